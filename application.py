@@ -1,10 +1,20 @@
 # application.py
 import os
-import csv
-from collections import defaultdict
-from flask import Flask # Only Flask itself, other Flask extensions if used by routes go to routes.py
+from flask import Flask, g, has_app_context # Only Flask itself, other Flask extensions if used by routes go to routes.py
 from dotenv import load_dotenv # type: ignore
-import traceback # Import traceback for better error printing
+import hashlib
+import threading
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import gtfs_store
+import metrics
+from memory_cache import SizedLRUCache
+from route_catalogue import RouteCatalogue
+from shape_encoding import encode_json_points, encode_polyline, encode_float32_shape
+from feed_poller import FeedPoller
+from recorder import FeedRecorder
+from gtfs_reloader import GtfsReloader
 
 # Load environment variables from .env file
 load_dotenv()
@@ -15,246 +25,329 @@ app = Flask(__name__)
 # --- Configuration ---
 TFNSW_API_KEY = os.getenv("API_KEY")
 app.config["TFNSW_API_KEY"] = TFNSW_API_KEY # Store in app.config if routes need it
-TFNSW_BUS_URL = "https://api.transport.nsw.gov.au/v1/gtfs/vehiclepos/buses"
+# BUS_URL can point at a local stand-in feed (see feed_server.py)
+TFNSW_BUS_URL = os.getenv("BUS_URL", "https://api.transport.nsw.gov.au/v1/gtfs/vehiclepos/buses")
 app.config["TFNSW_BUS_URL"] = TFNSW_BUS_URL # Store in app.config
 GOOGLE_MAPS_API_KEY = os.getenv("GOOGLE_MAPS_API_KEY")
 app.config["GOOGLE_MAPS_API_KEY"] = GOOGLE_MAPS_API_KEY # Store in app.config
+# One process polls TfNSW and shares each snapshot with the other workers via this file
+FEED_POLL_SECONDS = float(os.getenv("FEED_POLL_SECONDS", "10"))
+# Each /api/bus_stream connection is closed after this long (the browser reconnects),
+# so streams can't hold a worker forever
+BUS_STREAM_MAX_SECONDS = int(os.getenv("BUS_STREAM_MAX_SECONDS", "300"))
+BUS_STREAM_HEARTBEAT_SECONDS = 15
+# Set FEED_RECORD_DIR to keep a history of every snapshot for /api/replay (see recorder.py)
+FEED_RECORD_DIR = os.getenv("FEED_RECORD_DIR")
+FEED_RECORD_KEEP_HOURS = int(os.getenv("FEED_RECORD_KEEP_HOURS", "48"))
+REPLAY_MAX_SECONDS = int(os.getenv("REPLAY_MAX_SECONDS", str(6 * 3600)))
+# Shared by this app's processes: in the app's own .feed directory and named after the feed URL, so
+# another instance on the host (a dev server on feed_server.py, a benchmark) never shares it
+FEED_SNAPSHOT_PATH = os.getenv("FEED_SNAPSHOT_PATH") or os.path.join(
+    '.feed', f"vehiclepos-{hashlib.sha256(TFNSW_BUS_URL.encode('utf-8')).hexdigest()[:12]}.pb")
 
 # --- Constants ---
-GTFS_STATIC_DIR = 'gtfs_static'
+GTFS_STATIC_DIR = os.getenv("GTFS_STATIC_DIR", 'gtfs_static')
 app.config["GTFS_STATIC_DIR"] = GTFS_STATIC_DIR
+# GTFS_NETWORK selects which GTFS files are served:
+#   subset  the hand-cut *2606.txt files for one local operator (committed in the repo)
+#   full    the complete statewide feed: every agency in agency.txt (download it; see README)
+GTFS_NETWORK_FILES = {
+    "subset": {"routes": 'routes2606.txt', "trips": 'trips2606.txt', "shapes": 'shapes2606.txt',
+               "stop_times": 'stop_times2606.txt'},
+    "full": {"routes": 'routes.txt', "trips": 'trips.txt', "shapes": 'shapes.txt',
+             "stop_times": 'stop_times.txt'},
+}
+GTFS_NETWORK = os.getenv("GTFS_NETWORK", "subset")
+if GTFS_NETWORK not in GTFS_NETWORK_FILES:
+    raise ValueError(f"GTFS_NETWORK must be one of: {', '.join(GTFS_NETWORK_FILES)}")
+GTFS_ROUTES_FILE = GTFS_NETWORK_FILES[GTFS_NETWORK]["routes"]
+GTFS_TRIPS_FILE = GTFS_NETWORK_FILES[GTFS_NETWORK]["trips"]
+GTFS_SHAPES_FILE = GTFS_NETWORK_FILES[GTFS_NETWORK]["shapes"]
+GTFS_STOP_TIMES_FILE = GTFS_NETWORK_FILES[GTFS_NETWORK]["stop_times"]
+GTFS_SOURCE_FILES = {
+    "agency": 'agency.txt',
+    "routes": GTFS_ROUTES_FILE,
+    "trips": GTFS_TRIPS_FILE,
+    "shapes": GTFS_SHAPES_FILE,
+    "calendar": 'calendar.txt',
+    "calendar_dates": 'calendar_dates.txt',
+}
+# stop_times is optional (it is not committed); without it /api/schedule_deviation is unavailable
+if os.path.exists(os.path.join(GTFS_STATIC_DIR, GTFS_STOP_TIMES_FILE)):
+    GTFS_SOURCE_FILES["stop_times"] = GTFS_STOP_TIMES_FILE
+# Service dates ("today") are in the feed's timezone
+GTFS_TIMEZONE = ZoneInfo(os.getenv("GTFS_TIMEZONE", "Australia/Sydney"))
+# Compiled, memory-mapped copy of the files above (see gtfs_store.py). 'byte_index'
+# keeps shape points in the shapes file itself and only indexes where each shape is;
+# the default for the full network, whose shapes.txt is too big to copy per dataset
+GTFS_SHAPES_LAYOUT = os.getenv("GTFS_SHAPES_LAYOUT", "byte_index" if GTFS_NETWORK == "full" else "columns")
+GTFS_STORE_DIR = os.path.join(GTFS_STATIC_DIR, gtfs_store.DEFAULT_STORE_DIRNAME)
+# How often each process checks the GTFS files for a new dataset to load (see gtfs_reloader.py); 0 disables
+GTFS_RELOAD_SECONDS = float(os.getenv("GTFS_RELOAD_SECONDS", "60"))
+ROUTE_SHAPES_CACHE_MAX_BYTES = int(os.getenv("ROUTE_SHAPES_CACHE_MAX_MB", "64")) * 1024 * 1024
+# Compressed bodies of dataset-derived API responses (see http_cache.py)
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_MB", "32")) * 1024 * 1024
+
+
+# --- GTFS static dataset: the compiled store and what is built from it ---
+class GtfsDataset:
+    """
+    One version of the GTFS static data: the compiled, memory-mapped store
+    (see gtfs_store.py) and the route/agency catalogue built from it (see
+    route_catalogue.py). A reload builds a complete new one and swaps it in with
+    one assignment, so no lookup ever sees a store and catalogue of different versions.
+    """
+    __slots__ = ('store', 'catalogue', 'version')
+
+    def __init__(self, store):
+        self.store = store
+        self.version = store.version
+        self.catalogue = RouteCatalogue(store)
+        print(f"Route catalogue built: {len(self.catalogue.agencies)} agencies, "
+              f"{self.catalogue.realtime_route_count} realtime routes.")
+
+_gtfs_dataset = None
+_gtfs_dataset_lock = threading.Lock()
+# source_signature() of the files the last failed build was tried on: they aren't tried
+# again until they change, so broken sources don't cost a compile per request
+_gtfs_failed_signature = None
+
+def _latest_dataset():
+    """
+    The dataset in use, mapping (building if needed) the store on first use; None if
+    unavailable. After a failed build, tries again only once the source files change.
+    """
+    global _gtfs_dataset, _gtfs_failed_signature
+    if _gtfs_dataset is None:
+        if _gtfs_failed_signature == gtfs_store.source_signature(GTFS_STATIC_DIR, GTFS_SOURCE_FILES):
+            return None
+        with _gtfs_dataset_lock:
+            if _gtfs_dataset is None:
+                signature = gtfs_store.source_signature(GTFS_STATIC_DIR, GTFS_SOURCE_FILES)
+                if signature == _gtfs_failed_signature:
+                    return None
+                store = gtfs_store.load_or_build(GTFS_STATIC_DIR, GTFS_STORE_DIR, GTFS_SOURCE_FILES,
+                                                 GTFS_SHAPES_LAYOUT)
+                if store is None:
+                    _gtfs_failed_signature = signature
+                    print("GTFS store unavailable; it will be built again once the source files change.")
+                else:
+                    _gtfs_dataset = GtfsDataset(store)
+    return _gtfs_dataset
+
+def get_gtfs_dataset():
+    """
+    The GtfsDataset for the current request: the one in use when the request
+    first asked, so a request that overlaps a reload finishes on the old
+    version. Outside a request, the latest one.
+    """
+    if not has_app_context():
+        return _latest_dataset()
+    dataset = g.get('gtfs_dataset')
+    if dataset is None:
+        dataset = g.gtfs_dataset = _latest_dataset()
+    return dataset
+
+def get_gtfs_store():
+    dataset = get_gtfs_dataset()
+    return dataset.store if dataset is not None else None
+
+def get_route_catalogue():
+    dataset = get_gtfs_dataset()
+    return dataset.catalogue if dataset is not None else None
+
+def _store_in_use():
+    dataset = _gtfs_dataset
+    return dataset.store if dataset is not None else None
 
+def _swap_dataset(store):
+    """Builds the dataset for a newly loaded store and makes it the one in use (see gtfs_reloader.py)."""
+    global _gtfs_dataset
+    _gtfs_dataset = GtfsDataset(store)
+
+gtfs_reloader = GtfsReloader(GTFS_STATIC_DIR, GTFS_STORE_DIR, GTFS_SOURCE_FILES, GTFS_SHAPES_LAYOUT,
+                             GTFS_RELOAD_SECONDS, get_store=_store_in_use, on_reload=_swap_dataset)
 
-# --- Helper to load agency data (can be cached simply) ---
-_agency_data_cache = None
 def get_agency_name_map():
-    global _agency_data_cache
-    if _agency_data_cache is None:
-        _agency_data_cache = {}
-        # Use app.config for GTFS_STATIC_DIR if preferred, or keep direct reference
-        agency_file = os.path.join(GTFS_STATIC_DIR, 'agency.txt')
-        if os.path.exists(agency_file):
-            try:
-                with open(agency_file, 'r', encoding='utf-8-sig') as f_agency:
-                    reader = csv.DictReader(f_agency)
-                    for row in reader:
-                        _agency_data_cache[row['agency_id']] = row['agency_name']
-                print(f"Agency name map loaded with {len(_agency_data_cache)} entries.")
-            except Exception as e:
-                print(f"Error reading agency.txt: {e}")
-                traceback.print_exc()
-        else:
-            print(f"Warning: agency.txt not found at {agency_file}")
-    return _agency_data_cache
+    """agency_id -> agency_name from the GTFS store's agency table."""
+    catalogue = get_route_catalogue()
+    return catalogue.agency_names if catalogue is not None else {}
+
+def get_dataset_version():
+    """Content hash of the GTFS static files in use, or None if the store is unavailable."""
+    store = get_gtfs_store()
+    return store.version if store is not None else None
 
-# --- Cache for load_gtfs_shapes results ---
-_route_shapes_cache = {}
+def service_date_today():
+    return datetime.now(GTFS_TIMEZONE).date()
 
-def load_gtfs_shapes(target_realtime_routes: set):
+def default_service_date():
     """
-    Processes static GTFS data to extract shapes for the given target_realtime_routes.
-    Results are cached in-memory.
-    Returns a dictionary: { "realtime_route_id": [[{lat: y, lng: x}, ...]], ... }
-    or an empty dictionary if no shapes are found or errors occur.
+    Today's date for filtering by active services, or None (no filtering) if the
+    dataset's calendar doesn't cover today, e.g. an expired static feed.
     """
-    global _route_shapes_cache
-    cache_key = frozenset(target_realtime_routes)
-
-    if cache_key in _route_shapes_cache:
-        print(f"Cache HIT for load_gtfs_shapes with key: {cache_key}")
-        return _route_shapes_cache[cache_key]
-    
-    print(f"Cache MISS for load_gtfs_shapes with key: {cache_key}. Processing GTFS...")
+    store = get_gtfs_store()
+    today = service_date_today()
+    return today if store is not None and store.covers_date(today) else None
+
+def get_dataset_day_version():
+    """Like get_dataset_version, but also changes with default_service_date."""
+    version = get_dataset_version()
+    return f"{version}-{default_service_date()}" if version is not None else None
+
+# Compressed, ETag-addressed response bodies shared by the dataset_cached endpoints
+response_cache = SizedLRUCache(RESPONSE_CACHE_MAX_BYTES)
+metrics.watch_cache('response', response_cache)
+
+# --- Cache for load_gtfs_shapes (LRU, bounded by approximate memory) ---
+# ('shape', shape content hash, tolerance, fmt) -> that shape encoded in fmt, shared by
+# every route and request that uses it. Keyed by content rather than shape index, so
+# entries stay valid across dataset reloads and unchanged shapes stay cached.
+_route_shapes_cache = SizedLRUCache(ROUTE_SHAPES_CACHE_MAX_BYTES)
+metrics.watch_cache('route_shapes', _route_shapes_cache)
+_BYTES_PER_JSON_POINT = 232  # one {'lat', 'lng'} dict plus its two floats
+_BYTES_PER_ENTRY = 56
+
+def _route_shape_indexes(store, catalogue, realtime_id, service_date):
+    """Shape indexes for one realtime route id, one per distinct shape content."""
+    # The store already lists each content once per static route; merge across them.
+    shape_indexes = {}
+    for route_idx in catalogue.route_indexes(realtime_id):
+        for shape_idx in store.shape_indexes_for_route(route_idx, service_date):
+            shape_indexes[shape_idx] = None
+    return list(shape_indexes)
+
+def _encoded_shape(store, shape_idx, shape_hash, tolerance, fmt):
+    """One shape, simplified to tolerance and encoded in fmt (see shape_encoding.py); cached."""
+    cache_key = ('shape', shape_hash, tolerance, fmt)
+    encoded = _route_shapes_cache.get(cache_key)
+    if encoded is None:
+        lats, lngs = store.simplified_shape_points(shape_idx, tolerance)
+        if fmt == 'polyline':
+            encoded = encode_polyline(lats, lngs)
+            size = len(encoded) + _BYTES_PER_ENTRY
+        elif fmt == 'binary':
+            encoded = encode_float32_shape(lats, lngs)
+            size = len(encoded) + _BYTES_PER_ENTRY
+        else:
+            encoded = encode_json_points(lats, lngs)
+            size = len(encoded) * _BYTES_PER_JSON_POINT + _BYTES_PER_ENTRY
+        _route_shapes_cache.put(cache_key, encoded, size)
+    return encoded
 
+def load_gtfs_shapes(target_realtime_routes: set, tolerance=None, fmt='json', service_date=None):
+    """
+    Looks up shapes for the given target_realtime_routes ("<agency_id>_<route_short_name>")
+    in the compiled GTFS store, simplified to tolerance degrees if given. With
+    service_date (a datetime.date), only shapes of trips running that day are included.
+    Shapes are identified by their content hash, so a shape used by several of the
+    routes is listed once. Each encoded shape is cached individually.
+    Returns a dictionary:
+        { "routes": { "realtime_route_id": [shape_hash, ...], ... },
+          "shapes": { shape_hash: shape, ... } }
+    where each shape is [{lat: y, lng: x}, ...] for fmt 'json', an encoded-polyline
+    string for 'polyline' or a float32 record for 'binary'. Both are empty if no
+    shapes are found or errors occur.
+    """
+    final_result = {"routes": {}, "shapes": {}}
     if not target_realtime_routes:
-        print("load_gtfs_shapes: No target routes provided, returning empty shapes.")
-        return {}
-
-    print(f"Loading GTFS shapes for {len(target_realtime_routes)} target routes: {target_realtime_routes}")
-
-    route_shapes_for_this_request = defaultdict(list)
-    # Use app.config for GTFS_STATIC_DIR if preferred
-    shapes_file = os.path.join(GTFS_STATIC_DIR, 'shapes2606.txt')
-    trips_file = os.path.join(GTFS_STATIC_DIR, 'trips2606.txt')
-    routes_file_path = os.path.join(GTFS_STATIC_DIR, 'routes2606.txt')
-
-    target_short_names = set()
-    short_name_to_realtime_id = {}
-    agency_id_from_realtime_route = {}
-
-    for rt_id in target_realtime_routes:
-        try:
-            parts = rt_id.split('_', 1)
-            if len(parts) == 2:
-                agency_id, short_name = parts
-                target_short_names.add(short_name)
-                agency_id_from_realtime_route[rt_id] = agency_id
-                if (agency_id, short_name) not in short_name_to_realtime_id:
-                     short_name_to_realtime_id[(agency_id, short_name)] = rt_id
-            else:
-                short_name = rt_id
-                target_short_names.add(short_name)
-                if short_name not in short_name_to_realtime_id:
-                     short_name_to_realtime_id[short_name] = rt_id
-        except Exception as e:
-            print(f"Warning: Could not parse agency/short name from target route '{rt_id}': {e}")
-            continue
-
-    if not target_short_names:
-        print("load_gtfs_shapes: No valid target short names could be extracted.")
-        _route_shapes_cache[cache_key] = {}
-        return {}
+        return final_result
 
-    if not os.path.exists(shapes_file): print(f"ERROR (load_gtfs_shapes): shapes2606.txt not found"); _route_shapes_cache[cache_key] = {}; return {}
-    if not os.path.exists(trips_file): print(f"ERROR (load_gtfs_shapes): trips2606.txt not found"); _route_shapes_cache[cache_key] = {}; return {}
-    if not os.path.exists(routes_file_path): print(f"ERROR (load_gtfs_shapes): routes2606.txt not found"); _route_shapes_cache[cache_key] = {}; return {}
+    dataset = get_gtfs_dataset()
+    if dataset is None:
+        print("ERROR (load_gtfs_shapes): GTFS store unavailable.")
+        return final_result
+    store, catalogue = dataset.store, dataset.catalogue
 
-    agency_short_name_to_static_ids = defaultdict(set)
-    static_id_to_agency_short_name = {}
-    try:
-        with open(routes_file_path, 'r', encoding='utf-8-sig') as f_routes:
-            reader = csv.DictReader(f_routes)
-            for row in reader:
-                 try:
-                      current_short_name = row.get('route_short_name')
-                      static_route_id = row.get('route_id')
-                      current_agency_id = row.get('agency_id')
-                      if current_agency_id and current_short_name and static_route_id and \
-                         current_short_name in target_short_names and \
-                         short_name_to_realtime_id.get((current_agency_id, current_short_name)):
-                           agency_short_name_to_static_ids[(current_agency_id, current_short_name)].add(static_route_id)
-                           static_id_to_agency_short_name[static_route_id] = (current_agency_id, current_short_name)
-                 except KeyError as e:
-                      print(f"Warning (load_gtfs_shapes): Missing column '{e}' in routes.txt row. Skipping.")
-                      continue
-            if not agency_short_name_to_static_ids:
-                 print("ERROR (load_gtfs_shapes): No routes found in routes.txt matching target (agency, short_name)s.")
-                 _route_shapes_cache[cache_key] = {}
-                 return {}
-    except Exception as e:
-        print(f"ERROR (load_gtfs_shapes): Failed to read routes.txt: {e}")
-        traceback.print_exc()
-        _route_shapes_cache[cache_key] = {}
-        return {}
-
-    all_relevant_static_ids = set(static_id_to_agency_short_name.keys())
-    if not all_relevant_static_ids:
-         print("ERROR (load_gtfs_shapes): Processing routes.txt yielded no relevant static route IDs.")
-         _route_shapes_cache[cache_key] = {}
-         return {}
-
-    static_id_to_shape_ids = defaultdict(set)
-    try:
-        with open(trips_file, 'r', encoding='utf-8-sig') as f_trips:
-            reader = csv.DictReader(f_trips)
-            for row in reader:
-                 try:
-                      static_route_id = row.get('route_id')
-                      shape_id = row.get('shape_id')
-                      if static_route_id and shape_id and static_route_id in all_relevant_static_ids:
-                           static_id_to_shape_ids[static_route_id].add(shape_id)
-                 except KeyError as e:
-                      print(f"Warning (load_gtfs_shapes): Missing column '{e}' in trips.txt row. Skipping.")
-                      continue
-    except Exception as e:
-        print(f"ERROR (load_gtfs_shapes): Failed to read trips.txt: {e}")
-        traceback.print_exc()
-        _route_shapes_cache[cache_key] = {}
-        return {}
-
-    all_relevant_shape_ids = set(s_id for shapes in static_id_to_shape_ids.values() for s_id in shapes)
-    if not all_relevant_shape_ids:
-         print("WARNING (load_gtfs_shapes): No relevant shape IDs found after processing trips.")
-         _route_shapes_cache[cache_key] = {}
-         return {}
-
-    shape_id_to_points = defaultdict(list)
-    try:
-        with open(shapes_file, 'r', encoding='utf-8-sig') as f_shapes:
-            reader = csv.DictReader(f_shapes)
-            for row in reader:
-                try:
-                    shape_id = row.get('shape_id')
-                    if shape_id and shape_id in all_relevant_shape_ids:
-                        shape_id_to_points[shape_id].append({
-                            'lat': float(row['shape_pt_lat']),
-                            'lng': float(row['shape_pt_lon']),
-                            'seq': int(row['shape_pt_sequence'])
-                        })
-                except (ValueError, KeyError, TypeError):
-                     continue
-    except Exception as e:
-        print(f"ERROR (load_gtfs_shapes): Failed to read shapes.txt: {e}")
-        traceback.print_exc()
-        _route_shapes_cache[cache_key] = {}
-        return {}
-
-    processed_shape_points = {}
-    for shape_id in list(shape_id_to_points.keys()):
-        try:
-             points = shape_id_to_points[shape_id]
-             points.sort(key=lambda p: p['seq'])
-             final_points = [{'lat': p['lat'], 'lng': p['lng']} for p in points]
-             if final_points and len(final_points) >= 2:
-                processed_shape_points[shape_id] = final_points
-        except Exception as e:
-            print(f"Warning (load_gtfs_shapes): Error processing points for shape_id {shape_id}: {e}.")
+    route_refs, shapes = final_result["routes"], final_result["shapes"]
+    for realtime_id in target_realtime_routes:
+        shape_indexes = _route_shape_indexes(store, catalogue, realtime_id, service_date)
+        if not shape_indexes:
             continue
+        refs = []
+        for shape_idx in shape_indexes:
+            shape_hash = store.shape_hashes[shape_idx]
+            if shape_hash not in shapes:
+                shapes[shape_hash] = _encoded_shape(store, shape_idx, shape_hash, tolerance, fmt)
+            refs.append(shape_hash)
+        route_refs[realtime_id] = refs
 
-    if not processed_shape_points:
-         print("WARNING (load_gtfs_shapes): No valid shape coordinate lists generated.")
-         _route_shapes_cache[cache_key] = {}
-         return {}
+    if not route_refs:
+        print(f"WARNING (load_gtfs_shapes): No shapes found for {len(target_realtime_routes)} requested routes.")
 
-    for realtime_id in target_realtime_routes:
-        agency_id_part = agency_id_from_realtime_route.get(realtime_id)
-        short_name_part = None
-        if agency_id_part:
-            short_name_part = realtime_id[len(agency_id_part)+1:]
-
-        if not agency_id_part or not short_name_part:
-            continue
+    return final_result
 
-        lookup_key = (agency_id_part, short_name_part)
-        static_ids_for_key = agency_short_name_to_static_ids.get(lookup_key, set())
-        if not static_ids_for_key:
-            continue
+# --- Shared realtime feed poller (see feed_poller.py) ---
+feed_recorder = FeedRecorder(FEED_RECORD_DIR, FEED_RECORD_KEEP_HOURS) if FEED_RECORD_DIR else None
+feed_poller = FeedPoller(TFNSW_BUS_URL, TFNSW_API_KEY, FEED_SNAPSHOT_PATH, FEED_POLL_SECONDS, feed_recorder)
 
-        shapes_for_this_realtime_id = set()
-        for static_id in static_ids_for_key:
-            shape_ids_for_static_route = static_id_to_shape_ids.get(static_id, set())
-            for shape_id in shape_ids_for_static_route:
-                if shape_id in processed_shape_points:
-                    point_list = processed_shape_points[shape_id]
-                    point_tuple = tuple(tuple(sorted(p.items())) for p in point_list)
-                    shapes_for_this_realtime_id.add(point_tuple)
-
-        if shapes_for_this_realtime_id:
-             route_shapes_for_this_request[realtime_id] = [
-                 [dict(p_item for p_item in point_tuple_item) for point_tuple_item in point_tuple]
-                 for point_tuple in shapes_for_this_realtime_id
-             ]
-
-    final_result = dict(route_shapes_for_this_request)
-    _route_shapes_cache[cache_key] = final_result
-
-    if not final_result:
-        print(f"WARNING (load_gtfs_shapes): route_shapes_for_this_request is empty for targets: {target_realtime_routes}")
+def process_memory():
+    """
+    This process's memory in kB: {'Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty',
+    'Private_Clean', 'Private_Dirty'} from /proc/self/smaps_rollup on Linux,
+    otherwise just {'MaxRss'} from getrusage.
+    """
+    fields = ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty')
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            values = {}
+            for line in f:
+                name, _, rest = line.partition(':')
+                if name in fields:
+                    values[name] = int(rest.split()[0])
+            return values
+    except OSError:
+        import resource
+        return {'MaxRss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def memory_report(label):
+    """One line describing this process's memory, for startup logs."""
+    memory = process_memory()
+    if 'Rss' not in memory:
+        return f"{label} (pid {os.getpid()}): max RSS {memory['MaxRss'] // 1024} MB"
+    shared = memory.get('Shared_Clean', 0) + memory.get('Shared_Dirty', 0)
+    private = memory.get('Private_Clean', 0) + memory.get('Private_Dirty', 0)
+    return (f"{label} (pid {os.getpid()}): RSS {memory['Rss'] // 1024} MB, PSS {memory.get('Pss', 0) // 1024} MB, "
+            f"shared {shared // 1024} MB, private {private // 1024} MB")
+
+
+def start_background_tasks():
+    """
+    Starts this process's threads: the realtime feed poller, the GTFS dataset
+    reloader and the /metrics flusher. Called by initialize_app_data, or, when gunicorn preloads the app,
+    in each worker after the fork (see gunicorn.conf.py) so the master forks
+    without threads or held locks.
+    """
+    metrics.ensure_flushing() # Share this process's /metrics values with the other workers, if METRICS_DIR is set
+    gtfs_reloader.ensure_started() # Swap in a new GTFS dataset when the static files change
+    if TFNSW_API_KEY:
+        feed_poller.ensure_started()
     else:
-        print(f"Successfully generated shapes for {len(final_result)} of the {len(target_realtime_routes)} requested routes.")
+        print("Warning: API_KEY not set, realtime feed poller not started.")
 
-    return final_result
 
 def initialize_app_data():
     """
     Function to explicitly initialize any app-level data that needs to be ready
     before the first request, like the agency name map.
+
+    Under a preloading gunicorn master (BUSMAP_PRELOAD set by gunicorn.conf.py)
+    this runs once before the workers fork, so they all share the mapped GTFS
+    store and the route catalogue's pages copy-on-write; the background tasks
+    are then left to each worker.
     """
     print("-----------------------------------------------------")
     print("Initializing application data...")
-    print("GTFS static data will be loaded on-demand per API request.")
     print("Ensure GTFS files exist in 'gtfs_static' directory.")
-    get_agency_name_map() # Initialize agency name map once at startup
+    get_gtfs_dataset() # Map (building if needed) the compiled GTFS store and index its routes once at startup
+    if get_gtfs_store() is not None and default_service_date() is None:
+        print(f"Warning: the GTFS calendar does not cover {service_date_today()}; "
+              f"route shapes will not be filtered by active services.")
+    if os.getenv("BUSMAP_PRELOAD"):
+        print(memory_report("Preloaded in the gunicorn master"))
+    else:
+        start_background_tasks()
     print("Application data initialization complete.")
     print("-----------------------------------------------------")
 
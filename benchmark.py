@@ -0,0 +1,326 @@
+# benchmark.py
+"""
+Benchmarks for the GTFS shape pipeline, the /api/* handlers and the realtime
+feed parse-and-filter path, on a synthetic feed (see synthetic_gtfs.py).
+
+    python benchmark.py --scale subset --output before.json
+    ... change something ...
+    python benchmark.py --scale subset --compare before.json
+
+Each stage is run --repeat times for wall time (min and median reported), then
+once more under tracemalloc for memory:
+
+    peak_kib       peak Python heap allocated during the stage
+    retained_kib   Python heap still allocated when it returns
+    net_blocks     change in allocated object blocks (sys.getallocatedblocks)
+
+Memory-mapped store files are not Python heap, so they don't count towards
+these. The results file records the commit, scale, seed and interpreter, so
+runs of different commits on the same machine can be compared; --compare
+flags stages whose median time (by more than MIN_REGRESSION_MS) or peak
+memory grew by more than --threshold and exits with status 1 if any did.
+
+Stages:
+    compile            build the store from scratch (all of the below, and the other files)
+    compile_csv_read   read and parse the shapes file (columns layout)
+    compile_shapes     assemble the parsed points into shape columns (columns layout)
+    compile_dedup      list each route's shapes once per distinct content
+    open_store         open an already compiled store
+    catalogue          build the route/agency catalogue
+    shapes_assemble    load_gtfs_shapes() for --routes-per-request routes, empty shape cache
+    shapes_cached      the same with a warm shape cache
+    shapes_json        serialize that result to JSON
+    api_route_shapes   GET /api/route_shapes, empty response cache (includes compression)
+    api_routes_by_agency  GET /api/routes_by_agency for every agency, empty response cache
+    feed_parse         parse a --vehicles GTFS-realtime payload
+    feed_index         decode and index it (VehicleIndex)
+    feed_filter        route and viewport selection on the index
+    feed_records       build the JSON-ready dicts of the viewport's vehicles
+    api_bus_data       GET /api/bus_data for --routes-per-request routes
+"""
+import os
+import io
+import gc
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import tracemalloc
+import contextlib
+
+import synthetic_gtfs
+
+DEFAULT_DATA_ROOT = os.path.join(tempfile.gettempdir(), 'busmap-benchmark')
+DEFAULT_THRESHOLD = 0.15
+# Time differences below this are timer noise, whatever the ratio
+MIN_REGRESSION_MS = 1.0
+# Stages that take seconds at full scale are repeated at most this often
+SLOW_STAGE_REPEAT = 3
+
+
+class Stage:
+    def __init__(self, name, run, setup=None, slow=False):
+        self.name = name
+        self.run = run
+        self.setup = setup
+        self.slow = slow
+
+
+def _git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def _measure(stage, repeat):
+    """Runs one stage; returns its result dict."""
+    if stage.slow:
+        repeat = min(repeat, SLOW_STAGE_REPEAT)
+    times = []
+    for _ in range(repeat):
+        if stage.setup:
+            stage.setup()
+        gc.collect()
+        start = time.perf_counter()
+        stage.run()
+        times.append(time.perf_counter() - start)
+
+    if stage.setup:
+        stage.setup()
+    gc.collect()
+    blocks_before = sys.getallocatedblocks()
+    tracemalloc.start()
+    try:
+        stage.run()
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    net_blocks = sys.getallocatedblocks() - blocks_before
+
+    return {
+        "repeat": repeat,
+        "wall_min_ms": round(min(times) * 1000, 3),
+        "wall_median_ms": round(statistics.median(times) * 1000, 3),
+        "peak_kib": round(peak / 1024, 1),
+        "retained_kib": round(retained / 1024, 1),
+        "net_blocks": net_blocks,
+    }
+
+
+def _build_stages(data_dir, args):
+    """Imports the app against the synthetic feed and returns the list of Stages."""
+    os.environ["GTFS_STATIC_DIR"] = data_dir
+    os.environ["GTFS_NETWORK"] = "full"
+    if args.layout:
+        os.environ["GTFS_SHAPES_LAYOUT"] = args.layout
+    os.environ["FEED_SNAPSHOT_PATH"] = os.path.join(data_dir, 'benchmark_vehiclepos.pb')
+    os.environ.pop("API_KEY", None)
+    os.environ.pop("FEED_RECORD_DIR", None)
+
+    import application
+    import routes  # noqa: F401  (registers the views)
+    import gtfs_store
+    from route_catalogue import RouteCatalogue
+    from buses import parse_feed, VehicleIndex
+    from feed_server import SyntheticFeed, RecordedFeed, start_server
+
+    compile_root = os.path.join(data_dir, 'benchmark-compile')
+
+    def clean_compile_root():
+        shutil.rmtree(compile_root, ignore_errors=True)
+
+    store = application.get_gtfs_store()
+    catalogue = application.get_route_catalogue()
+    rng = random.Random(args.seed)
+    realtime_ids = catalogue.realtime_ids()
+    sample_routes = set(rng.sample(realtime_ids, min(args.routes_per_request, len(realtime_ids))))
+    routes_param = ','.join(sorted(sample_routes))
+    all_agencies = ','.join(agency["id"] for agency in catalogue.agencies)
+    client = application.app.test_client()
+    state = {}
+
+    # The steps of the compile on their own; dedup runs against the opened store's trips
+    shapes_path = os.path.join(data_dir, application.GTFS_SOURCE_FILES["shapes"])
+
+    def read_shape_points():
+        for _ in gtfs_store._read_shape_points(shapes_path):
+            pass
+
+    def prepare_shape_points():
+        clean_compile_root()
+        os.makedirs(compile_root)
+        if "shape_points" not in state:
+            state["shape_points"] = list(gtfs_store._read_shape_points(shapes_path))
+
+    def assemble_shapes():
+        state["shape_columns"] = gtfs_store._compile_shapes(state["shape_points"], compile_root)
+
+    def prepare_dedup():
+        if "shape_columns" not in state:
+            prepare_shape_points()
+            assemble_shapes()
+        state.pop("shape_points", None)
+
+    def dedup_shapes():
+        _, shape_hashes, shape_point_counts = state["shape_columns"]
+        gtfs_store._dedup_route_shapes(len(store.route_ids), shape_hashes, shape_point_counts, store.trip_route,
+                                       store.trip_shape, store.trip_service, store.service_days,
+                                       store._day_row_bytes)
+
+    def assemble():
+        state["shapes"] = application.load_gtfs_shapes(sample_routes)
+
+    def get(url):
+        response = client.get(url, headers={"Accept-Encoding": "gzip"})
+        if response.status_code != 200:
+            raise RuntimeError(f"{url} returned {response.status_code}")
+        return response
+
+    # One synthetic realtime payload on the feed's own routes
+    feed_routes = [(realtime_id, []) for realtime_id in realtime_ids]
+    payload = SyntheticFeed(args.vehicles, feed_routes, args.seed).message(0, 1_700_000_000)
+    feed = parse_feed(payload)
+    index = VehicleIndex(feed)
+    viewport = (-33.9, 151.0, -33.7, 151.2)
+
+    # Publish it through the real poller, fetching from a local feed server once
+    payload_path = os.path.join(data_dir, 'benchmark_payload.pb')
+    with open(payload_path, 'wb') as f:
+        f.write(payload)
+    feed_server = start_server(RecordedFeed(payload_path), update_seconds=0)
+    poller = application.feed_poller
+    poller.api_url, poller.api_key, poller.interval = feed_server.url, 'benchmark', 3600
+    application.app.config["TFNSW_API_KEY"] = 'benchmark'
+    application.app.config["TFNSW_BUS_URL"] = feed_server.url
+    poller.poll_once()
+
+    return [
+        Stage("compile", lambda: gtfs_store.compile_gtfs(data_dir, compile_root, application.GTFS_SOURCE_FILES,
+                                                         application.GTFS_SHAPES_LAYOUT),
+              setup=clean_compile_root, slow=True),
+        Stage("compile_csv_read", read_shape_points, slow=True),
+        Stage("compile_shapes", assemble_shapes, setup=prepare_shape_points, slow=True),
+        Stage("compile_dedup", dedup_shapes, setup=prepare_dedup),
+        Stage("open_store", lambda: gtfs_store.load_or_build(data_dir, application.GTFS_STORE_DIR,
+                                                             application.GTFS_SOURCE_FILES,
+                                                             application.GTFS_SHAPES_LAYOUT)),
+        Stage("catalogue", lambda: RouteCatalogue(store)),
+        Stage("shapes_assemble", assemble, setup=application._route_shapes_cache.clear),
+        Stage("shapes_cached", assemble),
+        Stage("shapes_json", lambda: application.app.json.dumps(state["shapes"])),
+        Stage("api_route_shapes", lambda: get(f"/api/route_shapes?routes={routes_param}&date=all"),
+              setup=lambda: (application.response_cache.clear(), application._route_shapes_cache.clear())),
+        Stage("api_routes_by_agency", lambda: get(f"/api/routes_by_agency?agency_ids={all_agencies}"),
+              setup=application.response_cache.clear),
+        Stage("feed_parse", lambda: parse_feed(payload)),
+        Stage("feed_index", lambda: VehicleIndex(feed)),
+        Stage("feed_filter", lambda: (index.select(sample_routes), index.select(None, viewport))),
+        Stage("feed_records", lambda: state["index"].records(state["index"].select(None, viewport)),
+              setup=lambda: state.update(index=VehicleIndex(feed))),
+        Stage("api_bus_data", lambda: get(f"/api/bus_data?routes={routes_param}")),
+    ], {"distinct_shapes": len(set(store.shape_hashes)), "shapes": len(store.shape_hashes),
+        "realtime_routes": len(realtime_ids), "payload_bytes": len(payload)}
+
+
+def _compare(results, baseline, threshold):
+    """Prints a comparison table; returns the names of regressed stages."""
+    print(f"\nCompared with {baseline['meta'].get('commit')} "
+          f"({'dirty' if baseline['meta'].get('dirty') else 'clean'}), threshold {threshold:.0%}:")
+    print(f"{'stage':<22}{'median ms':>12}{'was':>12}{'ratio':>8}{'peak KiB':>12}{'was':>12}{'ratio':>8}")
+    regressed = []
+    for name, result in results["stages"].items():
+        old = baseline["stages"].get(name)
+        if old is None:
+            print(f"{name:<22}{result['wall_median_ms']:>12.2f}{'-':>12}")
+            continue
+        time_ratio = result["wall_median_ms"] / old["wall_median_ms"] if old["wall_median_ms"] else 1.0
+        peak_ratio = result["peak_kib"] / old["peak_kib"] if old["peak_kib"] else 1.0
+        flag = ''
+        slower = (time_ratio > 1 + threshold
+                  and result["wall_median_ms"] - old["wall_median_ms"] > MIN_REGRESSION_MS)
+        if slower or peak_ratio > 1 + threshold:
+            regressed.append(name)
+            flag = '  REGRESSED'
+        print(f"{name:<22}{result['wall_median_ms']:>12.2f}{old['wall_median_ms']:>12.2f}{time_ratio:>8.2f}"
+              f"{result['peak_kib']:>12.1f}{old['peak_kib']:>12.1f}{peak_ratio:>8.2f}{flag}")
+    if baseline["meta"].get("params") != results["meta"]["params"]:
+        print("Warning: the baseline was run with different parameters; ratios are not comparable.")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the shape pipeline, API handlers and feed parsing.")
+    parser.add_argument('--scale', choices=sorted(synthetic_gtfs.SCALES), default='subset')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--data-dir', help=f"where to generate the feed (default {DEFAULT_DATA_ROOT}/<scale>-<seed>)")
+    parser.add_argument('--layout', choices=('columns', 'byte_index'), help="shape layout (default: the app's)")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--routes-per-request', type=int, default=50)
+    parser.add_argument('--vehicles', type=int, default=3000)
+    parser.add_argument('--stages', help="comma-separated subset of stages to run")
+    parser.add_argument('--output', help="write results as JSON to this file")
+    parser.add_argument('--compare', help="results JSON of an earlier run to compare against")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or os.path.join(DEFAULT_DATA_ROOT, f"{args.scale}-{args.seed}")
+    generate_start = time.perf_counter()
+    feed_params = synthetic_gtfs.generate(data_dir, args.scale, args.seed)
+    print(f"Synthetic feed ({args.scale}) ready in {data_dir} ({time.perf_counter() - generate_start:.1f} s)")
+
+    # The app reports what it does with print(); keep that out of the timings and the table
+    with contextlib.redirect_stdout(io.StringIO()):
+        stages, dataset = _build_stages(data_dir, args)
+    if args.stages:
+        wanted = set(args.stages.split(','))
+        stages = [stage for stage in stages if stage.name in wanted]
+
+    commit, dirty = _git_revision()
+    import application
+    results = {
+        "meta": {
+            "commit": commit,
+            "dirty": dirty,
+            "time": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": {"feed": feed_params, "layout": application.GTFS_SHAPES_LAYOUT, "repeat": args.repeat,
+                       "routes_per_request": args.routes_per_request, "vehicles": args.vehicles},
+            "dataset": dataset,
+        },
+        "stages": {},
+    }
+
+    print(f"{'stage':<22}{'min ms':>10}{'median ms':>12}{'peak KiB':>12}{'retained KiB':>14}{'net blocks':>12}")
+    for stage in stages:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = _measure(stage, args.repeat)
+        results["stages"][stage.name] = result
+        print(f"{stage.name:<22}{result['wall_min_ms']:>10.2f}{result['wall_median_ms']:>12.2f}"
+              f"{result['peak_kib']:>12.1f}{result['retained_kib']:>14.1f}{result['net_blocks']:>12}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if _compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,23 @@
 import os
-import requests
+import math
+from array import array
 from google.transit import gtfs_realtime_pb2 # type: ignore
 from datetime import datetime
 
-def fetch_and_filter_bus_positions(api_url, api_key, target_routes):
-    """
-    Fetches real-time vehicle positions and filters for specific routes.
+from metrics import FEED_PARSE_SECONDS
+from upstream import default_client
 
-    Args:
-        api_url (str): The GTFS-realtime vehicle positions API endpoint URL.
-        api_key (str): Your TfNSW API key.
-        target_routes (set): A set of route_id strings to filter for.2606_
+# Vehicles are also bucketed into a grid of this cell size (degrees, ~1 km) for bbox queries
+GRID_CELL_DEGREES = 0.01
+
+def fetch_feed_bytes(api_url, api_key):
+    """
+    Downloads the raw GTFS-realtime vehicle positions feed through the shared
+    upstream client (pooled, coalesced, revalidated, retried; see upstream.py).
 
     Returns:
-        list: A list of dictionaries, each containing info for a matching vehicle.
-              Returns None if fetching or parsing fails.
+        bytes: The protobuf payload, or None if the request fails. An unchanged
+        feed returns the same bytes object as the previous call.
     """
     # Check if variables loaded correctly
     if not api_key:
@@ -27,78 +30,250 @@ def fetch_and_filter_bus_positions(api_url, api_key, target_routes):
     headers = {
         "Authorization": f"apikey {api_key}"
     }
+    return default_client.fetch(api_url, headers)
 
-    response = None # Initialize response to None
-    try:
-        response = requests.get(api_url, headers=headers, timeout=30) # 30 second timeout
-        response.raise_for_status()  # Raise an exception for bad status codes (4xx or 5xx)
-        print("Data fetched successfully.")
-
-    except requests.exceptions.Timeout:
-        print("Error: Request timed out.")
-        return None
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching data: {e}")
-        # Check specifically for 401/403 which might indicate API key issues
-        if response is not None: # Check if response object exists
-             if response.status_code == 401 or response.status_code == 403:
-                  print("Authentication failed (401/403). Check your API key (TFNSW_API_KEY in .env) and ensure it has access.")
-             elif response.status_code == 404:
-                  print("API endpoint not found (404). Check the URL (ACTUAL_API_ENDPOINT_URL in .env).")
-        return None
+def parse_feed(content):
+    """
+    Parses a GTFS-realtime payload.
 
+    Returns:
+        FeedMessage: The parsed feed, or None if parsing fails.
+    """
     # Initialize the GTFS-realtime feed message object
     feed = gtfs_realtime_pb2.FeedMessage()
 
     try:
         # Parse the binary data from the response content
-        feed.ParseFromString(response.content)
-        print("Data parsed successfully.")
+        with FEED_PARSE_SECONDS.time():
+            feed.ParseFromString(content)
     except Exception as e:
         print(f"Error parsing GTFS-realtime data: {e}")
         return None
+    return feed
+
+def fetch_and_filter_bus_positions(api_url, api_key, target_routes):
+    """
+    Fetches real-time vehicle positions and filters for specific routes.
+
+    Args:
+        api_url (str): The GTFS-realtime vehicle positions API endpoint URL.
+        api_key (str): Your TfNSW API key.
+        target_routes (set): A set of route_id strings to filter for.2606_
+
+    Returns:
+        list: A list of dictionaries, each containing info for a matching vehicle.
+              Returns None if fetching or parsing fails.
+    """
+    content = fetch_feed_bytes(api_url, api_key)
+    if content is None:
+        return None
+    feed = parse_feed(content)
+    if feed is None:
+        return None
+    return filter_bus_positions(feed, target_routes)
+
+def _grid_cell(latitude, longitude):
+    return (int(latitude // GRID_CELL_DEGREES), int(longitude // GRID_CELL_DEGREES))
 
-    matching_vehicles = []
-    current_timestamp = datetime.now() # For comparing data freshness if needed
+def _optional(value):
+    """A float column value, or None where it is missing (NaN)."""
+    return None if value != value else value
+
+class VehicleIndex:
+    """
+    All vehicles of one parsed feed, decoded once into columns and indexed by
+    route_id, trip_id, vehicle_id and grid cell.
 
-    # Iterate through each entity in the feed
-    for entity in feed.entity:
-        # Check if the entity has vehicle position data and trip data
-        if entity.HasField('vehicle') and entity.vehicle.HasField('trip'):
+    Each column holds one value per vehicle ("row"): route_id, trip_id,
+    vehicle_id and stop_id are lists of str ('' when missing); latitude,
+    longitude, bearing and speed (m/s) are float arrays (NaN when missing);
+    timestamp (0 when missing) and stop_sequence (-1 when missing) are int
+    arrays. Lookups return row numbers and only touch the matching vehicles (or
+    grid cells). record() / records() build the JSON-ready dicts for the rows a
+    response actually sends, so speed strings and datetimes are only made for
+    vehicles some client asked for, once per snapshot. Treat as read-only; it is
+    shared between requests.
+    """
+
+    def __init__(self, feed):
+        nan = math.nan
+        self.route_id, self.trip_id, self.vehicle_id, self.stop_id = [], [], [], []
+        self.latitude, self.longitude = array('d'), array('d')
+        self.bearing, self.speed = array('d'), array('d')
+        self.timestamp, self.stop_sequence = array('q'), array('q')
+
+        # Appends bound once, and plain attribute reads instead of HasField where
+        # the default means missing anyway ('' ids, timestamp 0): this loop runs
+        # over every vehicle of every snapshot
+        add_route, add_trip = self.route_id.append, self.trip_id.append
+        add_vehicle, add_stop = self.vehicle_id.append, self.stop_id.append
+        add_latitude, add_longitude = self.latitude.append, self.longitude.append
+        add_bearing, add_speed = self.bearing.append, self.speed.append
+        add_timestamp, add_stop_sequence = self.timestamp.append, self.stop_sequence.append
+        for entity in feed.entity:
+            # Only vehicle positions with a trip that has a route_id are indexed
             vehicle = entity.vehicle
-            trip = entity.vehicle.trip
-
-            # Check if the trip has a route_id and if it's in our target set
-            # Ensure comparison with strings
-            if trip.HasField('route_id') and str(trip.route_id) in target_routes:
-
-                # --- MODIFICATION START ---
-                # Calculate speed safely, ensuring it's always a string
-                speed_value = 'N/A' # Default to 'N/A' string
-                if vehicle.HasField('position') and vehicle.position.HasField('speed'):
-                    try:
-                        speed_kmh = vehicle.position.speed * 3.6
-                        speed_value = f"{speed_kmh:.1f} km/h"
-                    except TypeError:
-                        speed_value = 'Data Error'
-                    except Exception as e:
-                        print(f"Warning: Error calculating speed for vehicle {vehicle.vehicle.id if vehicle.HasField('vehicle') else 'Unknown'}: {e}")
-                        speed_value = 'Calc Error'
-                # --- MODIFICATION END ---
-            
-                # Extract relevant information
-                position_info = {
-                    "route_id": str(trip.route_id), # Store as string
-                    "trip_id": trip.trip_id if trip.HasField('trip_id') else 'N/A',
-                    "vehicle_id": vehicle.vehicle.id if vehicle.HasField('vehicle') and vehicle.vehicle.HasField('id') else 'N/A',
-                    "latitude": vehicle.position.latitude if vehicle.HasField('position') and vehicle.position.HasField('latitude') else None,
-                    "longitude": vehicle.position.longitude if vehicle.HasField('position') and vehicle.position.HasField('longitude') else None,
-                    "bearing": vehicle.position.bearing if vehicle.HasField('position') and vehicle.position.HasField('bearing') else None,
-                    "speed": speed_value,
-                    "timestamp": datetime.fromtimestamp(vehicle.timestamp) if vehicle.HasField('timestamp') else None,
-                    "raw_timestamp": vehicle.timestamp if vehicle.HasField('timestamp') else None # Keep raw timestamp if needed
-                }
-                matching_vehicles.append(position_info)
-
-    print(f"Found {len(matching_vehicles)} vehicles matching the target routes ({', '.join(target_routes)}).")
-    return matching_vehicles
+            trip = vehicle.trip
+            route_id = trip.route_id
+            if not route_id:
+                continue
+            add_route(route_id)
+            add_trip(trip.trip_id)
+            add_vehicle(vehicle.vehicle.id)
+            add_stop(vehicle.stop_id)
+            if vehicle.HasField('position'):
+                position = vehicle.position
+                add_latitude(position.latitude)  # required fields of a Position
+                add_longitude(position.longitude)
+                add_bearing(position.bearing if position.HasField('bearing') else nan)
+                add_speed(position.speed if position.HasField('speed') else nan)
+            else:
+                add_latitude(nan)
+                add_longitude(nan)
+                add_bearing(nan)
+                add_speed(nan)
+            add_timestamp(vehicle.timestamp)
+            add_stop_sequence(vehicle.current_stop_sequence if vehicle.HasField('current_stop_sequence') else -1)
+        self.count = len(self.route_id)
+        self._records = [None] * self.count  # record() of each row, once asked for
+
+        self.by_route = {}  # route_id -> rows
+        for row, route_id in enumerate(self.route_id):
+            rows = self.by_route.get(route_id)
+            if rows is None:
+                self.by_route[route_id] = [row]
+            else:
+                rows.append(row)
+        # Later rows win for repeated ids, as the feed's last word on that trip or vehicle
+        self.by_trip = dict(zip(self.trip_id, range(self.count)))
+        self.by_trip.pop('', None)
+        self.by_vehicle = dict(zip(self.vehicle_id, range(self.count)))
+        self.by_vehicle.pop('', None)
+        self.by_cell = {}  # _grid_cell(lat, lng) -> rows; vehicles without a position are left out
+        for row, (latitude, longitude) in enumerate(zip(self.latitude, self.longitude)):
+            if latitude == latitude and longitude == longitude:
+                self.by_cell.setdefault(_grid_cell(latitude, longitude), []).append(row)
+
+    def record(self, row):
+        """
+        The JSON-ready dict for one row (as /api/bus_data returns it), built on
+        first use and then shared, so it must not be mutated.
+        """
+        record = self._records[row]
+        if record is None:
+            record = self._records[row] = self._build_record(row)
+        return record
+
+    def _build_record(self, row):
+        speed = self.speed[row]
+        timestamp = self.timestamp[row]
+        stop_sequence = self.stop_sequence[row]
+        return {
+            "route_id": self.route_id[row],
+            "trip_id": self.trip_id[row] or 'N/A',
+            "vehicle_id": self.vehicle_id[row] or 'N/A',
+            "latitude": _optional(self.latitude[row]),
+            "longitude": _optional(self.longitude[row]),
+            "bearing": _optional(self.bearing[row]),
+            "speed": 'N/A' if speed != speed else f"{speed * 3.6:.1f} km/h",
+            "timestamp": datetime.fromtimestamp(timestamp) if timestamp else None,
+            "raw_timestamp": timestamp or None, # Keep raw timestamp if needed
+            "stop_sequence": stop_sequence if stop_sequence >= 0 else None,
+            "stop_id": self.stop_id[row] or None,
+        }
+
+    def records(self, rows):
+        """record() of each of rows, in order."""
+        record = self.record
+        return [record(row) for row in rows]
+
+    def _in_bbox(self, row, bbox):
+        # False for vehicles without a position (NaN compares false)
+        south, west, north, east = bbox
+        return south <= self.latitude[row] <= north and west <= self.longitude[row] <= east
+
+    def for_routes(self, target_routes):
+        """Rows of the vehicles whose route_id is in target_routes."""
+        matching_rows = []
+        for route_id in target_routes:
+            rows = self.by_route.get(route_id)
+            if rows:
+                matching_rows.extend(rows)
+        return matching_rows
+
+    def in_bbox(self, bbox):
+        """
+        Rows of the vehicles inside bbox (south, west, north, east in degrees, edges
+        included). Visits whichever is fewer, the grid cells the bbox covers or the
+        occupied cells.
+        """
+        south, west, north, east = bbox
+        (cell_south, cell_west), (cell_north, cell_east) = _grid_cell(south, west), _grid_cell(north, east)
+        covered_cells = (cell_north - cell_south + 1) * (cell_east - cell_west + 1)
+        if covered_cells < len(self.by_cell):
+            cells = ((y, x) for y in range(cell_south, cell_north + 1) for x in range(cell_west, cell_east + 1))
+        else:
+            cells = (cell for cell in self.by_cell
+                     if cell_south <= cell[0] <= cell_north and cell_west <= cell[1] <= cell_east)
+
+        matching_rows = []
+        for cell in cells:
+            rows = self.by_cell.get(cell)
+            if not rows:
+                continue
+            # Cells strictly inside the bbox need no per-vehicle test
+            if cell_south < cell[0] < cell_north and cell_west < cell[1] < cell_east:
+                matching_rows.extend(rows)
+            else:
+                matching_rows.extend(row for row in rows if self._in_bbox(row, bbox))
+        return matching_rows
+
+    def select(self, target_routes=None, bbox=None):
+        """Rows of the vehicles on target_routes and/or inside bbox; either filter may be None."""
+        if bbox is None:
+            return self.for_routes(target_routes or ())
+        if target_routes is None:
+            return self.in_bbox(bbox)
+        return [row for row in self.for_routes(target_routes) if self._in_bbox(row, bbox)]
+
+    def changes_since(self, previous, target_routes=None, bbox=None):
+        """
+        Compares this index with an older one for the vehicles selected by
+        target_routes and/or bbox (see select). A vehicle that leaves the
+        selection counts as removed. Vehicles without a vehicle_id can't be
+        tracked, so no delta could ever remove them; if either selection has one,
+        there is no delta and None is returned (send the full list instead).
+
+        Returns:
+            tuple or None: (list of rows of added or changed vehicles, list of removed vehicle_ids)
+        """
+        changed = []
+        current_ids = set()
+        for row in self.select(target_routes, bbox):
+            vehicle_id = self.vehicle_id[row]
+            if not vehicle_id:
+                return None
+            current_ids.add(vehicle_id)
+            previous_row = previous.by_vehicle.get(vehicle_id)
+            if previous_row is None or previous.record(previous_row) != self.record(row):
+                changed.append(row)
+
+        removed = []
+        for row in previous.select(target_routes, bbox):
+            vehicle_id = previous.vehicle_id[row]
+            if not vehicle_id:
+                return None
+            if vehicle_id not in current_ids:
+                removed.append(vehicle_id)
+        return changed, removed
+
+def filter_bus_positions(feed, target_routes):
+    """
+    Extracts the vehicles on target_routes from an already parsed feed.
+    Prefer building one VehicleIndex per feed when querying it repeatedly.
+
+    Returns:
+        list: A list of dictionaries, each containing info for a matching vehicle.
+    """
+    index = VehicleIndex(feed)
+    return index.records(index.for_routes(target_routes))
@@ -0,0 +1,239 @@
+# concurrency_benchmark.py
+"""
+How many concurrent clients one server process holds.
+
+Starts the local stand-in feed (feed_server.py, optionally slow or stalling)
+and one gunicorn worker of the given class, then for each --clients level runs
+that many keep-alive clients requesting /api/bus_data in a loop for
+--duration seconds, while --streams clients hold /api/bus_stream open.
+Reports per level: requests per second, latency percentiles, errors and how
+many streams stayed connected.
+
+    python concurrency_benchmark.py --worker-class gthread --clients 10,100,500 --streams 50
+    python concurrency_benchmark.py --worker-class gevent --clients 10,100,1000 --streams 500
+    python concurrency_benchmark.py --worker-class sync --clients 10,50 --streams 1
+
+--url benchmarks an already running server instead (then the worker and feed
+options are ignored). The client side is one asyncio event loop, so it isn't
+the bottleneck at these sizes.
+"""
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+from urllib.parse import urlsplit
+
+import feed_server
+
+STARTUP_TIMEOUT_SECONDS = 120
+CONNECT_TIMEOUT_SECONDS = 10
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_for(url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=5) as response:
+                if response.status == 200:
+                    return True
+        except OSError:
+            pass
+        time.sleep(0.5)
+    return False
+
+
+async def _read_response(reader):
+    """Reads one HTTP/1.1 response; returns (status, keep-alive?)."""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed")
+    status = int(status_line.split()[1])
+    length, keep_alive = 0, True
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        name, value = name.strip().lower(), value.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'connection' and value == 'close':
+            keep_alive = False
+    if length:
+        await reader.readexactly(length)
+    return status, keep_alive
+
+
+async def _client(host, port, path, stop_at, latencies, errors):
+    reader = writer = None
+    request = f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: keep-alive\r\n\r\n".encode()
+    while time.monotonic() < stop_at:
+        started = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), CONNECT_TIMEOUT_SECONDS)
+            writer.write(request)
+            status, keep_alive = await asyncio.wait_for(_read_response(reader), max(1.0, stop_at - time.monotonic()))
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError, IndexError):
+            if time.monotonic() >= stop_at:
+                break  # still waiting when the level ended: unfinished, not failed
+            errors.append('connection')
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+            await asyncio.sleep(0.05)
+            continue
+        if status == 200:
+            latencies.append(time.perf_counter() - started)
+        else:
+            errors.append(status)
+        if not keep_alive:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def _stream(host, port, path, stop_at, stats):
+    """Holds one SSE connection until stop_at, counting 'vehicles' events."""
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), CONNECT_TIMEOUT_SECONDS)
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+        status_line = await asyncio.wait_for(reader.readline(), CONNECT_TIMEOUT_SECONDS)
+        if b' 200 ' not in status_line:
+            stats["failed"] += 1
+            writer.close()
+            return
+    except (OSError, asyncio.TimeoutError):
+        stats["failed"] += 1
+        return
+    stats["connected"] += 1
+    try:
+        while time.monotonic() < stop_at:
+            chunk = await asyncio.wait_for(reader.read(65536), max(0.1, stop_at - time.monotonic()))
+            if not chunk:
+                break
+            stats["events"] += chunk.count(b'event: vehicles')
+    except (OSError, asyncio.TimeoutError):
+        pass
+    finally:
+        stats["held"] += time.monotonic() >= stop_at - 0.5
+        writer.close()
+
+
+async def _run_level(host, port, clients, streams, duration, routes):
+    stop_at = time.monotonic() + duration
+    latencies, errors = [], []
+    stream_stats = {"connected": 0, "failed": 0, "held": 0, "events": 0}
+    tasks = [_stream(host, port, f"/api/bus_stream?routes={routes}", stop_at, stream_stats) for _ in range(streams)]
+    tasks += [_client(host, port, f"/api/bus_data?routes={routes}", stop_at, latencies, errors)
+              for _ in range(clients)]
+    started = time.monotonic()
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - started
+    return latencies, errors, stream_stats, elapsed
+
+
+def _percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def _start_servers(args, routes):
+    """Starts the stand-in feed and one gunicorn worker; returns (base url, cleanup)."""
+    faults = feed_server.FaultConfig(latency_ms=args.upstream_latency_ms, stall_rate=args.upstream_stall_rate,
+                                     stall_seconds=30)
+    feed = feed_server.start_server(feed_server.SyntheticFeed(args.vehicles, routes), update_seconds=2,
+                                    faults=faults)
+    port = _free_port()
+    snapshot_dir = tempfile.mkdtemp(prefix='busmap-concurrency-')
+    env = dict(os.environ, BUS_URL=feed.url, API_KEY='benchmark', FEED_POLL_SECONDS='2',
+               GUNICORN_WORKER_CLASS=args.worker_class,
+               FEED_SNAPSHOT_PATH=os.path.join(snapshot_dir, 'vehiclepos.pb'))
+    env.pop('FEED_RECORD_DIR', None)
+    command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}',
+               '--workers', '1', '--worker-class', args.worker_class,
+               '--threads', str(args.threads if args.worker_class == 'gthread' else 1),
+               '--worker-connections', str(args.worker_connections), '--backlog', '4096', 'app:app']
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def cleanup():
+        server.terminate()
+        try:
+            server.wait(15)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        feed.shutdown()
+
+    base_url = f"http://127.0.0.1:{port}"
+    first_route = routes[0][0] if routes else '2606_900'
+    if not _wait_for(f"{base_url}/api/bus_data?routes={first_route}", STARTUP_TIMEOUT_SECONDS):
+        cleanup()
+        raise RuntimeError(f"gunicorn ({args.worker_class}) did not start serving within {STARTUP_TIMEOUT_SECONDS}s")
+    return base_url, cleanup
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure concurrent clients one server process can hold.")
+    parser.add_argument('--url', help="benchmark this running server instead of starting one")
+    parser.add_argument('--worker-class', default='gthread', choices=('sync', 'gthread', 'gevent'))
+    parser.add_argument('--threads', type=int, default=32, help="gthread threads")
+    parser.add_argument('--worker-connections', type=int, default=1000, help="gevent connections")
+    parser.add_argument('--clients', default='10,50,100,250', help="comma-separated concurrency levels")
+    parser.add_argument('--streams', type=int, default=0, help="SSE streams held open during each level")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds per level")
+    parser.add_argument('--routes-per-request', type=int, default=5)
+    parser.add_argument('--vehicles', type=int, default=3000, help="stand-in feed size")
+    parser.add_argument('--upstream-latency-ms', type=float, default=0, help="stand-in feed response delay")
+    parser.add_argument('--upstream-stall-rate', type=float, default=0.0,
+                        help="fraction of feed requests that stall for 30 s")
+    args = parser.parse_args()
+
+    routes = feed_server._load_realtime_routes(feed_server.DEFAULT_ROUTES_FILE, feed_server.DEFAULT_TRIPS_FILE) or []
+    route_ids = [realtime_id for realtime_id, _ in routes[:args.routes_per_request]] or ['2606_900']
+    routes_param = ','.join(route_ids)
+
+    cleanup = None
+    if args.url:
+        base_url = args.url.rstrip('/')
+        description = base_url
+    else:
+        base_url, cleanup = _start_servers(args, routes)
+        description = (f"1 gunicorn {args.worker_class} worker"
+                       + (f", {args.threads} threads" if args.worker_class == 'gthread' else '')
+                       + (f", upstream latency {args.upstream_latency_ms:.0f} ms" if args.upstream_latency_ms else '')
+                       + (f", upstream stalls {args.upstream_stall_rate:.0%}" if args.upstream_stall_rate else ''))
+    parts = urlsplit(base_url)
+    host, port = parts.hostname, parts.port or 80
+
+    print(f"{description}; {args.streams} streams held; {args.duration:.0f} s per level")
+    print(f"{'clients':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'errors':>8}"
+          f"{'streams held':>14}{'events':>8}")
+    try:
+        for clients in (int(c) for c in args.clients.split(',')):
+            latencies, errors, streams, elapsed = asyncio.run(
+                _run_level(host, port, clients, args.streams, args.duration, routes_param))
+            print(f"{clients:>8}{len(latencies) / elapsed:>10.1f}{_percentile(latencies, 0.5) * 1000:>10.1f}"
+                  f"{_percentile(latencies, 0.99) * 1000:>10.1f}"
+                  f"{(max(latencies) if latencies else float('nan')) * 1000:>10.1f}{len(errors):>8}"
+                  f"{streams['held']:>8}/{args.streams:<5}{streams['events']:>8}")
+    finally:
+        if cleanup is not None:
+            cleanup()
+
+
+if __name__ == '__main__':
+    main()
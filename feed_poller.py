@@ -0,0 +1,235 @@
+# feed_poller.py
+"""
+Shared background poller for the TfNSW vehicle positions feed.
+
+Every process (gunicorn worker, dev server) runs a FeedPoller thread, but only
+the one holding an exclusive lock on '<snapshot_path>.lock' talks to TfNSW.
+It fetches the feed every `interval` seconds and publishes it by atomically
+replacing the snapshot file (versions fit in a JavaScript number):
+
+    b'BMS2' | uint64 version (epoch microseconds at fetch) | 8-byte feed id | GTFS-realtime payload
+
+The feed id is a hash of the feed URL and API key (see feed_source_id), and a
+snapshot from any other feed is ignored, so a process never serves a feed it
+wasn't configured for. The snapshot's directory is created private to its user.
+
+The other processes only stat that file and re-parse it when it changes, so
+request handlers never wait on the upstream round trip. If the polling process
+exits its lock is released and another process takes over on its next attempt.
+The polling process also hands each new snapshot to the optional recorder
+(see recorder.py), off the request path.
+"""
+import os
+import time
+import hashlib
+import fcntl
+import struct
+import threading
+import traceback
+from collections import OrderedDict
+
+import metrics
+from buses import fetch_feed_bytes, parse_feed, VehicleIndex
+
+_SNAPSHOT_MAGIC = b'BMS2'
+_HEADER = struct.Struct('<4sQ8s')
+SNAPSHOT_HISTORY = 8  # recent snapshots kept per process for /api/bus_data?since= deltas
+
+
+class FeedSnapshot:
+    """
+    One feed download decoded into its VehicleIndex, built once per process.
+    The parsed FeedMessage itself isn't kept. Treat as read-only; it is shared
+    between requests.
+    """
+    __slots__ = ('version', 'fetched_at', 'vehicles')
+
+    def __init__(self, version, feed):
+        self.version = version
+        self.fetched_at = version / 1e6
+        with metrics.FEED_INDEX_SECONDS.time():
+            self.vehicles = VehicleIndex(feed)
+        metrics.SNAPSHOT_VEHICLES.set(self.vehicles.count)
+        metrics.SNAPSHOT_VEHICLES_HISTOGRAM.observe(self.vehicles.count)
+
+
+def feed_source_id(api_url, api_key):
+    """8-byte id of a feed (its URL and API key) for snapshot headers; doesn't reveal the key."""
+    return hashlib.sha256(f"{api_url}\0{api_key or ''}".encode('utf-8')).digest()[:8]
+
+
+def _make_snapshot_dir(path):
+    os.makedirs(os.path.dirname(path) or '.', mode=0o700, exist_ok=True)
+
+
+def write_snapshot_file(path, version, content, source_id):
+    _make_snapshot_dir(path)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(_SNAPSHOT_MAGIC, version, source_id))
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def read_snapshot_file(path, source_id=None):
+    """
+    Returns (version, payload bytes), or None if the file is missing, malformed
+    or (when source_id is given) from another feed.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    if len(data) < _HEADER.size:
+        return None
+    magic, version, file_source_id = _HEADER.unpack_from(data)
+    if magic != _SNAPSHOT_MAGIC or (source_id is not None and file_source_id != source_id):
+        return None
+    return version, data[_HEADER.size:]
+
+
+class FeedPoller:
+    def __init__(self, api_url, api_key, snapshot_path, interval, recorder=None):
+        self.api_url = api_url
+        self.recorder = recorder
+        self.api_key = api_key
+        self.snapshot_path = snapshot_path
+        self.lock_path = snapshot_path + '.lock'
+        self.interval = interval
+        self.is_leader = False
+        self._snapshot = None
+        self._snapshot_stat = None
+        self._pid = None
+        self._lock_file = None
+        self._published_content = None
+        self._history = OrderedDict()  # version -> FeedSnapshot, oldest first
+        self._read_lock = threading.Lock()
+
+    def ensure_started(self):
+        """Starts the polling thread in this process (again, after a fork)."""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self.is_leader = False
+        self._lock_file = None
+        thread = threading.Thread(target=self._run, name='feed-poller', daemon=True)
+        thread.start()
+
+    def _try_become_leader(self):
+        if self._lock_file is None:
+            _make_snapshot_dir(self.lock_path)
+            self._lock_file = open(self.lock_path, 'a+')
+        try:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        print(f"Feed poller: process {os.getpid()} is now polling {self.api_url} every {self.interval}s.")
+        return True
+
+    def _run(self):
+        metrics.ensure_flushing()  # the polling worker may never serve a request
+        while True:
+            started = time.monotonic()
+            try:
+                if not self.is_leader:
+                    self.is_leader = self._try_become_leader()
+                if self.is_leader:
+                    self.poll_once()
+            except Exception as e:
+                print(f"Feed poller error: {e}")
+                traceback.print_exc()
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def poll_once(self):
+        """
+        Fetches the feed and publishes it if it parses and differs from the last
+        published payload (so unchanged feeds don't produce new versions).
+        Returns True on success.
+        """
+        content = fetch_feed_bytes(self.api_url, self.api_key)
+        if content is None:
+            return False  # readers keep the last good snapshot
+        if content is self._published_content or content == self._published_content:
+            return True
+        feed = parse_feed(content)
+        if feed is None:
+            return False
+        version = time.time_ns() // 1000
+        write_snapshot_file(self.snapshot_path, version, content, feed_source_id(self.api_url, self.api_key))
+        self._published_content = content
+        snapshot = FeedSnapshot(version, feed)
+        with self._read_lock:
+            self._set_snapshot(snapshot)
+            self._snapshot_stat = None
+        metrics.SNAPSHOTS_PUBLISHED.inc()
+        if self.recorder is not None:
+            try:
+                self.recorder.record(version, snapshot.vehicles)
+            except Exception as e:
+                print(f"Feed recorder error: {e}")
+                traceback.print_exc()
+        return True
+
+    def _set_snapshot(self, snapshot):
+        self._snapshot = snapshot
+        self._history[snapshot.version] = snapshot
+        while len(self._history) > SNAPSHOT_HISTORY:
+            self._history.popitem(last=False)
+
+    def get_snapshot_version(self, version):
+        """Returns a recent snapshot seen by this process, or None if unknown or evicted."""
+        return self._history.get(version)
+
+    def get_snapshot(self):
+        """
+        Returns the latest FeedSnapshot (re-parsing the shared file only when it
+        has changed), or None if no snapshot has been published yet.
+        """
+        self.ensure_started()
+        try:
+            st = os.stat(self.snapshot_path)
+        except FileNotFoundError:
+            return self._snapshot
+        stat_key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if stat_key == self._snapshot_stat:
+            return self._snapshot
+
+        with self._read_lock:
+            if stat_key == self._snapshot_stat:
+                return self._snapshot
+            loaded = read_snapshot_file(self.snapshot_path, feed_source_id(self.api_url, self.api_key))
+            if loaded is None:
+                return self._snapshot
+            version, content = loaded
+            if self._snapshot is None or version != self._snapshot.version:
+                feed = parse_feed(content)
+                if feed is None:
+                    return self._snapshot
+                self._set_snapshot(FeedSnapshot(version, feed))
+            self._snapshot_stat = stat_key
+            return self._snapshot
+
+    def wait_for_new_snapshot(self, after_version, timeout, check_every=0.5):
+        """
+        Waits up to timeout seconds for a snapshot whose version differs from
+        after_version. Returns it, or None on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            snapshot = self.get_snapshot()
+            if snapshot is not None and snapshot.version != after_version:
+                return snapshot
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            time.sleep(min(check_every, remaining))
+
+    def wait_for_snapshot(self, timeout):
+        """Like get_snapshot, but waits up to timeout seconds for the first snapshot."""
+        deadline = time.monotonic() + timeout
+        snapshot = self.get_snapshot()
+        while snapshot is None and time.monotonic() < deadline:
+            time.sleep(0.2)
+            snapshot = self.get_snapshot()
+        return snapshot
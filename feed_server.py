@@ -0,0 +1,316 @@
+# feed_server.py
+"""
+Local stand-in for the TfNSW GTFS-realtime vehicle positions API.
+
+Serves synthetic or recorded FeedMessage protobufs over HTTP so the realtime
+pipeline (feed_poller, /api/bus_data, /api/bus_stream) can be run and measured
+without the network or an API key. Point the app at it with:
+
+    python feed_server.py --port 8765 --vehicles 3000
+    BUS_URL=http://127.0.0.1:8765/ API_KEY=local uv run app.py
+
+Feeds:
+    synthetic  --vehicles N vehicles spread over the routes of --routes-file
+               (default the operator's routes2606.txt, "<agency>_<short name>"
+               as in the live feed) with trips from --trips-file. Positions are
+               a pure function of --seed and the tick number, and the feed
+               changes every --update-seconds, so two runs serve identical bytes.
+    recorded   --recorded PATH: a recorder directory (FEED_RECORD_DIR, see
+               recorder.py), a feed snapshot file or a raw .pb file. Recorded
+               snapshots are served in order, one per --update-seconds, looping.
+
+Latency and faults (fractions apply per request, drawn from --seed):
+    --latency-ms / --jitter-ms   delay before the response
+    --error-rate                 503 responses
+    --truncate-rate              body cut in half (a protobuf parse error)
+    --stall-rate / --stall-seconds  hold the connection, to trigger client timeouts
+    --reset-rate                 close the connection without a response
+    --api-key                    require "Authorization: apikey <key>", else 401
+
+Responses carry an ETag; a matching If-None-Match gets 304 Not Modified.
+
+start_server() runs it in a background thread for scripts and benchmarks.
+"""
+import os
+import csv
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from google.transit import gtfs_realtime_pb2 # type: ignore
+
+from feed_poller import read_snapshot_file
+from recorder import replay_all
+
+DEFAULT_ROUTES_FILE = os.path.join('gtfs_static', 'routes2606.txt')
+DEFAULT_TRIPS_FILE = os.path.join('gtfs_static', 'trips2606.txt')
+
+# Synthetic vehicles start inside this box (roughly Sydney) and drift from there
+_SYNTHETIC_BOUNDS = (-34.1, 150.6, -33.5, 151.35)
+_SPEED_DEGREES_PER_TICK = 0.0005
+
+
+def _load_realtime_routes(routes_file, trips_file):
+    """[(realtime route id, [trip_id, ...]), ...] from a GTFS routes/trips pair, or None if missing."""
+    try:
+        with open(routes_file, newline='', encoding='utf-8-sig') as f:
+            realtime_ids = {
+                row['route_id']: f"{row['agency_id']}_{row['route_short_name']}"
+                for row in csv.DictReader(f)
+                if row.get('agency_id') and row.get('route_short_name')
+            }
+    except FileNotFoundError:
+        return None
+
+    trips = {}
+    try:
+        with open(trips_file, newline='', encoding='utf-8-sig') as f:
+            for row in csv.DictReader(f):
+                realtime_id = realtime_ids.get(row['route_id'])
+                if realtime_id:
+                    trips.setdefault(realtime_id, []).append(row['trip_id'])
+    except FileNotFoundError:
+        pass
+    return [(realtime_id, trips.get(realtime_id, [])) for realtime_id in sorted(set(realtime_ids.values()))]
+
+
+class SyntheticFeed:
+    """A deterministic fleet of vehicles that moves a little each tick."""
+
+    def __init__(self, vehicles, routes=None, seed=0):
+        if not routes:
+            routes = [(f"2606_{900 + i}", []) for i in range(100)]
+        rng = random.Random(seed)
+        south, west, north, east = _SYNTHETIC_BOUNDS
+        self._vehicles = []
+        for i in range(vehicles):
+            route_id, trip_ids = routes[i % len(routes)]
+            trip_id = rng.choice(trip_ids) if trip_ids else f"synthetic-{i}"
+            self._vehicles.append((
+                route_id, trip_id, f"{10000 + i}",
+                rng.uniform(south, north), rng.uniform(west, east),
+                rng.uniform(0, 360), rng.uniform(0, 20), rng.randint(1, 40),
+            ))
+
+    def message(self, tick, now):
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.header.gtfs_realtime_version = '2.0'
+        feed.header.incrementality = gtfs_realtime_pb2.FeedHeader.FULL_DATASET
+        feed.header.timestamp = int(now)
+        for i, (route_id, trip_id, vehicle_id, lat, lon, bearing, speed, first_stop) in enumerate(self._vehicles):
+            # Each vehicle oscillates around its start point so the fleet stays in the box
+            phase = (tick + i) % 200
+            step = phase if phase < 100 else 200 - phase
+            entity = feed.entity.add()
+            entity.id = vehicle_id
+            v = entity.vehicle
+            v.trip.trip_id = trip_id
+            v.trip.route_id = route_id
+            v.vehicle.id = vehicle_id
+            v.position.latitude = lat + step * _SPEED_DEGREES_PER_TICK
+            v.position.longitude = lon + step * _SPEED_DEGREES_PER_TICK
+            v.position.bearing = bearing
+            v.position.speed = speed
+            v.current_stop_sequence = first_stop + step // 10
+            v.timestamp = int(now) - (i % 30)
+        return feed.SerializeToString()
+
+
+class RecordedFeed:
+    """Recorded payloads, served in order and looped."""
+
+    def __init__(self, path):
+        if os.path.isdir(path):
+            self._payloads = [_vehicles_message(version, vehicles) for version, vehicles in replay_all(path)]
+        else:
+            snapshot = read_snapshot_file(path)
+            if snapshot is not None:
+                self._payloads = [snapshot[1]]
+            else:
+                with open(path, 'rb') as f:
+                    self._payloads = [f.read()]
+        if not self._payloads:
+            raise ValueError(f"no recorded snapshots found in {path}")
+
+    def __len__(self):
+        return len(self._payloads)
+
+    def message(self, tick, now):
+        return self._payloads[tick % len(self._payloads)]
+
+
+def _vehicles_message(version, vehicles):
+    """Rebuilds a FeedMessage from recorder.replay() vehicle dicts."""
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = '2.0'
+    feed.header.timestamp = version // 1000000
+    for vehicle in vehicles:
+        entity = feed.entity.add()
+        entity.id = vehicle["vehicle_id"] or vehicle["trip_id"] or str(len(feed.entity))
+        v = entity.vehicle
+        v.trip.route_id = vehicle["route_id"]
+        if vehicle["trip_id"]:
+            v.trip.trip_id = vehicle["trip_id"]
+        if vehicle["vehicle_id"]:
+            v.vehicle.id = vehicle["vehicle_id"]
+        for field in ("latitude", "longitude", "bearing", "speed"):
+            if vehicle[field] is not None:
+                setattr(v.position, field, vehicle[field])
+        if vehicle["timestamp"]:
+            v.timestamp = vehicle["timestamp"]
+    return feed.SerializeToString()
+
+
+class FaultConfig:
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0, truncate_rate=0.0,
+                 stall_rate=0.0, stall_seconds=60.0, reset_rate=0.0, api_key=None, seed=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.truncate_rate = truncate_rate
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.reset_rate = reset_rate
+        self.api_key = api_key
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def draw(self):
+        """(delay seconds, fault name or None) for one request."""
+        with self.lock:
+            delay = (self.latency_ms + self.random.uniform(0, self.jitter_ms)) / 1000
+            roll = self.random.random()
+        for name, rate in (('reset', self.reset_rate), ('stall', self.stall_rate),
+                           ('error', self.error_rate), ('truncate', self.truncate_rate)):
+            if roll < rate:
+                return delay, name
+            roll -= rate
+        return delay, None
+
+
+class FeedServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, feed, update_seconds=10.0, faults=None):
+        super().__init__(address, _FeedHandler)
+        self.feed = feed
+        self.update_seconds = update_seconds
+        self.faults = faults or FaultConfig()
+        self.started = time.time()
+        self.requests_served = 0
+        self._cached = (None, None)  # (tick, payload)
+        self._cache_lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def payload(self):
+        now = time.time()
+        tick = int((now - self.started) / self.update_seconds) if self.update_seconds > 0 else self.requests_served
+        with self._cache_lock:
+            cached_tick, payload = self._cached
+            if cached_tick != tick:
+                payload = self.feed.message(tick, now)
+                self._cached = (tick, payload)
+        return payload
+
+
+class _FeedHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.requests_served += 1
+        faults = server.faults
+        delay, fault = faults.draw()
+        if delay > 0:
+            time.sleep(delay)
+
+        if faults.api_key and self.headers.get('Authorization') != f"apikey {faults.api_key}":
+            self._send(401, b'unauthorized', 'text/plain')
+            return
+        if fault == 'reset':
+            self.close_connection = True
+            return
+        if fault == 'stall':
+            time.sleep(faults.stall_seconds)
+        if fault == 'error':
+            self._send(503, b'service unavailable (injected)', 'text/plain')
+            return
+
+        payload = server.payload()
+        etag = f'"{hashlib.sha1(payload).hexdigest()[:16]}"'
+        if self.headers.get('If-None-Match') == etag:
+            self._send(304, b'', None, etag)
+            return
+        if fault == 'truncate':
+            payload = payload[:len(payload) // 2]
+        self._send(200, payload, 'application/x-google-protobuf', etag)
+
+    def _send(self, status, body, content_type, etag=None):
+        self.send_response(status)
+        if etag:
+            self.send_header('ETag', etag)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(feed, host='127.0.0.1', port=0, update_seconds=10.0, faults=None):
+    """Starts a FeedServer in a daemon thread (port 0 picks a free port); stop it with shutdown()."""
+    server = FeedServer((host, port), feed, update_seconds, faults)
+    threading.Thread(target=server.serve_forever, name='feed-server', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve synthetic or recorded GTFS-realtime vehicle positions.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--vehicles', type=int, default=2000, help="synthetic fleet size (sets the payload size)")
+    parser.add_argument('--routes-file', default=DEFAULT_ROUTES_FILE)
+    parser.add_argument('--trips-file', default=DEFAULT_TRIPS_FILE)
+    parser.add_argument('--recorded', help="recorder directory, snapshot file or .pb file to serve instead")
+    parser.add_argument('--update-seconds', type=float, default=10.0,
+                        help="how often the feed changes; 0 changes it on every request")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--truncate-rate', type=float, default=0.0)
+    parser.add_argument('--stall-rate', type=float, default=0.0)
+    parser.add_argument('--stall-seconds', type=float, default=60.0)
+    parser.add_argument('--reset-rate', type=float, default=0.0)
+    parser.add_argument('--api-key', help="reject requests without this key")
+    args = parser.parse_args()
+
+    if args.recorded:
+        feed = RecordedFeed(args.recorded)
+        description = f"{len(feed)} recorded snapshot(s) from {args.recorded}"
+    else:
+        routes = _load_realtime_routes(args.routes_file, args.trips_file)
+        feed = SyntheticFeed(args.vehicles, routes, args.seed)
+        description = f"{args.vehicles} synthetic vehicles on {len(routes) if routes else 100} routes"
+    faults = FaultConfig(args.latency_ms, args.jitter_ms, args.error_rate, args.truncate_rate,
+                         args.stall_rate, args.stall_seconds, args.reset_rate, args.api_key, args.seed)
+
+    server = FeedServer((args.host, args.port), feed, args.update_seconds, faults)
+    print(f"Serving {description} at {server.url} (payload {len(server.payload())} bytes)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
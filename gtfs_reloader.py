@@ -0,0 +1,140 @@
+# gtfs_reloader.py
+"""
+Hot reload of the GTFS static dataset.
+
+Each process runs one GtfsReloader thread. Every `interval` seconds it stats
+the source files (gtfs_store.source_signature). When they differ from the
+dataset in use, and then stay unchanged for one more check (so a copy still in
+progress isn't compiled), it loads the new dataset in the background:
+whichever process gets <store_root>/build.lock first compiles the new version
+in a child process (python gtfs_store.py) and points CURRENT at it, the others
+wait for the lock and then only map what it built. The lock is polled rather
+than waited on and the compile runs in its own process, so under the gevent
+worker (where this thread is a greenlet) neither stalls the worker's requests.
+The opened store is handed to on_reload, which builds whatever else belongs
+to the dataset and swaps it all in with one assignment (see application.py).
+Requests keep serving the old dataset until then, and those already running
+finish on it.
+
+Compiled versions other than the new one and this process's previous one are
+deleted. A process still using an older one is unaffected: a store opens all
+of its files up front, and mapped files stay readable after deletion.
+
+Replace the source files by moving complete files into place (mv, or rsync's
+default write-then-rename): the byte_index shape layout maps shapes.txt itself,
+and a file overwritten in place under a mapping can crash the process reading it.
+"""
+import os
+import sys
+import json
+import time
+import fcntl
+import threading
+import traceback
+import subprocess
+
+import gtfs_store
+import metrics
+
+LOCK_RETRY_SECONDS = 1.0
+
+GTFS_RELOADS = metrics.Counter('busmap_gtfs_reloads_total',
+                               "GTFS static datasets swapped in after the files changed, by result.", ('result',))
+
+
+class GtfsReloader:
+    def __init__(self, gtfs_dir, store_root, source_files, shape_layout, interval, get_store, on_reload):
+        self.gtfs_dir = gtfs_dir
+        self.store_root = store_root
+        self.source_files = source_files
+        self.shape_layout = shape_layout
+        self.interval = interval
+        self.get_store = get_store  # the store in use, or None
+        self.on_reload = on_reload  # called with each newly opened GtfsStore
+        self._pid = None
+        self._seen = None  # signature of the files last loaded (or found unloadable)
+        self._pending = None  # a changed signature waiting to settle
+
+    def ensure_started(self):
+        """Starts the watching thread in this process (again, after a fork); not if interval is 0."""
+        if self.interval <= 0 or self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._run, name='gtfs-reloader', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check_once()
+            except Exception as e:
+                print(f"GTFS reloader error: {e}")
+                traceback.print_exc()
+
+    def check_once(self):
+        """
+        Loads and hands on the dataset if the source files have changed and
+        settled since the last check. Returns True if a new store was swapped in.
+        """
+        current = self.get_store()
+        if self._seen is None and current is not None:
+            self._seen = current.source_signature
+        signature = gtfs_store.source_signature(self.gtfs_dir, self.source_files)
+        if signature == self._seen:
+            self._pending = None
+            return False
+        if signature != self._pending:
+            self._pending = signature  # still changing, or just changed: look again next time
+            return False
+
+        self._seen, self._pending = signature, None
+        print(f"GTFS static files in {self.gtfs_dir} changed; loading the new dataset...")
+        started = time.monotonic()
+        store = self._load()
+        if store is None:
+            GTFS_RELOADS.labels('failed').inc()
+            print("GTFS reload failed; still serving the previous dataset.")
+            return False
+        if current is not None and store.version == current.version:
+            print(f"GTFS static files changed but their content didn't (version {store.version}).")
+            return False
+        self.on_reload(store)
+        GTFS_RELOADS.labels('loaded').inc()
+        print(f"GTFS dataset {store.version} in use "
+              f"(was {current.version if current is not None else 'none'}; {time.monotonic() - started:.1f}s).")
+        return True
+
+    def _load(self):
+        """Opens the store for the current files, compiling it if no other process has; None on failure."""
+        os.makedirs(self.store_root, exist_ok=True)
+        with open(os.path.join(self.store_root, 'build.lock'), 'a+') as lock_file:
+            # Held by a process compiling; polled, so waiting only ever sleeps
+            while True:
+                try:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    time.sleep(LOCK_RETRY_SECONDS)
+            if not gtfs_store.is_current(self.gtfs_dir, self.store_root, self.source_files, self.shape_layout):
+                if not self._compile():
+                    return None
+            store = gtfs_store.open_current(self.store_root)
+            if store is not None:
+                current = self.get_store()
+                keep = {store.version} | ({current.version} if current is not None else set())
+                try:
+                    gtfs_store.prune_versions(self.store_root, keep)
+                except OSError as e:
+                    print(f"Could not remove old GTFS store versions: {e}")
+        return store
+
+    def _compile(self):
+        """Compiles the current files in a child process, keeping its CPU time and memory out of this one."""
+        command = [sys.executable, os.path.abspath(gtfs_store.__file__), self.gtfs_dir,
+                   '--store-root', self.store_root, '--shape-layout', self.shape_layout,
+                   '--source-files', json.dumps(self.source_files)]
+        result = subprocess.run(command)
+        if result.returncode != 0:
+            print(f"GTFS store compile exited with status {result.returncode}.")
+            return False
+        return True
@@ -0,0 +1,980 @@
+# gtfs_store.py
+"""
+Compiled, memory-mapped GTFS static store.
+
+The GTFS text files are compiled once into a columnar binary layout:
+
+    <store_root>/CURRENT              name of the active version directory
+    <store_root>/<version>/meta.json  counts, source file stats, format number
+    <store_root>/<version>/*.txt      string tables (one value per line)
+    <store_root>/<version>/*.bin      fixed-width numeric columns
+
+Shape points live in two float64 columns (lat, lon) with a uint32 offsets
+column per shape, so looking up a shape is a slice of a memory-mapped file.
+A float32 significance column alongside them holds each point's
+Douglas-Peucker significance (see shape_simplify.py), so any level of detail
+is a threshold filter. Routes map to the shapes their trips use through a CSR
+pair of columns (route_shape_offsets / route_shape_idx) computed at build time.
+Service calendars (calendar.txt + calendar_dates.txt) are expanded into one
+bitset per service with a bit per day (service_days.bin), and each route/shape
+pair gets the union of its trips' bitsets (route_shape_days.bin), so "which
+shapes run on this date" is a bit test.
+
+When stop_times.txt is a source it is compiled into flat columns (int32 arrival
+seconds, uint32 stop index and stop_sequence) with a [start, end) row range per
+trip, and trip ids are kept as a sorted, memory-mapped blob so a trip_id is found
+by binary search. Schedule lookups therefore allocate nothing per trip, and the
+columns are page cache shared between workers rather than per-process memory.
+
+Each shape also gets a content hash (shape_hashes.txt); a route lists only the
+first shape of each distinct content, so shapes duplicated under several
+shape_ids are stored per route once and can be shared between routes by hash.
+
+For feeds whose shapes.txt is too large to copy into columns (the full NSW
+feed), the 'byte_index' shape layout instead records the byte range of each
+shape_id in the shapes file itself (which must be grouped by shape_id). The
+store then memory-maps the raw file and parses only the requested range. The
+build still parses every shape once to write the significance column (with a
+point offsets column), so simplifying is the same threshold filter as for
+'columns' and Douglas-Peucker never runs on the request path.
+
+Nothing the store holds is a per-item Python object: numeric columns are
+memoryviews over mapped files and string tables are StringTables over mapped
+files, so a store opened before gunicorn forks its workers stays in shared
+pages (reading an item creates a new object instead of touching a shared one).
+
+Build from the command line with:  python gtfs_store.py [gtfs_dir]
+"""
+import os
+import re
+import csv
+import json
+import mmap
+import shutil
+import hashlib
+import traceback
+from datetime import datetime, timedelta
+from array import array
+
+from shape_simplify import douglas_peucker_significance, kept_indexes
+
+STORE_FORMAT = 7
+SHAPE_LAYOUTS = ('columns', 'byte_index')
+DEFAULT_STORE_DIRNAME = '.compiled'
+_NO_SHAPE = 0xFFFFFFFF  # trip_shape value for trips without a shape_id
+
+
+class _UngroupedShapesError(Exception):
+    """Raised when shapes.txt is not grouped by shape_id (triggers the slow path)."""
+
+
+class _UngroupedStopTimesError(Exception):
+    """Raised when stop_times.txt is not grouped by trip_id (triggers the slow path)."""
+
+
+def _source_stats(paths):
+    stats = {}
+    for name, path in paths.items():
+        st = os.stat(path)
+        stats[name] = {"file": os.path.basename(path), "path": os.path.abspath(path),
+                       "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    return stats
+
+
+def source_signature(gtfs_dir, source_files):
+    """
+    (name, size, mtime_ns) of each source file, (name, None, None) for a missing
+    one: cheap to take, and changes whenever a file is replaced.
+    """
+    signature = []
+    for name in sorted(source_files):
+        try:
+            st = os.stat(os.path.join(gtfs_dir, source_files[name]))
+        except FileNotFoundError:
+            signature.append((name, None, None))
+            continue
+        signature.append((name, st.st_size, st.st_mtime_ns))
+    return tuple(signature)
+
+
+def _dataset_version(paths, shape_layout):
+    """Content hash of the source files (and store format); identifies a dataset across machines."""
+    digest = hashlib.sha1(f"format {STORE_FORMAT} {shape_layout}".encode('utf-8'))
+    for name in sorted(paths):
+        digest.update(name.encode('utf-8'))
+        with open(paths[name], 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def _content_hash(*parts):
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(part)
+    return digest.hexdigest()[:16]
+
+
+def _parse_gtfs_date(value):
+    return datetime.strptime(value.strip(), '%Y%m%d').date()
+
+
+def _compile_calendar(paths, service_index):
+    """
+    Expands calendar.txt and calendar_dates.txt into per-service day bitsets for
+    the services in service_index. Returns (first date or None, day count,
+    bytes per service row, bytearray of service_count rows).
+    """
+    weekly, exceptions = [], []
+    with open(paths["calendar"], 'r', encoding='utf-8-sig', newline='') as f_calendar:
+        reader = csv.DictReader(f_calendar)
+        for row in reader:
+            s_idx = service_index.get(row.get('service_id'))
+            if s_idx is None:
+                continue
+            try:
+                weekdays = [row[day] == '1' for day in ('monday', 'tuesday', 'wednesday', 'thursday',
+                                                        'friday', 'saturday', 'sunday')]
+                weekly.append((s_idx, weekdays, _parse_gtfs_date(row['start_date']),
+                               _parse_gtfs_date(row['end_date'])))
+            except (KeyError, ValueError):
+                continue
+    with open(paths["calendar_dates"], 'r', encoding='utf-8-sig', newline='') as f_dates:
+        reader = csv.DictReader(f_dates)
+        for row in reader:
+            s_idx = service_index.get(row.get('service_id'))
+            if s_idx is None:
+                continue
+            try:
+                exceptions.append((s_idx, _parse_gtfs_date(row['date']), row['exception_type'].strip() == '1'))
+            except (KeyError, ValueError):
+                continue
+
+    all_dates = [d for _, _, start, end in weekly for d in (start, end)] + [d for _, d, _ in exceptions]
+    if not all_dates:
+        return None, 0, 0, bytearray()
+    first = min(all_dates)
+    day_count = (max(all_dates) - first).days + 1
+    row_bytes = (day_count + 7) // 8
+    bits = bytearray(row_bytes * len(service_index))
+
+    for s_idx, weekdays, start, end in weekly:
+        base = s_idx * row_bytes
+        day = (start - first).days
+        current = start
+        while current <= end:
+            if weekdays[current.weekday()]:
+                bits[base + (day >> 3)] |= 1 << (day & 7)
+            current += timedelta(days=1)
+            day += 1
+    # Exceptions override the weekly pattern (1 = added, 2 = removed)
+    for s_idx, exception_date, added in exceptions:
+        day = (exception_date - first).days
+        position = s_idx * row_bytes + (day >> 3)
+        if added:
+            bits[position] |= 1 << (day & 7)
+        else:
+            bits[position] &= ~(1 << (day & 7)) & 0xFF
+    return first, day_count, row_bytes, bits
+
+
+def _column_index(header, name, path):
+    try:
+        return header.index(name)
+    except ValueError:
+        raise ValueError(f"Column '{name}' missing from {os.path.basename(path)}")
+
+
+def _write_lines(path, values):
+    with open(path, 'w', encoding='utf-8', newline='\n') as f:
+        f.write('\n'.join(values))
+
+
+class StringTable:
+    """
+    Read-only sequence over a mapped string table file (one UTF-8 value per line).
+    Holds only the mapping and one array of line ends; items are decoded on access.
+    The file is mapped at once (so it stays readable if it is deleted later), but
+    the line ends are only found on first use.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._size = os.fstat(f.fileno()).st_size
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self._size else b''
+        self._line_ends = None
+
+    @property
+    def _ends(self):
+        ends = self._line_ends
+        if ends is None:
+            ends = array('Q', (m.start() for m in re.finditer(b'\n', self._data)))
+            if self._size:
+                ends.append(self._size)
+            self._line_ends = ends
+        return ends
+
+    def __len__(self):
+        return len(self._ends)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self._ends)
+        end = self._ends[i]
+        start = self._ends[i - 1] + 1 if i > 0 else 0
+        return self._data[start:end].decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self._ends)):
+            yield self[i]
+
+
+def _write_array(path, values):
+    with open(path, 'wb') as f:
+        values.tofile(f)
+
+
+def _read_shape_points(shapes_path):
+    """
+    Reads shapes.txt, yielding (shape_id, (shape_pt_sequence, lat, lon)) per row in
+    file order. Rows that don't parse are skipped.
+    """
+    with open(shapes_path, 'r', encoding='utf-8-sig', newline='') as f_shapes:
+        reader = csv.reader(f_shapes)
+        header = next(reader, [])
+        i_id = _column_index(header, 'shape_id', shapes_path)
+        i_lat = _column_index(header, 'shape_pt_lat', shapes_path)
+        i_lon = _column_index(header, 'shape_pt_lon', shapes_path)
+        i_seq = _column_index(header, 'shape_pt_sequence', shapes_path)
+        for row in reader:
+            try:
+                yield row[i_id], (int(row[i_seq]), float(row[i_lat]), float(row[i_lon]))
+            except (ValueError, IndexError):
+                continue
+
+
+def _compile_shapes(shape_points, out_dir, grouped=True):
+    """
+    Assembles shapes from shape_points (as yielded by _read_shape_points) into
+    shape_lat.bin / shape_lon.bin / shape_significance.bin / shape_offsets.bin.
+    The fast path assumes rows are grouped by shape_id (as in the TfNSW feed) and
+    writes each shape as soon as it ends; otherwise all points are grouped in memory.
+    Returns (shape_ids in column order, content hashes, point counts).
+    """
+    shape_ids, shape_hashes = [], []
+    point_counts = array('I')
+    offsets = array('I', [0])
+    seen = set()
+    total = 0
+
+    with open(os.path.join(out_dir, 'shape_lat.bin'), 'wb') as f_lat, \
+         open(os.path.join(out_dir, 'shape_lon.bin'), 'wb') as f_lon, \
+         open(os.path.join(out_dir, 'shape_significance.bin'), 'wb') as f_sig:
+
+        def flush(shape_id, points):
+            nonlocal total
+            points.sort()
+            lats = array('d', (p[1] for p in points))
+            lngs = array('d', (p[2] for p in points))
+            f_lat.write(lats.tobytes())
+            f_lon.write(lngs.tobytes())
+            f_sig.write(douglas_peucker_significance(lats, lngs).tobytes())
+            total += len(points)
+            shape_ids.append(shape_id)
+            shape_hashes.append(_content_hash(lats.tobytes(), lngs.tobytes()))
+            point_counts.append(len(points))
+            offsets.append(total)
+
+        if grouped:
+            current_id, points = None, []
+            for shape_id, point in shape_points:
+                if shape_id != current_id:
+                    if current_id is not None:
+                        flush(current_id, points)
+                    if shape_id in seen:
+                        raise _UngroupedShapesError(shape_id)
+                    seen.add(shape_id)
+                    current_id, points = shape_id, []
+                points.append(point)
+            if current_id is not None:
+                flush(current_id, points)
+        else:
+            grouped_points = {}
+            for shape_id, point in shape_points:
+                grouped_points.setdefault(shape_id, []).append(point)
+            for shape_id, points in grouped_points.items():
+                flush(shape_id, points)
+
+    _write_array(os.path.join(out_dir, 'shape_offsets.bin'), offsets)
+    return shape_ids, shape_hashes, point_counts
+
+
+def _parse_gtfs_time(value):
+    """Seconds after the service day's start for 'H:MM:SS' (may exceed 24h), or -1 if blank."""
+    value = value.strip()
+    if not value:
+        return -1
+    hours, minutes, seconds = value.split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def _compile_stop_times(stop_times_path, trip_index, out_dir, grouped=True):
+    """
+    Streams stop_times.txt into stop_time_arrival.bin ('i'), stop_time_stop.bin and
+    stop_time_sequence.bin ('I'), sorted by stop_sequence within each trip, plus
+    trip_stop_ranges.bin ([start, end) per trip index, 'I' pairs). Rows of unknown
+    trips are skipped. Returns (stop_ids, row count).
+    """
+    stop_ids, stop_index = [], {}
+    trip_ranges = array('I', bytes(8 * len(trip_index)))
+    seen = set()
+    total = 0
+
+    with open(stop_times_path, 'r', encoding='utf-8-sig', newline='') as f_stop_times, \
+         open(os.path.join(out_dir, 'stop_time_arrival.bin'), 'wb') as f_arrival, \
+         open(os.path.join(out_dir, 'stop_time_stop.bin'), 'wb') as f_stop, \
+         open(os.path.join(out_dir, 'stop_time_sequence.bin'), 'wb') as f_sequence:
+        reader = csv.reader(f_stop_times)
+        header = next(reader, [])
+        i_trip = _column_index(header, 'trip_id', stop_times_path)
+        i_arrival = _column_index(header, 'arrival_time', stop_times_path)
+        i_departure = _column_index(header, 'departure_time', stop_times_path)
+        i_stop = _column_index(header, 'stop_id', stop_times_path)
+        i_seq = _column_index(header, 'stop_sequence', stop_times_path)
+
+        def parse(row):
+            arrival = _parse_gtfs_time(row[i_arrival])
+            if arrival < 0:
+                arrival = _parse_gtfs_time(row[i_departure])
+            stop_id = row[i_stop]
+            if stop_id not in stop_index:
+                stop_index[stop_id] = len(stop_ids)
+                stop_ids.append(stop_id)
+            return (int(row[i_seq]), arrival, stop_index[stop_id])
+
+        def flush(t_idx, rows):
+            nonlocal total
+            rows.sort()
+            array('I', (r[0] for r in rows)).tofile(f_sequence)
+            array('i', (r[1] for r in rows)).tofile(f_arrival)
+            array('I', (r[2] for r in rows)).tofile(f_stop)
+            trip_ranges[2 * t_idx], trip_ranges[2 * t_idx + 1] = total, total + len(rows)
+            total += len(rows)
+
+        if grouped:
+            current_id, current_idx, rows = None, None, []
+            for row in reader:
+                try:
+                    trip_id = row[i_trip]
+                    if trip_id != current_id:
+                        if current_idx is not None:
+                            flush(current_idx, rows)
+                        if trip_id in seen:
+                            raise _UngroupedStopTimesError(trip_id)
+                        seen.add(trip_id)
+                        current_id, current_idx, rows = trip_id, trip_index.get(trip_id), []
+                    if current_idx is not None:
+                        rows.append(parse(row))
+                except (ValueError, IndexError):
+                    continue
+            if current_idx is not None:
+                flush(current_idx, rows)
+        else:
+            grouped_rows = {}
+            for row in reader:
+                try:
+                    t_idx = trip_index.get(row[i_trip])
+                    if t_idx is not None:
+                        grouped_rows.setdefault(t_idx, []).append(parse(row))
+                except (ValueError, IndexError):
+                    continue
+            for t_idx, rows in grouped_rows.items():
+                flush(t_idx, rows)
+
+    _write_array(os.path.join(out_dir, 'trip_stop_ranges.bin'), trip_ranges)
+    return stop_ids, total
+
+
+def _write_sorted_trip_ids(trip_ids, out_dir):
+    """trip_id_blob.bin / trip_id_offsets.bin ('Q') in trip order, trip_id_sorted.bin ('I') by id."""
+    encoded = [trip_id.encode('utf-8') for trip_id in trip_ids]
+    offsets = array('Q', [0])
+    for value in encoded:
+        offsets.append(offsets[-1] + len(value))
+    with open(os.path.join(out_dir, 'trip_id_blob.bin'), 'wb') as f:
+        f.write(b''.join(encoded))
+    _write_array(os.path.join(out_dir, 'trip_id_offsets.bin'), offsets)
+    _write_array(os.path.join(out_dir, 'trip_id_sorted.bin'),
+                 array('I', sorted(range(len(encoded)), key=encoded.__getitem__)))
+
+
+def _compile_columns(shapes_path, out_dir):
+    try:
+        return _compile_shapes(_read_shape_points(shapes_path), out_dir, grouped=True)
+    except _UngroupedShapesError as e:
+        print(f"shapes file is not grouped by shape_id (saw '{e}' twice); grouping in memory.")
+        return _compile_shapes(_read_shape_points(shapes_path), out_dir, grouped=False)
+
+
+def _shape_point_columns(header, shapes_path):
+    """(shape_pt_sequence, shape_pt_lat, shape_pt_lon) column indexes in a shapes.txt header."""
+    return (_column_index(header, 'shape_pt_sequence', shapes_path),
+            _column_index(header, 'shape_pt_lat', shapes_path),
+            _column_index(header, 'shape_pt_lon', shapes_path))
+
+
+def _parse_shape_rows(data, columns):
+    """Parses shapes.txt rows (bytes) into (lat, lon) float64 arrays in shape_pt_sequence order."""
+    i_seq, i_lat, i_lon = columns
+    points = []
+    for row in csv.reader(data.decode('utf-8').splitlines()):
+        try:
+            points.append((int(row[i_seq]), float(row[i_lat]), float(row[i_lon])))
+        except (ValueError, IndexError):
+            continue
+    points.sort()
+    return array('d', (p[1] for p in points)), array('d', (p[2] for p in points))
+
+
+def _index_shapes(shapes_path, out_dir):
+    """
+    One pass over shapes.txt recording the [start, end) byte range of each shape_id
+    in shape_byte_ranges.bin (uint64 pairs). Rows of a shape must be contiguous.
+    The content hash covers each row without its shape_id, in file order. Each
+    shape's rows are also parsed as the store will parse them, to write
+    shape_significance.bin and shape_offsets.bin for its points in that order.
+    Returns (shape_ids in file order, content hashes, point counts).
+    """
+    shape_ids, shape_hashes = [], []
+    point_counts = array('I')
+    ranges = array('Q')
+    offsets = array('I', [0])
+    seen = set()
+    with open(shapes_path, 'rb') as f_shapes, \
+         open(os.path.join(out_dir, 'shape_significance.bin'), 'wb') as f_sig:
+        header_line = f_shapes.readline()
+        header = next(csv.reader([header_line.decode('utf-8-sig')]), [])
+        i_id = _column_index(header, 'shape_id', shapes_path)
+        columns = _shape_point_columns(header, shapes_path)
+        position = len(header_line)
+        current_id, start, digest, lines = None, position, None, []
+
+        def flush(end):
+            lats, lngs = _parse_shape_rows(b''.join(lines), columns)
+            f_sig.write(douglas_peucker_significance(lats, lngs).tobytes())
+            shape_ids.append(current_id)
+            shape_hashes.append(digest.hexdigest()[:16])
+            point_counts.append(len(lats))
+            offsets.append(offsets[-1] + len(lats))
+            ranges.extend((start, end))
+
+        for line in f_shapes:
+            fields = line.split(b',', i_id + 1)
+            if len(fields) > i_id and line.strip():
+                shape_id = fields[i_id].strip().strip(b'"').decode('utf-8')
+                if shape_id != current_id:
+                    if current_id is not None:
+                        flush(position)
+                    if shape_id in seen:
+                        raise ValueError(f"{os.path.basename(shapes_path)} is not grouped by shape_id "
+                                         f"(saw '{shape_id}' twice); sort it by shape_id to use the "
+                                         f"byte_index shape layout.")
+                    seen.add(shape_id)
+                    current_id, start, digest, lines = shape_id, position, hashlib.sha1(), []
+                digest.update(b','.join(fields[:i_id] + fields[i_id + 1:]).rstrip(b'\r\n'))
+                digest.update(b'\n')
+            if current_id is not None:
+                lines.append(line)
+            position += len(line)
+        if current_id is not None:
+            flush(position)
+
+    _write_array(os.path.join(out_dir, 'shape_byte_ranges.bin'), ranges)
+    _write_array(os.path.join(out_dir, 'shape_offsets.bin'), offsets)
+    return shape_ids, shape_hashes, point_counts
+
+
+def compile_gtfs(gtfs_dir, store_root, source_files, shape_layout='columns'):
+    """
+    Compiles the GTFS files named in source_files ({"agency", "routes", "trips",
+    "shapes"} -> file name in gtfs_dir) into a new version directory under
+    store_root and points CURRENT at it. shape_layout is one of SHAPE_LAYOUTS.
+    Returns the version string.
+    """
+    if shape_layout not in SHAPE_LAYOUTS:
+        raise ValueError(f"Unknown shape layout '{shape_layout}' (expected one of {', '.join(SHAPE_LAYOUTS)})")
+    paths = {name: os.path.join(gtfs_dir, file_name) for name, file_name in source_files.items()}
+    for path in paths.values():
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"GTFS source file not found: {path}")
+
+    version = _dataset_version(paths, shape_layout)
+    os.makedirs(store_root, exist_ok=True)
+    final_dir = os.path.join(store_root, version)
+    if not os.path.exists(os.path.join(final_dir, 'meta.json')):
+        print(f"Compiling GTFS store version {version} from {gtfs_dir}...")
+        tmp_dir = f"{final_dir}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        try:
+            _compile_into(paths, tmp_dir, version, shape_layout)
+            try:
+                os.rename(tmp_dir, final_dir)
+            except OSError:
+                # Another process finished the same version first; keep theirs.
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+    current_tmp = os.path.join(store_root, f'CURRENT.tmp-{os.getpid()}')
+    with open(current_tmp, 'w') as f:
+        f.write(version)
+    os.replace(current_tmp, os.path.join(store_root, 'CURRENT'))
+    return version
+
+
+def _dedup_route_shapes(route_count, shape_hashes, shape_point_counts, trip_route, trip_shape, trip_service,
+                        service_days, row_bytes):
+    """
+    Lists each route's shapes once per distinct content, each with the days any
+    of its trips run. Returns (route_shape_offsets, route_shape_idx,
+    route_shape_days, number of distinct shape contents).
+    """
+    # Routes reference the first shape with each content; shapes under 2 points aren't drawable
+    first_with_hash = {}
+    route_shape_for = [first_with_hash.setdefault(h, i) if shape_point_counts[i] >= 2 else _NO_SHAPE
+                       for i, h in enumerate(shape_hashes)]
+    route_shape_services = [{} for _ in range(route_count)]  # route -> {shape: set of service indexes}
+    for r_idx, s_idx, service in zip(trip_route, trip_shape, trip_service):
+        if s_idx != _NO_SHAPE and route_shape_for[s_idx] != _NO_SHAPE:
+            route_shape_services[r_idx].setdefault(route_shape_for[s_idx], set()).add(service)
+
+    route_shape_offsets, route_shape_idx = array('I', [0]), array('I')
+    route_shape_days = bytearray()
+    for shape_services in route_shape_services:
+        for shape in sorted(shape_services):
+            route_shape_idx.append(shape)
+            days = 0
+            for service in shape_services[shape]:
+                days |= int.from_bytes(service_days[service * row_bytes:(service + 1) * row_bytes], 'little')
+            route_shape_days += days.to_bytes(row_bytes, 'little')
+        route_shape_offsets.append(len(route_shape_idx))
+    return route_shape_offsets, route_shape_idx, route_shape_days, len(first_with_hash)
+
+
+def _compile_into(paths, out_dir, version, shape_layout):
+    # --- agencies ---
+    agency_ids, agency_names = [], []
+    with open(paths["agency"], 'r', encoding='utf-8-sig', newline='') as f_agency:
+        reader = csv.reader(f_agency)
+        header = next(reader, [])
+        i_id = _column_index(header, 'agency_id', paths["agency"])
+        i_name = _column_index(header, 'agency_name', paths["agency"])
+        for row in reader:
+            if len(row) <= max(i_id, i_name) or not row[i_id]:
+                continue
+            agency_ids.append(row[i_id])
+            agency_names.append(row[i_name])
+
+    # --- routes ---
+    route_ids, route_agency, route_short, route_long = [], [], [], []
+    with open(paths["routes"], 'r', encoding='utf-8-sig', newline='') as f_routes:
+        reader = csv.reader(f_routes)
+        header = next(reader, [])
+        i_id = _column_index(header, 'route_id', paths["routes"])
+        i_agency = _column_index(header, 'agency_id', paths["routes"])
+        i_short = _column_index(header, 'route_short_name', paths["routes"])
+        i_long = header.index('route_long_name') if 'route_long_name' in header else None
+        for row in reader:
+            if len(row) <= max(i_id, i_agency, i_short) or not row[i_id]:
+                continue
+            route_ids.append(row[i_id])
+            route_agency.append(row[i_agency])
+            route_short.append(row[i_short])
+            route_long.append(row[i_long] if i_long is not None and i_long < len(row) else '')
+    route_index = {rid: i for i, rid in enumerate(route_ids)}
+
+    # --- shapes ---
+    if shape_layout == 'byte_index':
+        shape_ids, shape_hashes, shape_point_counts = _index_shapes(paths["shapes"], out_dir)
+    else:
+        shape_ids, shape_hashes, shape_point_counts = _compile_columns(paths["shapes"], out_dir)
+    point_count = sum(shape_point_counts)
+    shape_index = {sid: i for i, sid in enumerate(shape_ids)}
+
+    # --- trips ---
+    trip_ids, service_ids = [], []
+    service_index = {}
+    trip_route, trip_shape, trip_service = array('I'), array('I'), array('I')
+    with open(paths["trips"], 'r', encoding='utf-8-sig', newline='') as f_trips:
+        reader = csv.reader(f_trips)
+        header = next(reader, [])
+        i_route = _column_index(header, 'route_id', paths["trips"])
+        i_trip = _column_index(header, 'trip_id', paths["trips"])
+        i_service = _column_index(header, 'service_id', paths["trips"])
+        i_shape = header.index('shape_id') if 'shape_id' in header else None
+        for row in reader:
+            try:
+                r_idx = route_index[row[i_route]]
+            except (KeyError, IndexError):
+                continue
+            s_idx = shape_index.get(row[i_shape], _NO_SHAPE) if i_shape is not None else _NO_SHAPE
+            service_id = row[i_service]
+            if service_id not in service_index:
+                service_index[service_id] = len(service_ids)
+                service_ids.append(service_id)
+            trip_ids.append(row[i_trip])
+            trip_route.append(r_idx)
+            trip_shape.append(s_idx)
+            trip_service.append(service_index[service_id])
+
+    # --- calendar ---
+    calendar_start, calendar_days, row_bytes, service_days = _compile_calendar(paths, service_index)
+
+    # --- stop times (optional) ---
+    stop_ids, stop_time_count = [], None
+    if "stop_times" in paths:
+        trip_index = {trip_id: i for i, trip_id in enumerate(trip_ids)}
+        try:
+            stop_ids, stop_time_count = _compile_stop_times(paths["stop_times"], trip_index, out_dir)
+        except _UngroupedStopTimesError as e:
+            print(f"stop_times file is not grouped by trip_id (saw '{e}' twice); grouping in memory.")
+            stop_ids, stop_time_count = _compile_stop_times(paths["stop_times"], trip_index, out_dir,
+                                                            grouped=False)
+        del trip_index
+        _write_lines(os.path.join(out_dir, 'stop_ids.txt'), stop_ids)
+    _write_sorted_trip_ids(trip_ids, out_dir)
+
+    route_shape_offsets, route_shape_idx, route_shape_days, distinct_shapes = _dedup_route_shapes(
+        len(route_ids), shape_hashes, shape_point_counts, trip_route, trip_shape, trip_service,
+        service_days, row_bytes)
+
+    _write_lines(os.path.join(out_dir, 'agency_ids.txt'), agency_ids)
+    _write_lines(os.path.join(out_dir, 'agency_names.txt'), agency_names)
+    _write_lines(os.path.join(out_dir, 'route_ids.txt'), route_ids)
+    _write_lines(os.path.join(out_dir, 'route_agency.txt'), route_agency)
+    _write_lines(os.path.join(out_dir, 'route_short_name.txt'), route_short)
+    _write_lines(os.path.join(out_dir, 'route_long_name.txt'), route_long)
+    _write_lines(os.path.join(out_dir, 'shape_ids.txt'), shape_ids)
+    _write_lines(os.path.join(out_dir, 'shape_hashes.txt'), shape_hashes)
+    _write_lines(os.path.join(out_dir, 'trip_ids.txt'), trip_ids)
+    _write_lines(os.path.join(out_dir, 'service_ids.txt'), service_ids)
+    _write_array(os.path.join(out_dir, 'trip_route.bin'), trip_route)
+    _write_array(os.path.join(out_dir, 'trip_shape.bin'), trip_shape)
+    _write_array(os.path.join(out_dir, 'trip_service.bin'), trip_service)
+    _write_array(os.path.join(out_dir, 'route_shape_offsets.bin'), route_shape_offsets)
+    _write_array(os.path.join(out_dir, 'route_shape_idx.bin'), route_shape_idx)
+    with open(os.path.join(out_dir, 'service_days.bin'), 'wb') as f:
+        f.write(service_days)
+    with open(os.path.join(out_dir, 'route_shape_days.bin'), 'wb') as f:
+        f.write(route_shape_days)
+
+    meta = {
+        "format": STORE_FORMAT,
+        "version": version,
+        "shape_layout": shape_layout,
+        "calendar": {
+            "start_date": calendar_start.strftime('%Y%m%d') if calendar_start else None,
+            "days": calendar_days,
+        },
+        "sources": _source_stats(paths),
+        "counts": {
+            "agencies": len(agency_ids),
+            "routes": len(route_ids),
+            "trips": len(trip_ids),
+            "shapes": len(shape_ids),
+            "distinct_shapes": distinct_shapes,
+            "shape_points": point_count,
+            "services": len(service_ids),
+            "stops": len(stop_ids),
+            "stop_times": stop_time_count,
+        },
+    }
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    print(f"Compiled {len(route_ids)} routes, {len(trip_ids)} trips, {len(shape_ids)} shapes "
+          f"({point_count} points).")
+
+
+class GtfsStore:
+    """
+    Read-only view over a compiled store directory. Numeric columns are memory-mapped
+    and exposed as typed memoryviews; string tables are mapped StringTables.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        if self.meta.get("format") != STORE_FORMAT:
+            raise ValueError(f"Unsupported GTFS store format {self.meta.get('format')} in {path}")
+        self.version = self.meta["version"]
+        self._mmaps = []
+
+        self.agency_ids = self._strings('agency_ids.txt')
+        self.agency_names = self._strings('agency_names.txt')
+        self.route_ids = self._strings('route_ids.txt')
+        self.route_agency = self._strings('route_agency.txt')
+        self.route_short_name = self._strings('route_short_name.txt')
+        self.route_long_name = self._strings('route_long_name.txt')
+        self.shape_ids = self._strings('shape_ids.txt')
+        self.shape_hashes = self._strings('shape_hashes.txt')
+
+        self.shape_layout = self.meta.get("shape_layout", 'columns')
+        self.shape_point_count = self.meta["counts"]["shape_points"]
+        self.shape_significance = self._map('shape_significance.bin', 'f')
+        self.shape_offsets = self._map('shape_offsets.bin', 'I')
+        if self.shape_layout == 'byte_index':
+            self.shape_byte_ranges = self._map('shape_byte_ranges.bin', 'Q')
+            self._open_shapes_source(self.meta["sources"]["shapes"]["path"])
+        else:
+            self.shape_lat = self._map('shape_lat.bin', 'd')
+            self.shape_lon = self._map('shape_lon.bin', 'd')
+        self.trip_route = self._map('trip_route.bin', 'I')
+        self.trip_shape = self._map('trip_shape.bin', 'I')
+        self.trip_service = self._map('trip_service.bin', 'I')
+        self.route_shape_offsets = self._map('route_shape_offsets.bin', 'I')
+        self.route_shape_idx = self._map('route_shape_idx.bin', 'I')
+
+        calendar = self.meta["calendar"]
+        self.calendar_days = calendar["days"]
+        self.calendar_start = _parse_gtfs_date(calendar["start_date"]) if calendar["start_date"] else None
+        self._day_row_bytes = (self.calendar_days + 7) // 8
+        self.service_days = self._map('service_days.bin', 'B')
+        self.route_shape_days = self._map('route_shape_days.bin', 'B')
+
+        self.trip_id_blob = self._map('trip_id_blob.bin', 'B')
+        self.trip_id_offsets = self._map('trip_id_offsets.bin', 'Q')
+        self.trip_id_sorted = self._map('trip_id_sorted.bin', 'I')
+        self.has_stop_times = self.meta["counts"]["stop_times"] is not None
+        if self.has_stop_times:
+            self.trip_stop_ranges = self._map('trip_stop_ranges.bin', 'I')
+            self.stop_time_arrival = self._map('stop_time_arrival.bin', 'i')
+            self.stop_time_stop = self._map('stop_time_stop.bin', 'I')
+            self.stop_time_sequence = self._map('stop_time_sequence.bin', 'I')
+        # Every file is opened here, so a version pruned after a reload (see
+        # prune_versions) stays readable by processes still using it. The full feed
+        # has hundreds of thousands of trips; these tables only find their line
+        # ends when a feature first reads them.
+        self.trip_ids = self._strings('trip_ids.txt')
+        self.service_ids = self._strings('service_ids.txt')
+        self.stop_ids = self._strings('stop_ids.txt') if self.has_stop_times else []
+
+
+    @property
+    def source_signature(self):
+        """source_signature() of the files this store was compiled from, as they were then."""
+        return tuple((name, source["size"], source["mtime_ns"])
+                     for name, source in sorted(self.meta["sources"].items()))
+
+    def _strings(self, filename):
+        return StringTable(os.path.join(self.path, filename))
+
+    def _map(self, filename, typecode):
+        with open(os.path.join(self.path, filename), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(array(typecode))
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mmaps.append(mm)
+        return memoryview(mm).cast(typecode)
+
+    def _open_shapes_source(self, shapes_path):
+        """Maps the raw shapes file for the byte_index layout and locates its columns."""
+        with open(shapes_path, 'rb') as f:
+            header = next(csv.reader([f.readline().decode('utf-8-sig')]), [])
+            self._shapes_source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mmaps.append(self._shapes_source)
+        self._shape_columns = _shape_point_columns(header, shapes_path)
+
+    def _read_shape_range(self, shape_idx):
+        """Parses one shape's rows from the raw shapes file into (lat, lon) float64 arrays."""
+        start, end = self.shape_byte_ranges[2 * shape_idx], self.shape_byte_ranges[2 * shape_idx + 1]
+        return _parse_shape_rows(self._shapes_source[start:end], self._shape_columns)
+
+    def covers_date(self, service_date):
+        """True if service_date falls within the dataset's calendar."""
+        return self._day_number(service_date) is not None
+
+    def _day_number(self, service_date):
+        if self.calendar_start is None:
+            return None
+        day = (service_date - self.calendar_start).days
+        return day if 0 <= day < self.calendar_days else None
+
+    def _day_bit_set(self, days_column, row, day):
+        return days_column[row * self._day_row_bytes + (day >> 3)] & (1 << (day & 7)) != 0
+
+    def service_active(self, service_idx, service_date):
+        """True if the service runs on service_date (a datetime.date)."""
+        day = self._day_number(service_date)
+        return day is not None and self._day_bit_set(self.service_days, service_idx, day)
+
+    def trip_active(self, trip_idx, service_date):
+        return self.service_active(self.trip_service[trip_idx], service_date)
+
+    def trip_index(self, trip_id):
+        """Trip index for a trip_id (binary search over the sorted id blob), or None."""
+        key = trip_id.encode('utf-8')
+        order, offsets, blob = self.trip_id_sorted, self.trip_id_offsets, self.trip_id_blob
+        low, high = 0, len(order)
+        while low < high:
+            middle = (low + high) // 2
+            t_idx = order[middle]
+            if blob[offsets[t_idx]:offsets[t_idx + 1]].tobytes() < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(order):
+            t_idx = order[low]
+            if blob[offsets[t_idx]:offsets[t_idx + 1]].tobytes() == key:
+                return t_idx
+        return None
+
+    def stop_time_range(self, trip_idx):
+        """[start, end) rows of the trip in the stop_time_* columns (empty without stop_times)."""
+        if not self.has_stop_times:
+            return 0, 0
+        return self.trip_stop_ranges[2 * trip_idx], self.trip_stop_ranges[2 * trip_idx + 1]
+
+    def shape_indexes_for_route(self, route_idx, service_date=None):
+        """
+        Shape indexes used by trips of the given static route index: one per distinct
+        content (see shape_hashes), only shapes with at least two points. With
+        service_date, only shapes used by a trip running on that date.
+        """
+        start, end = self.route_shape_offsets[route_idx], self.route_shape_offsets[route_idx + 1]
+        if service_date is None:
+            return self.route_shape_idx[start:end]
+        day = self._day_number(service_date)
+        if day is None:
+            return []
+        return [self.route_shape_idx[pair] for pair in range(start, end)
+                if self._day_bit_set(self.route_shape_days, pair, day)]
+
+    def shape_points(self, shape_idx):
+        """(lat, lon) float64 memoryview slices (arrays for byte_index) for a shape, in shape_pt_sequence order."""
+        if self.shape_layout == 'byte_index':
+            return self._read_shape_range(shape_idx)
+        start, end = self.shape_offsets[shape_idx], self.shape_offsets[shape_idx + 1]
+        return self.shape_lat[start:end], self.shape_lon[start:end]
+
+    def simplified_shape_points(self, shape_idx, tolerance):
+        """
+        (lat, lon) lists for a shape simplified to tolerance degrees, or the full
+        memoryview slices when tolerance is None.
+        """
+        if tolerance is None:
+            return self.shape_points(shape_idx)
+        start, end = self.shape_offsets[shape_idx], self.shape_offsets[shape_idx + 1]
+        if self.shape_layout == 'byte_index':
+            lats, lngs = self._read_shape_range(shape_idx)
+            keep = kept_indexes(self.shape_significance[start:end], 0, len(lats), tolerance)
+            return [lats[i] for i in keep], [lngs[i] for i in keep]
+        keep = kept_indexes(self.shape_significance, start, end, tolerance)
+        return [self.shape_lat[i] for i in keep], [self.shape_lon[i] for i in keep]
+
+
+def _store_is_current(version_dir, gtfs_dir, source_files, shape_layout):
+    meta_path = os.path.join(version_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    if meta.get("format") != STORE_FORMAT or meta.get("shape_layout") != shape_layout:
+        return False
+    for name, file_name in source_files.items():
+        recorded = meta.get("sources", {}).get(name)
+        path = os.path.join(gtfs_dir, file_name)
+        if not recorded or recorded.get("file") != file_name or not os.path.exists(path):
+            return False
+        st = os.stat(path)
+        if st.st_size != recorded["size"] or st.st_mtime_ns != recorded["mtime_ns"]:
+            return False
+    return True
+
+
+def _current_version_dir(store_root):
+    """The version directory CURRENT names, or None if nothing has been compiled."""
+    current_path = os.path.join(store_root, 'CURRENT')
+    if not os.path.exists(current_path):
+        return None
+    with open(current_path, 'r') as f:
+        return os.path.join(store_root, f.read().strip())
+
+
+def is_current(gtfs_dir, store_root, source_files, shape_layout='columns'):
+    """True if CURRENT names a store compiled from the source files as they are now."""
+    version_dir = _current_version_dir(store_root)
+    return version_dir is not None and _store_is_current(version_dir, gtfs_dir, source_files, shape_layout)
+
+
+def _open_store(version_dir):
+    store = GtfsStore(version_dir)
+    print(f"GTFS store {store.version} mapped: {len(store.route_ids)} routes, "
+          f"{len(store.shape_ids)} shapes, {store.shape_point_count} shape points ({store.shape_layout}).")
+    return store
+
+
+def load_or_build(gtfs_dir, store_root, source_files, shape_layout='columns'):
+    """
+    Opens the current compiled store, (re)building it first if it is missing or
+    its source files (see compile_gtfs) have changed. Returns a GtfsStore, or None on failure.
+    """
+    try:
+        version_dir = _current_version_dir(store_root)
+        if version_dir is None or not _store_is_current(version_dir, gtfs_dir, source_files, shape_layout):
+            version = compile_gtfs(gtfs_dir, store_root, source_files, shape_layout)
+            version_dir = os.path.join(store_root, version)
+        return _open_store(version_dir)
+    except Exception as e:
+        print(f"ERROR (gtfs_store): Could not load or build GTFS store: {e}")
+        traceback.print_exc()
+        return None
+
+
+def open_current(store_root):
+    """Opens the store CURRENT names, without checking its sources. Returns a GtfsStore, or None on failure."""
+    try:
+        version_dir = _current_version_dir(store_root)
+        if version_dir is None:
+            raise FileNotFoundError(f"no compiled GTFS store in {store_root}")
+        return _open_store(version_dir)
+    except Exception as e:
+        print(f"ERROR (gtfs_store): Could not open GTFS store: {e}")
+        traceback.print_exc()
+        return None
+
+
+def prune_versions(store_root, keep):
+    """
+    Deletes the version directories under store_root other than those in keep
+    (and builds in progress). A GtfsStore opens all of its files when it is
+    created, so processes still using a deleted version keep reading it; the
+    space is freed once they let go of it.
+    """
+    for name in os.listdir(store_root):
+        path = os.path.join(store_root, name)
+        if name in keep or '.tmp-' in name or not os.path.isdir(path):
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        print(f"Removed old GTFS store version {name}.")
+
+
+if __name__ == '__main__':
+    # 'python gtfs_store.py [gtfs_dir]' builds the store as an explicit step. gtfs_reloader.py
+    # also runs it, with every option given, to compile a new dataset outside the serving process.
+    import argparse
+    parser = argparse.ArgumentParser(description="Compile GTFS text files into the memory-mapped store.")
+    parser.add_argument('gtfs_dir', nargs='?', default='gtfs_static')
+    parser.add_argument('--store-root', help=f"where to put the store (default <gtfs_dir>/{DEFAULT_STORE_DIRNAME})")
+    parser.add_argument('--shape-layout', choices=SHAPE_LAYOUTS, help="default: the app's")
+    parser.add_argument('--source-files', help="JSON object of source name -> file name (default: the app's)")
+    args = parser.parse_args()
+    if args.shape_layout is None or args.source_files is None:
+        from application import GTFS_SOURCE_FILES, GTFS_SHAPES_LAYOUT
+    source_files = json.loads(args.source_files) if args.source_files else GTFS_SOURCE_FILES
+    shape_layout = args.shape_layout or GTFS_SHAPES_LAYOUT
+    store_root = args.store_root or os.path.join(args.gtfs_dir, DEFAULT_STORE_DIRNAME)
+    built = compile_gtfs(args.gtfs_dir, store_root, source_files, shape_layout)
+    print(f"GTFS store version {built} is current.")
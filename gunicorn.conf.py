@@ -0,0 +1,52 @@
+# gunicorn.conf.py
+"""
+Gunicorn settings (loaded automatically from the working directory, and named
+in the Procfile).
+
+The default worker class is gthread: each worker serves GUNICORN_THREADS
+requests at once, so long-lived /api/bus_stream connections and slow clients
+only hold a thread, not the whole worker. For thousands of concurrent
+connections per worker use the cooperative gevent worker instead:
+
+    pip install ".[async]"
+    GUNICORN_WORKER_CLASS=gevent gunicorn app:app
+
+No request handler waits on the TfNSW feed (the poller thread fetches it; see
+feed_poller.py and upstream.py), so either class keeps serving while upstream
+is slow. concurrency_benchmark.py measures how many clients one worker holds.
+
+With GUNICORN_PRELOAD (on by default, except for gevent, which must patch the
+standard library before the app imports it) the master loads the app once and
+the workers fork from it: the mapped GTFS store, the route catalogue and the
+imported modules are then shared copy-on-write instead of built per worker.
+The master forks without any threads running; each worker starts its own feed
+poller and metrics flusher in post_worker_init, and logs its memory.
+"""
+import gc
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+# gunicorn turns sync workers with more than one thread into gthread ones
+threads = int(os.getenv("GUNICORN_THREADS", "32")) if worker_class == "gthread" else 1
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))  # gevent only
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = 10
+preload_app = os.getenv("GUNICORN_PRELOAD", "0" if worker_class == "gevent" else "1") == "1"
+if preload_app:
+    os.environ["BUSMAP_PRELOAD"] = "1"  # read by application.initialize_app_data
+
+
+def pre_fork(server, worker):
+    # Move everything the master built into the permanent generation, so the
+    # workers' garbage collections don't write to (and so un-share) its pages
+    gc.freeze()
+
+
+def post_worker_init(worker):
+    import application
+    if preload_app:
+        application.start_background_tasks()
+    print(application.memory_report(f"Worker {worker.age} ready"))
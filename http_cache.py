@@ -0,0 +1,97 @@
+# http_cache.py
+"""
+Conditional GET and precompressed bodies for responses that only change when
+the GTFS static dataset does (/api/agencies, /api/routes_by_agency,
+/api/route_shapes).
+
+A view wrapped with dataset_cached() gets an ETag derived from the dataset
+version, the path and the query string. A request whose If-None-Match matches
+is answered with an empty 304 without calling the view. Otherwise the body is
+built once, compressed once per content coding (brotli when the optional
+'brotli' package is installed, gzip otherwise) and the result kept in a
+SizedLRUCache, so repeat requests are a cache lookup.
+"""
+import gzip
+import hashlib
+import functools
+
+from flask import request, make_response, Response
+
+try:
+    import brotli  # optional: pip install brotli (see pyproject's 'compression' extra)
+except ImportError:
+    brotli = None
+
+MIN_COMPRESS_BYTES = 512  # smaller bodies are sent as they are
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9  # 10-11 compress only slightly better and are many times slower
+_BYTES_PER_ENTRY = 200
+
+
+def _preferred_encoding():
+    """The content coding to send for this request: 'br', 'gzip' or None (identity)."""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br'] > 0:
+        return 'br'
+    if accepted['gzip'] > 0:
+        return 'gzip'
+    return None
+
+
+def _compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _representation_etag(base_etag, encoding):
+    return f"{base_etag}-{encoding}" if encoding else base_etag
+
+
+def dataset_cached(get_version, cache):
+    """
+    Decorator for GET views whose output depends only on the request's path and
+    query string and on the dataset identified by get_version(). Responses other
+    than 200, or any response while get_version() returns None, pass through
+    uncached.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            version = get_version()
+            if version is None:
+                return view(*args, **kwargs)
+
+            query = sorted(request.args.items(multi=True))
+            base_etag = hashlib.sha1(repr((version, request.path, query)).encode('utf-8')).hexdigest()[:20]
+            encoding = _preferred_encoding()
+            etag = _representation_etag(base_etag, encoding)
+            headers = {"Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304, headers=headers)
+                response.set_etag(etag)
+                return response
+
+            cached = cache.get((base_etag, encoding))
+            if cached is None:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                body = response.get_data()
+                sent_encoding = None
+                if encoding and len(body) >= MIN_COMPRESS_BYTES:
+                    compressed = _compress(body, encoding)
+                    if len(compressed) < len(body):
+                        body, sent_encoding = compressed, encoding
+                cached = (body, response.mimetype, sent_encoding)
+                cache.put((base_etag, encoding), cached, len(body) + _BYTES_PER_ENTRY)
+
+            body, mimetype, sent_encoding = cached
+            response = Response(body, mimetype=mimetype, headers=headers)
+            if sent_encoding:
+                response.headers["Content-Encoding"] = sent_encoding
+            response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,341 @@
+# metrics.py
+"""
+Counters, gauges and histograms in the Prometheus text format, for /metrics.
+
+Metrics are declared once at module level (see the definitions at the end of
+this file) and updated in place:
+
+    UPSTREAM_FETCH_SECONDS.observe(elapsed)
+    with FILTER_SECONDS.labels('bus_data').time():
+        ...
+    CACHE_HITS.labels('route_shapes').inc()
+
+Every process keeps its own values. With several gunicorn workers, set
+METRICS_DIR to a directory shared by them: each process then writes its values
+to <METRICS_DIR>/<pid>.json every METRICS_FLUSH_SECONDS, and whichever worker
+answers /metrics adds up the files of all live workers (gauges take the max or
+the sum, as declared). Without it /metrics only shows the answering process.
+"""
+import os
+import json
+import time
+import math
+import bisect
+import threading
+import contextlib
+
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "5"))
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(10))  # 1 KiB .. 256 MiB
+COUNT_BUCKETS = (0, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000)
+
+_metrics = []  # every metric, in declaration order
+_collectors = []  # callables run before each exposition, to copy in values kept elsewhere
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def labels(self, *values):
+        """The child series for these label values (one per label name, in order)."""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}")
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _default(self):
+        if self.labelnames:
+            raise ValueError(f"{self.name} needs labels {self.labelnames}")
+        return self.labels()
+
+    def _values(self):
+        """{label values tuple: state} for dumping to a file."""
+        return {key: child.state() for key, child in list(self._children.items())}
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def set_total(self, value):
+        """Sets a count kept elsewhere (e.g. a cache's own counters); for collectors."""
+        self.value = float(value)
+
+    def state(self):
+        return self.value
+
+
+class Counter(_Metric):
+    kind = 'counter'
+    _new_child = _CounterChild
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+
+class _GaugeChild(_CounterChild):
+    def set(self, value):
+        self.value = float(value)
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+    _new_child = _GaugeChild
+
+    def __init__(self, name, documentation, labelnames=(), aggregate='sum'):
+        super().__init__(name, documentation, labelnames)
+        self.aggregate = aggregate  # how values of several processes combine: 'sum' or 'max'
+
+    def set(self, value):
+        self._default().set(value)
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)  # first bucket with value <= bound
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @contextlib.contextmanager
+    def time(self):
+        """Observes the seconds the with-block takes."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def state(self):
+        with self._lock:
+            return [list(self.counts), self.sum]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+
+def add_collector(collect):
+    """Registers collect(), called before every exposition and flush."""
+    _collectors.append(collect)
+
+
+def _collect():
+    for collect in _collectors:
+        try:
+            collect()
+        except Exception as e:
+            print(f"Metrics collector error: {e}")
+
+
+def _snapshot():
+    """This process's values: {metric name: {label values tuple: state}}."""
+    _collect()
+    return {metric.name: metric._values() for metric in _metrics}
+
+
+# --- Sharing between worker processes (METRICS_DIR) ---
+
+_flusher_pid = None
+
+
+def ensure_flushing():
+    """Starts writing this process's values to METRICS_DIR (again, after a fork)."""
+    global _flusher_pid
+    if not METRICS_DIR or _flusher_pid == os.getpid():
+        return
+    _flusher_pid = os.getpid()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True).start()
+
+
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_SECONDS)
+        try:
+            _write_snapshot()
+        except Exception as e:
+            print(f"Metrics flush error: {e}")
+
+
+def _write_snapshot():
+    data = {name: [[list(key), state] for key, state in values.items()] for name, values in _snapshot().items()}
+    path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _other_process_snapshots():
+    """Snapshots written by the other live processes; files of dead ones are removed."""
+    snapshots = []
+    for name in os.listdir(METRICS_DIR):
+        stem, ext = os.path.splitext(name)
+        if ext != '.json' or not stem.isdigit() or int(stem) == os.getpid():
+            continue
+        path = os.path.join(METRICS_DIR, name)
+        if not _pid_alive(int(stem)):
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            continue
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        snapshots.append({metric: {tuple(key): state for key, state in series} for metric, series in data.items()})
+    return snapshots
+
+
+def _merge(metric, into, state):
+    if metric.kind == 'histogram':
+        if into is None:
+            return [list(state[0]), state[1]]
+        into[0] = [a + b for a, b in zip(into[0], state[0])]
+        into[1] += state[1]
+        return into
+    if into is None:
+        return state
+    if metric.kind == 'gauge' and metric.aggregate == 'max':
+        return max(into, state)
+    return into + state
+
+
+# --- Text exposition ---
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _label_string(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def exposition():
+    """All metrics in the Prometheus text format (version 0.0.4)."""
+    snapshots = [_snapshot()]
+    if METRICS_DIR and os.path.isdir(METRICS_DIR):
+        snapshots.extend(_other_process_snapshots())
+
+    lines = []
+    for metric in _metrics:
+        merged = {}
+        for snapshot in snapshots:
+            for key, state in snapshot.get(metric.name, {}).items():
+                merged[key] = _merge(metric, merged.get(key), state)
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for key in sorted(merged):
+            state = merged[key]
+            if metric.kind != 'histogram':
+                lines.append(f"{metric.name}{_label_string(metric.labelnames, key)} {_format_value(state)}")
+                continue
+            counts, total = state
+            cumulative = 0
+            for bound, count in zip(metric.buckets + (math.inf,), counts):
+                cumulative += count
+                labels = _label_string(metric.labelnames, key, ('le', _format_value(bound)))
+                lines.append(f"{metric.name}_bucket{labels} {cumulative}")
+            labels = _label_string(metric.labelnames, key)
+            lines.append(f"{metric.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{metric.name}_count{labels} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+
+# --- The application's metrics ---
+
+REQUEST_SECONDS = Histogram('busmap_request_seconds', "Time to build a response, by endpoint.",
+                            ('endpoint', 'status'))
+UPSTREAM_FETCH_SECONDS = Histogram('busmap_upstream_fetch_seconds',
+                                   "Time to download the GTFS-realtime feed, by result.", ('result',))
+UPSTREAM_PAYLOAD_BYTES = Histogram('busmap_upstream_payload_bytes', "Size of downloaded GTFS-realtime payloads.",
+                                   buckets=BYTES_BUCKETS)
+FEED_PARSE_SECONDS = Histogram('busmap_feed_parse_seconds', "Time to parse a GTFS-realtime payload.")
+FEED_INDEX_SECONDS = Histogram('busmap_feed_index_seconds', "Time to decode and index a snapshot's vehicles.")
+SNAPSHOT_VEHICLES = Gauge('busmap_snapshot_vehicles', "Vehicles in the latest snapshot.", aggregate='max')
+SNAPSHOT_VEHICLES_HISTOGRAM = Histogram('busmap_snapshot_vehicles_per_snapshot', "Vehicles per loaded snapshot.",
+                                        buckets=COUNT_BUCKETS)
+SNAPSHOTS_PUBLISHED = Counter('busmap_snapshots_published_total', "New feed snapshots published by the poller.")
+FILTER_SECONDS = Histogram('busmap_filter_seconds',
+                           "Time to select a request's vehicles or assemble its shapes, by endpoint.", ('endpoint',))
+SERIALIZE_SECONDS = Histogram('busmap_serialize_seconds', "Time to serialize a response body, by endpoint.",
+                              ('endpoint',))
+RESPONSE_BYTES = Histogram('busmap_response_bytes', "Size of (non-streamed) response bodies as sent, by endpoint.",
+                           ('endpoint',), buckets=BYTES_BUCKETS)
+CACHE_HITS = Counter('busmap_cache_hits_total', "Cache lookups that found an entry.", ('cache',))
+CACHE_MISSES = Counter('busmap_cache_misses_total', "Cache lookups that found nothing.", ('cache',))
+CACHE_EVICTIONS = Counter('busmap_cache_evictions_total', "Entries evicted to stay within the size budget.",
+                          ('cache',))
+CACHE_BYTES = Gauge('busmap_cache_bytes', "Approximate bytes held by a cache.", ('cache',))
+
+
+def watch_cache(name, cache):
+    """Reports a SizedLRUCache's hits, misses, evictions and size under cache=name."""
+    def collect():
+        CACHE_HITS.labels(name).set_total(cache.hits)
+        CACHE_MISSES.labels(name).set_total(cache.misses)
+        CACHE_EVICTIONS.labels(name).set_total(cache.evictions)
+        CACHE_BYTES.labels(name).set(cache.current_bytes)
+    add_collector(collect)
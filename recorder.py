@@ -0,0 +1,224 @@
+# recorder.py
+"""
+Append-only on-disk history of vehicle positions, and replay of it.
+
+The polling process appends every new feed snapshot as one columnar block to an
+hourly file (UTC hour of the snapshot version), and appends the block's
+(version, byte offset) to a sidecar index:
+
+    <dir>/YYYYMMDDHH.bmr   blocks, all little-endian:
+        b'BMR1' | uint64 version (epoch microseconds) | uint32 vehicle_count
+        | uint32 strings_length | strings (UTF-8, '\\n'-separated, each used once)
+        | uint32 route[n] | uint32 trip[n] | uint32 vehicle[n]   (indexes into strings)
+        | float32 lat[n] | float32 lon[n] | float32 bearing[n] | float32 speed[n] (m/s)
+        | uint32 timestamp[n]
+    <dir>/YYYYMMDDHH.idx   uint64 version | uint64 offset, one pair per block
+
+Missing values are NaN (floats), 0 (timestamp) or '' (strings). A block only
+becomes visible to readers once its index entry is written, so a reader never
+sees a partial block. Replay binary-searches the index for the start time and
+reads blocks sequentially from there.
+"""
+import os
+import sys
+import math
+import struct
+import bisect
+from array import array
+from datetime import datetime, timedelta, timezone
+
+_BLOCK_MAGIC = b'BMR1'
+_BLOCK_HEADER = struct.Struct('<4sQII')
+_INDEX_ENTRY = struct.Struct('<QQ')
+_HOUR_FORMAT = '%Y%m%d%H'
+
+
+def _hour_name(version):
+    return datetime.fromtimestamp(version / 1e6, timezone.utc).strftime(_HOUR_FORMAT)
+
+
+def _little_endian(values):
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_little_endian(typecode, data):
+    values = array(typecode, data)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+def encode_block(version, vehicles):
+    """One snapshot's vehicle positions (a buses.VehicleIndex) as a block (see module docstring)."""
+    strings, string_index = [], {}
+
+    def intern(values):
+        indexes = array('I')
+        for value in values:
+            idx = string_index.get(value)
+            if idx is None:
+                idx = string_index[value] = len(strings)
+                strings.append(value)
+            indexes.append(idx)
+        return indexes
+
+    # The index's columns already use this format's missing values
+    route, trip, vehicle = intern(vehicles.route_id), intern(vehicles.trip_id), intern(vehicles.vehicle_id)
+    lat, lon = array('f', vehicles.latitude), array('f', vehicles.longitude)
+    bearing, speed = array('f', vehicles.bearing), array('f', vehicles.speed)
+    timestamp = array('I', vehicles.timestamp)
+
+    encoded_strings = '\n'.join(strings).encode('utf-8')
+    parts = [_BLOCK_HEADER.pack(_BLOCK_MAGIC, version, len(route), len(encoded_strings)), encoded_strings]
+    for column in (route, trip, vehicle, lat, lon, bearing, speed, timestamp):
+        parts.append(_little_endian(column))
+    return b''.join(parts)
+
+
+def _decode_block(data, offset):
+    """Returns (version, columns dict, offset after the block)."""
+    magic, version, count, strings_length = _BLOCK_HEADER.unpack_from(data, offset)
+    if magic != _BLOCK_MAGIC:
+        raise ValueError(f"bad block magic at offset {offset}")
+    offset += _BLOCK_HEADER.size
+    strings = data[offset:offset + strings_length].decode('utf-8').split('\n')
+    offset += strings_length
+    columns = {}
+    for name, typecode in (('route', 'I'), ('trip', 'I'), ('vehicle', 'I'), ('lat', 'f'), ('lon', 'f'),
+                           ('bearing', 'f'), ('speed', 'f'), ('timestamp', 'I')):
+        columns[name] = _from_little_endian(typecode, data[offset:offset + 4 * count])
+        offset += 4 * count
+    columns['strings'] = strings
+    return version, columns, offset
+
+
+def _optional(value):
+    return None if math.isnan(value) else value
+
+
+class FeedRecorder:
+    """
+    Appends snapshots to hourly files under directory. Only the polling process
+    writes; keep_hours > 0 deletes files older than that many hours on rotation.
+    """
+
+    def __init__(self, directory, keep_hours=0):
+        self.directory = directory
+        self.keep_hours = keep_hours
+        self._hour = None
+        self._data_file = None
+        self._index_file = None
+        os.makedirs(directory, exist_ok=True)
+
+    def record(self, version, vehicles):
+        hour = _hour_name(version)
+        if hour != self._hour:
+            self._rotate(hour)
+        block = encode_block(version, vehicles)
+        offset = self._data_file.tell()
+        self._data_file.write(block)
+        self._data_file.flush()
+        self._index_file.write(_INDEX_ENTRY.pack(version, offset))
+        self._index_file.flush()
+
+    def _rotate(self, hour):
+        self.close()
+        self._hour = hour
+        self._data_file = open(os.path.join(self.directory, f'{hour}.bmr'), 'ab')
+        self._index_file = open(os.path.join(self.directory, f'{hour}.idx'), 'ab')
+        if self.keep_hours > 0:
+            self._prune(datetime.strptime(hour, _HOUR_FORMAT) - timedelta(hours=self.keep_hours))
+
+    def _prune(self, cutoff):
+        for name in os.listdir(self.directory):
+            stem, ext = os.path.splitext(name)
+            if ext not in ('.bmr', '.idx'):
+                continue
+            try:
+                if datetime.strptime(stem, _HOUR_FORMAT) < cutoff:
+                    os.remove(os.path.join(self.directory, name))
+            except (ValueError, OSError):
+                continue
+
+    def close(self):
+        for f in (self._data_file, self._index_file):
+            if f is not None:
+                f.close()
+        self._data_file = self._index_file = None
+
+
+def _read_index(index_path):
+    try:
+        with open(index_path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return [], []
+    count = len(data) // _INDEX_ENTRY.size
+    entries = [_INDEX_ENTRY.unpack_from(data, i * _INDEX_ENTRY.size) for i in range(count)]
+    return [e[0] for e in entries], [e[1] for e in entries]
+
+
+def replay(directory, from_version, to_version, target_routes=None):
+    """
+    Yields (version, [vehicle dict, ...]) for every recorded snapshot with
+    from_version <= version <= to_version (epoch microseconds), oldest first,
+    keeping only vehicles on target_routes if given.
+    """
+    hour = datetime.fromtimestamp(from_version / 1e6, timezone.utc).replace(minute=0, second=0, microsecond=0)
+    last_hour = datetime.fromtimestamp(to_version / 1e6, timezone.utc)
+    while hour <= last_hour:
+        name = hour.strftime(_HOUR_FORMAT)
+        hour += timedelta(hours=1)
+        versions, offsets = _read_index(os.path.join(directory, f'{name}.idx'))
+        first = bisect.bisect_left(versions, from_version)
+        last = bisect.bisect_right(versions, to_version)
+        if first >= last:
+            continue
+        # Read just the byte range of the wanted blocks
+        with open(os.path.join(directory, f'{name}.bmr'), 'rb') as f:
+            f.seek(offsets[first])
+            end = offsets[last] if last < len(offsets) else None
+            data = f.read() if end is None else f.read(end - offsets[first])
+        offset = 0
+        for _ in range(first, last):
+            version, columns, offset = _decode_block(data, offset)
+            yield version, _block_vehicles(columns, target_routes)
+
+
+def replay_all(directory, target_routes=None):
+    """replay() over every hourly file in directory, oldest first."""
+    for name in sorted(os.listdir(directory)):
+        stem, ext = os.path.splitext(name)
+        if ext != '.idx':
+            continue
+        try:
+            hour = datetime.strptime(stem, _HOUR_FORMAT).replace(tzinfo=timezone.utc)
+        except ValueError:
+            continue
+        start = int(hour.timestamp() * 1e6)
+        yield from replay(directory, start, start + 3600 * 1000000 - 1, target_routes)
+
+
+def _block_vehicles(columns, target_routes):
+    strings = columns['strings']
+    if target_routes is not None:
+        wanted = {i for i, value in enumerate(strings) if value in target_routes}
+        rows = [i for i, r in enumerate(columns['route']) if r in wanted]
+    else:
+        rows = range(len(columns['route']))
+    vehicles = []
+    for i in rows:
+        timestamp = columns['timestamp'][i]
+        vehicles.append({
+            "route_id": strings[columns['route'][i]],
+            "trip_id": strings[columns['trip'][i]] or None,
+            "vehicle_id": strings[columns['vehicle'][i]] or None,
+            "latitude": _optional(columns['lat'][i]),
+            "longitude": _optional(columns['lon'][i]),
+            "bearing": _optional(columns['bearing'][i]),
+            "speed": _optional(columns['speed'][i]),
+            "timestamp": timestamp or None,
+        })
+    return vehicles
@@ -0,0 +1,125 @@
+# route_catalogue.py
+"""
+Route and agency catalogue, built once per compiled GTFS store.
+
+Answers /api/agencies and /api/routes_by_agency and maps realtime route ids
+("<agency_id>_<route_short_name>") to the static route indexes behind them for
+load_gtfs_shapes. Like the store, the per-route indexes are flat columns rather
+than objects:
+
+    realtime ids         sorted, in one bytes blob with a uint64 offsets column,
+                         found by binary search
+    route indexes        CSR pair: per realtime id, the static routes behind it
+    display order        realtime id positions, sorted once at build time
+    routes by agency     CSR pair: per agency, its routes' ranks in display order
+
+Route entries are built from the store's string tables when a request asks
+for them. Only the agency list and names (one entry per agency) are Python
+objects, shared between requests, so treat them as read-only.
+"""
+import heapq
+from array import array
+
+
+def sort_key_routes(short_name):
+    """Numeric route numbers first (by their leading number), then the rest by name."""
+    parts = short_name.split('/')
+    try:
+        primary_num = int(parts[0])
+        return (primary_num, short_name)
+    except ValueError:
+        return (float('inf'), short_name)
+
+
+class RouteCatalogue:
+    def __init__(self, store):
+        self.version = store.version
+        self._store = store
+        self.agency_names = dict(zip(store.agency_ids, store.agency_names))
+
+        # realtime_id -> static route indexes, only while building
+        groups = {}
+        agency_ids_with_routes = set()
+        for idx, (agency_id, short_name) in enumerate(zip(store.route_agency, store.route_short_name)):
+            if agency_id:
+                agency_ids_with_routes.add(agency_id)
+            if not agency_id or not short_name:
+                continue
+            groups.setdefault(f"{agency_id}_{short_name}".encode('utf-8'), []).append(idx)
+
+        realtime_ids = sorted(groups)
+        self._realtime_id_blob = b''.join(realtime_ids)
+        self._realtime_id_offsets = array('Q', [0])
+        self._route_offsets, self._route_indexes = array('I', [0]), array('I')
+        for realtime_id in realtime_ids:
+            self._realtime_id_offsets.append(self._realtime_id_offsets[-1] + len(realtime_id))
+            self._route_indexes.extend(groups[realtime_id])
+            self._route_offsets.append(len(self._route_indexes))
+        del groups
+        self.realtime_route_count = len(realtime_ids)
+
+        # The first static route seen names a realtime route; ties keep that order
+        first_route = [self._route_indexes[self._route_offsets[i]] for i in range(len(realtime_ids))]
+        self._display_order = array('I', sorted(
+            range(len(realtime_ids)),
+            key=lambda i: (sort_key_routes(store.route_short_name[first_route[i]]), first_route[i])))
+
+        self.agencies = [
+            {"id": agency_id, "name": self.agency_names.get(agency_id, f"Unknown Agency (ID: {agency_id})")}
+            for agency_id in sorted(agency_ids_with_routes)
+        ]
+        self._agency_positions = {agency["id"]: i for i, agency in enumerate(self.agencies)}
+        ranks_by_agency = [[] for _ in self.agencies]
+        for rank, position in enumerate(self._display_order):
+            ranks_by_agency[self._agency_positions[store.route_agency[first_route[position]]]].append(rank)
+        self._agency_route_offsets, self._agency_route_ranks = array('I', [0]), array('I')
+        for ranks in ranks_by_agency:
+            self._agency_route_ranks.extend(ranks)
+            self._agency_route_offsets.append(len(self._agency_route_ranks))
+
+    def _realtime_id(self, position):
+        start, end = self._realtime_id_offsets[position], self._realtime_id_offsets[position + 1]
+        return self._realtime_id_blob[start:end].decode('utf-8')
+
+    def _find(self, realtime_id):
+        """Position of realtime_id in the sorted blob, or None."""
+        key = realtime_id.encode('utf-8')
+        blob, offsets = self._realtime_id_blob, self._realtime_id_offsets
+        lo, hi = 0, self.realtime_route_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if blob[offsets[mid]:offsets[mid + 1]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.realtime_route_count and blob[offsets[lo]:offsets[lo + 1]] == key:
+            return lo
+        return None
+
+    def _route(self, position):
+        idx = self._route_indexes[self._route_offsets[position]]
+        return {
+            "realtime_id": self._realtime_id(position),
+            "short_name": self._store.route_short_name[idx],
+            "long_name": self._store.route_long_name[idx],
+            "agency_id": self._store.route_agency[idx],
+        }
+
+    def realtime_ids(self):
+        """Every realtime route id, sorted."""
+        return [self._realtime_id(position) for position in range(self.realtime_route_count)]
+
+    def routes_for_agencies(self, agency_ids):
+        """Routes of the given agencies, in the same order as one sorted list of them all."""
+        offsets = self._agency_route_offsets
+        lists = [self._agency_route_ranks[offsets[i]:offsets[i + 1]]
+                 for i in (self._agency_positions.get(aid) for aid in agency_ids) if i is not None]
+        ranks = lists[0] if len(lists) == 1 else heapq.merge(*lists)
+        return [self._route(self._display_order[rank]) for rank in ranks]
+
+    def route_indexes(self, realtime_id):
+        """Static route indexes behind a realtime route id (empty if unknown)."""
+        position = self._find(realtime_id)
+        if position is None:
+            return ()
+        return self._route_indexes[self._route_offsets[position]:self._route_offsets[position + 1]]
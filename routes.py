@@ -1,17 +1,44 @@
 # routes.py
-import os
-import csv
-from collections import defaultdict
+import math
+import time
 import traceback
+from datetime import datetime, timezone
 
-from flask import render_template, jsonify, request
+from flask import render_template, jsonify, request, Response, g
 
 # Import the app object and data utility functions from application.py
-from application import app, load_gtfs_shapes, get_agency_name_map
-# Import the function from your bus script
-from buses import fetch_and_filter_bus_positions
+from shape_simplify import tolerance_for_zoom, MAX_SIMPLIFIED_ZOOM
+from shape_encoding import SHAPE_FORMATS, pack_binary_shapes
+from http_cache import dataset_cached
+from schedule import schedule_deviations
+from recorder import replay
+import metrics
+from application import app, load_gtfs_shapes, get_route_catalogue, feed_poller, FEED_POLL_SECONDS, \
+    BUS_STREAM_MAX_SECONDS, BUS_STREAM_HEARTBEAT_SECONDS, get_dataset_version, get_dataset_day_version, \
+    default_service_date, response_cache, get_gtfs_store, GTFS_TIMEZONE, FEED_RECORD_DIR, REPLAY_MAX_SECONDS
 
 
+@app.before_request
+def _start_request_timer():
+    metrics.ensure_flushing()
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _observe_request(response):
+    """Per-endpoint request time (to the start of the body for streams) and body size."""
+    started = g.pop('request_started', None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.REQUEST_SECONDS.labels(endpoint, response.status_code).observe(time.perf_counter() - started)
+        if not response.is_streamed:
+            metrics.RESPONSE_BYTES.labels(endpoint).observe(response.content_length or 0)
+    return response
+
+@app.route('/metrics')
+def api_metrics():
+    """Prometheus text exposition of the counters and histograms in metrics.py."""
+    return Response(metrics.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/')
 def index():
     """Renders the main HTML page. The Google Maps API key will be fetched by JS."""
@@ -30,41 +57,19 @@ def api_maps_config():
 
 
 @app.route('/api/agencies')
+@dataset_cached(get_dataset_version, response_cache)
 def api_get_agencies():
-    agencies = []
-    agency_name_map = get_agency_name_map() # Uses the cached map from application.py
-    
-    gtfs_static_dir = app.config.get("GTFS_STATIC_DIR", 'gtfs_static')
-    routes_file = os.path.join(gtfs_static_dir, 'routes2606.txt')
-    
-    found_agency_ids = set()
-    if not os.path.exists(routes_file):
-        print(f"ERROR (/api/agencies): {routes_file} not found.")
-        return jsonify({"error": f"{os.path.basename(routes_file)} not found"}), 404
-    
-    try:
-        with open(routes_file, 'r', encoding='utf-8-sig') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row.get('agency_id'):
-                    found_agency_ids.add(row['agency_id'])
-    except Exception as e:
-        print(f"Error reading {os.path.basename(routes_file)} for agencies: {e}")
-        traceback.print_exc()
-        return jsonify({"error": f"Could not read routes data to determine agencies: {e}"}), 500
+    catalogue = get_route_catalogue() # Built once at startup in application.py
+    if catalogue is None:
+        print("ERROR (/api/agencies): GTFS store unavailable.")
+        return jsonify({"error": "GTFS static data not available"}), 503
 
-    if not found_agency_ids:
+    if not catalogue.agencies:
         print("WARNING (/api/agencies): No agency_ids found in routes file.")
-        return jsonify([])
-
-    for aid in sorted(list(found_agency_ids)):
-        agencies.append({
-            "id": aid,
-            "name": agency_name_map.get(aid, f"Unknown Agency (ID: {aid})")
-        })
-    return jsonify(agencies)
+    return jsonify(catalogue.agencies)
 
 @app.route('/api/routes_by_agency')
+@dataset_cached(get_dataset_version, response_cache)
 def api_get_routes_by_agency():
     agency_ids_str = request.args.get('agency_ids')
     if not agency_ids_str:
@@ -74,49 +79,27 @@ def api_get_routes_by_agency():
     if not target_agency_ids:
         return jsonify({"error": "agency_ids parameter was empty or invalid"}), 400
 
-    routes_data = []
-    gtfs_static_dir = app.config.get("GTFS_STATIC_DIR", 'gtfs_static')
-    routes_file = os.path.join(gtfs_static_dir, 'routes2606.txt')
+    catalogue = get_route_catalogue()
+    if catalogue is None:
+        print("ERROR (/api/routes_by_agency): GTFS store unavailable.")
+        return jsonify({"error": "GTFS static data not available"}), 503
 
-    if not os.path.exists(routes_file):
-        print(f"ERROR (/api/routes_by_agency): {os.path.basename(routes_file)} not found.")
-        return jsonify({"error": f"{os.path.basename(routes_file)} not found"}), 404
-
-    try:
-        with open(routes_file, 'r', encoding='utf-8-sig') as f:
-            reader = csv.DictReader(f)
-            seen_realtime_ids = set()
-            for row in reader:
-                agency_id = row.get('agency_id')
-                route_short_name = row.get('route_short_name')
-                if agency_id in target_agency_ids and route_short_name:
-                    realtime_route_id = f"{agency_id}_{route_short_name}"
-                    if realtime_route_id in seen_realtime_ids:
-                        continue
-                    seen_realtime_ids.add(realtime_route_id)
-                    
-                    routes_data.append({
-                        "realtime_id": realtime_route_id,
-                        "short_name": route_short_name,
-                        "long_name": row.get('route_long_name', ''),
-                        "agency_id": agency_id,
-                    })
-        
-        def sort_key_routes(route):
-            parts = route['short_name'].split('/')
-            try:
-                primary_num = int(parts[0])
-                return (primary_num, route['short_name'])
-            except ValueError:
-                return (float('inf'), route['short_name'])
-        routes_data.sort(key=sort_key_routes)
+    return jsonify(catalogue.routes_for_agencies(target_agency_ids))
 
-    except Exception as e:
-        print(f"Error reading {os.path.basename(routes_file)} for routes: {e}")
-        traceback.print_exc()
-        return jsonify({"error": f"Could not read routes data: {e}"}), 500
-        
-    return jsonify(routes_data)
+def _parse_bbox(bbox_str):
+    """
+    Parses 'south,west,north,east' (degrees, as LatLngBounds.toUrlValue() gives it).
+    Returns a tuple, or None if bbox_str is missing; raises ValueError if malformed.
+    """
+    if not bbox_str:
+        return None
+    parts = [float(p) for p in bbox_str.split(',')]
+    if len(parts) != 4:
+        raise ValueError("bbox needs four numbers: south,west,north,east")
+    south, west, north, east = parts
+    if not (-90 <= south <= north <= 90 and -180 <= west <= east <= 180):
+        raise ValueError("bbox must be south,west,north,east with south <= north and west <= east")
+    return (south, west, north, east)
 
 @app.route('/api/bus_data')
 def get_bus_data():
@@ -125,8 +108,16 @@ def get_bus_data():
     if selected_routes_str:
         target_routes = set(r.strip() for r in selected_routes_str.split(',') if r.strip())
 
-    if not target_routes:
+    # bbox=south,west,north,east limits the vehicles to a map viewport; on its own
+    # it selects every vehicle inside it
+    try:
+        bbox = _parse_bbox(request.args.get('bbox'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if not target_routes and bbox is None:
         return jsonify([])
+    selected_routes = target_routes or None
 
     tfnsw_api_key = app.config.get("TFNSW_API_KEY")
     tfnsw_bus_url = app.config.get("TFNSW_BUS_URL")
@@ -136,17 +127,191 @@ def get_bus_data():
          return jsonify({"error": "Server configuration error (TfNSW API)"}), 500
 
     try:
-        buses = fetch_and_filter_bus_positions(tfnsw_bus_url, tfnsw_api_key, target_routes)
-        if buses is None:
-            print("API Error: fetch_and_filter_bus_positions returned None")
-            return jsonify({"error": "Failed to fetch or parse bus data from TfNSW"}), 500
-        return jsonify(buses)
+        # Only waits if this is the very first snapshot since startup
+        snapshot = feed_poller.wait_for_snapshot(timeout=FEED_POLL_SECONDS)
+        if snapshot is None:
+            print("API Error: no vehicle positions snapshot available yet")
+            return jsonify({"error": "Bus data from TfNSW is not available yet"}), 503
+
+        # With since=<version> only vehicles added, changed or removed since that
+        # snapshot are sent. Unknown versions, and selections with vehicles that
+        # have no vehicle_id to remove them by, get a full list flagged "full": true.
+        since_str = request.args.get('since')
+        vehicles = snapshot.vehicles
+        with metrics.FILTER_SECONDS.labels('bus_data').time():
+            delta = None
+            if since_str is not None:
+                previous = feed_poller.get_snapshot_version(int(since_str)) if since_str.isdigit() else None
+                if previous is not None:
+                    delta = vehicles.changes_since(previous.vehicles, selected_routes, bbox)
+            if delta is None:
+                rows = vehicles.select(selected_routes, bbox)
+            else:
+                rows, removed = delta
+        # Only the selected rows are turned into dicts (speed strings, datetimes)
+        with metrics.SERIALIZE_SECONDS.labels('bus_data').time():
+            if since_str is None:
+                body = vehicles.records(rows)
+            elif delta is None:
+                body = {"version": snapshot.version, "full": True, "vehicles": vehicles.records(rows), "removed": []}
+            else:
+                body = {"version": snapshot.version, "full": False, "vehicles": vehicles.records(rows),
+                        "removed": removed}
+            response = jsonify(body)
+        response.headers["X-Snapshot-Version"] = str(snapshot.version)
+        return response
     except Exception as e:
         print(f"API Exception in /api/bus_data: An unexpected error occurred: {e}")
         traceback.print_exc()
         return jsonify({"error": "An unexpected server error occurred processing bus data"}), 500
 
+@app.route('/api/schedule_deviation')
+def api_schedule_deviation():
+    """
+    Schedule deviation of every vehicle on the requested routes and/or bbox (same
+    selection as /api/bus_data) in one call: {"version", "vehicles": [{vehicle_id,
+    trip_id, route_id, stop_sequence, scheduled_arrival, deviation_seconds}, ...]}.
+    Vehicles whose trip or stop isn't in the timetable are left out.
+    """
+    selected_routes_str = request.args.get('routes')
+    target_routes = set()
+    if selected_routes_str:
+        target_routes = set(r.strip() for r in selected_routes_str.split(',') if r.strip())
+
+    try:
+        bbox = _parse_bbox(request.args.get('bbox'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if not target_routes and bbox is None:
+        return jsonify({"error": "routes or bbox parameter is required"}), 400
+
+    if not app.config.get("TFNSW_API_KEY") or not app.config.get("TFNSW_BUS_URL"):
+         print("API Error: TfNSW API Key or URL not configured.")
+         return jsonify({"error": "Server configuration error (TfNSW API)"}), 500
+
+    store = get_gtfs_store()
+    if store is None or not store.has_stop_times:
+        return jsonify({"error": "Timetable (stop_times) not loaded on server"}), 503
+
+    snapshot = feed_poller.wait_for_snapshot(timeout=FEED_POLL_SECONDS)
+    if snapshot is None:
+        print("API Error: no vehicle positions snapshot available yet")
+        return jsonify({"error": "Bus data from TfNSW is not available yet"}), 503
+
+    try:
+        rows = snapshot.vehicles.select(target_routes or None, bbox)
+        return jsonify({"version": snapshot.version,
+                        "vehicles": schedule_deviations(store, snapshot.vehicles, rows, GTFS_TIMEZONE)})
+    except Exception as e:
+        print(f"API Exception in /api/schedule_deviation: {e}")
+        traceback.print_exc()
+        return jsonify({"error": "An unexpected server error occurred computing schedule deviation"}), 500
+
+# Replayed times must be after the epoch and leave the hourly walk in recorder.replay room before year 9999 ends
+_LATEST_REPLAY_TIME = datetime(9999, 12, 31, tzinfo=timezone.utc).timestamp()
+
+def _parse_time(value):
+    """
+    Epoch seconds, or an ISO 8601 time (in GTFS_TIMEZONE if it has no offset), as epoch seconds.
+    Raises ValueError for anything else, including times outside what can be replayed.
+    """
+    try:
+        seconds = float(value)
+    except ValueError:
+        parsed = datetime.fromisoformat(value)
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=GTFS_TIMEZONE)
+        seconds = parsed.timestamp()
+    if not math.isfinite(seconds) or not 0 <= seconds <= _LATEST_REPLAY_TIME:
+        raise ValueError(value)
+    return seconds
+
+@app.route('/api/replay')
+def api_replay():
+    """
+    Streams recorded snapshots between from= and to= (epoch seconds or ISO 8601) as
+    newline-delimited JSON, one {"version", "vehicles": [...]} object per snapshot,
+    limited to routes= if given. Recorded vehicles carry raw values: speed in m/s
+    and timestamp in epoch seconds.
+    """
+    if not FEED_RECORD_DIR:
+        return jsonify({"error": "Recording is not enabled on this server (FEED_RECORD_DIR)"}), 404
+
+    selected_routes_str = request.args.get('routes')
+    target_routes = None
+    if selected_routes_str:
+        target_routes = set(r.strip() for r in selected_routes_str.split(',') if r.strip()) or None
+
+    if not request.args.get('from') or not request.args.get('to'):
+        return jsonify({"error": "from and to parameters are required"}), 400
+    try:
+        from_time = _parse_time(request.args['from'])
+        to_time = _parse_time(request.args['to'])
+    except ValueError:
+        return jsonify({"error": "from and to must be epoch seconds or ISO 8601 times from 1970 to 9999"}), 400
+    if to_time < from_time:
+        return jsonify({"error": "to must not be before from"}), 400
+    if to_time - from_time > REPLAY_MAX_SECONDS:
+        return jsonify({"error": f"at most {REPLAY_MAX_SECONDS} seconds can be replayed per request"}), 400
+
+    def generate():
+        for version, vehicles in replay(FEED_RECORD_DIR, int(from_time * 1e6), int(to_time * 1e6), target_routes):
+            yield app.json.dumps({"version": version, "vehicles": vehicles}) + "\n"
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@app.route('/api/bus_stream')
+def api_bus_stream():
+    """
+    Server-Sent Events stream of the vehicles on the requested routes and/or bbox. A
+    'vehicles' event (the same list /api/bus_data returns) is pushed once per new feed
+    snapshot, with the snapshot version as the event id so reconnects skip what was
+    already sent.
+    """
+    selected_routes_str = request.args.get('routes')
+    target_routes = set()
+    if selected_routes_str:
+        target_routes = set(r.strip() for r in selected_routes_str.split(',') if r.strip())
+
+    try:
+        bbox = _parse_bbox(request.args.get('bbox'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if not target_routes and bbox is None:
+        return jsonify({"error": "routes or bbox parameter is required"}), 400
+    selected_routes = target_routes or None
+
+    if not app.config.get("TFNSW_API_KEY") or not app.config.get("TFNSW_BUS_URL"):
+         print("API Error: TfNSW API Key or URL not configured.")
+         return jsonify({"error": "Server configuration error (TfNSW API)"}), 500
+
+    last_version = None
+    last_event_id = request.headers.get('Last-Event-ID')
+    if last_event_id and last_event_id.isdigit():
+        last_version = int(last_event_id)
+
+    def generate(last_version):
+        yield f"retry: {int(FEED_POLL_SECONDS * 1000)}\n\n"
+        deadline = time.monotonic() + BUS_STREAM_MAX_SECONDS
+        while time.monotonic() < deadline:
+            snapshot = feed_poller.wait_for_new_snapshot(last_version, timeout=BUS_STREAM_HEARTBEAT_SECONDS)
+            if snapshot is None:
+                yield ": keep-alive\n\n"
+                continue
+            last_version = snapshot.version
+            with metrics.FILTER_SECONDS.labels('bus_stream').time():
+                rows = snapshot.vehicles.select(selected_routes, bbox)
+            with metrics.SERIALIZE_SECONDS.labels('bus_stream').time():
+                data = app.json.dumps(snapshot.vehicles.records(rows))
+            yield f"id: {snapshot.version}\nevent: vehicles\ndata: {data}\n\n"
+
+    return Response(generate(last_version), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.route('/api/route_shapes')
+@dataset_cached(get_dataset_day_version, response_cache)
 def api_get_route_shapes():
     selected_routes_str = request.args.get('routes')
     target_realtime_routes = set()
@@ -154,7 +319,45 @@ def api_get_route_shapes():
         target_realtime_routes = set(r.strip() for r in selected_routes_str.split(',') if r.strip())
 
     if not target_realtime_routes:
-        return jsonify({})
-    
-    shapes_data = load_gtfs_shapes(target_realtime_routes)
-    return jsonify(shapes_data)
\ No newline at end of file
+        return jsonify({"routes": {}, "shapes": {}})
+
+    # Optional level of detail: a map zoom level, or an explicit tolerance in degrees
+    tolerance = None
+    try:
+        if request.args.get('tolerance'):
+            tolerance = float(request.args['tolerance'])
+            if not math.isfinite(tolerance):
+                raise ValueError
+            if not tolerance > 0:
+                tolerance = None
+        elif request.args.get('zoom'):
+            zoom = float(request.args['zoom'])
+            if not math.isfinite(zoom):
+                raise ValueError
+            # Zoom levels past either end simplify like the end itself
+            tolerance = tolerance_for_zoom(int(min(max(zoom, 0), MAX_SIMPLIFIED_ZOOM)))
+    except ValueError:
+        return jsonify({"error": "zoom and tolerance must be finite numbers"}), 400
+
+    shape_format = request.args.get('format', 'json')
+    if shape_format not in SHAPE_FORMATS:
+        return jsonify({"error": f"format must be one of: {', '.join(SHAPE_FORMATS)}"}), 400
+
+    # Only shapes of services running on date=YYYYMMDD (default today); date=all for every shape
+    date_str = request.args.get('date')
+    if date_str == 'all':
+        service_date = None
+    elif date_str:
+        try:
+            service_date = datetime.strptime(date_str, '%Y%m%d').date()
+        except ValueError:
+            return jsonify({"error": "date must be YYYYMMDD or 'all'"}), 400
+    else:
+        service_date = default_service_date()
+
+    with metrics.FILTER_SECONDS.labels('route_shapes').time():
+        shapes_data = load_gtfs_shapes(target_realtime_routes, tolerance, shape_format, service_date)
+    with metrics.SERIALIZE_SECONDS.labels('route_shapes').time():
+        if shape_format == 'binary':
+            return Response(pack_binary_shapes(shapes_data), mimetype='application/octet-stream')
+        return jsonify(shapes_data)
\ No newline at end of file
@@ -0,0 +1,86 @@
+# schedule.py
+"""
+Schedule deviation of live vehicles against the compiled stop_times columns
+(see gtfs_store.py).
+
+A vehicle's deviation is its position timestamp minus the scheduled arrival at
+the stop it reports (current_stop_sequence, else stop_id) on the service day
+its trip runs. Positive means late. Everything is looked up in the memory-mapped
+columns, so a batch costs a binary search and a scan of one trip's stops per
+vehicle, with no per-trip data held in the process.
+"""
+from datetime import datetime, timedelta, time as dt_time
+
+# Service days whose trips can still be running at a given moment: today, and
+# yesterday for trips scheduled past midnight (stop times beyond 24:00:00).
+_SERVICE_DAY_OFFSETS = (0, -1)
+
+
+def _stop_row(store, trip_idx, stop_sequence, stop_id):
+    """Row in the stop_time_* columns for the stop the vehicle reported, or None."""
+    start, end = store.stop_time_range(trip_idx)
+    if stop_sequence is not None:
+        sequences = store.stop_time_sequence
+        for row in range(start, end):
+            if sequences[row] == stop_sequence:
+                return row
+    if stop_id is not None:
+        stop_ids, stops = store.stop_ids, store.stop_time_stop
+        for row in range(start, end):
+            if stop_ids[stops[row]] == stop_id:
+                return row
+    return None
+
+
+def _service_day_start(service_date, tz):
+    # GTFS times count from "noon minus 12h", which differs from midnight on DST change days
+    return datetime.combine(service_date, dt_time(12), tzinfo=tz) - timedelta(hours=12)
+
+
+def schedule_deviation(store, vehicles, row, tz):
+    """
+    Deviation dict for one vehicle (a row of a VehicleIndex), or None if its
+    trip, stop or timestamp can't be matched to the timetable.
+    """
+    timestamp = vehicles.timestamp[row]
+    trip_id = vehicles.trip_id[row]
+    if not timestamp or not trip_id:
+        return None
+    trip_idx = store.trip_index(trip_id)
+    if trip_idx is None:
+        return None
+    stop_sequence = vehicles.stop_sequence[row]
+    stop_row = _stop_row(store, trip_idx, stop_sequence if stop_sequence >= 0 else None,
+                         vehicles.stop_id[row] or None)
+    if stop_row is None or store.stop_time_arrival[stop_row] < 0:
+        return None
+
+    local_date = datetime.fromtimestamp(timestamp, tz).date()
+    best = None
+    for offset in _SERVICE_DAY_OFFSETS:
+        service_date = local_date + timedelta(days=offset)
+        scheduled = int(_service_day_start(service_date, tz).timestamp()) + store.stop_time_arrival[stop_row]
+        deviation = timestamp - scheduled
+        # Prefer a day the trip actually runs, then the closest match
+        candidate = (not store.trip_active(trip_idx, service_date), abs(deviation), scheduled, deviation)
+        if best is None or candidate < best:
+            best = candidate
+    _, _, scheduled, deviation = best
+    return {
+        "vehicle_id": vehicles.vehicle_id[row] or 'N/A',
+        "trip_id": trip_id,
+        "route_id": vehicles.route_id[row],
+        "stop_sequence": store.stop_time_sequence[stop_row],
+        "scheduled_arrival": scheduled,
+        "deviation_seconds": deviation,
+    }
+
+
+def schedule_deviations(store, vehicles, rows, tz):
+    """Deviation dicts for every vehicle in rows (of the VehicleIndex vehicles) that can be matched."""
+    results = []
+    for row in rows:
+        deviation = schedule_deviation(store, vehicles, row, tz)
+        if deviation is not None:
+            results.append(deviation)
+    return results
@@ -0,0 +1,82 @@
+# shape_encoding.py
+"""
+Wire formats for /api/route_shapes.
+
+The JSON formats are {"routes": {realtime_id: [shape_hash, ...]}, "shapes": {shape_hash: shape}}
+so a shape shared by several routes is sent once, with each shape as:
+
+    json      [{"lat": y, "lng": x}, ...]
+    polyline  a Google encoded-polyline string, decodable in the browser with
+              google.maps.geometry.encoding.decodePath
+    binary    application/octet-stream, all little-endian:
+                  b'BSH2' | uint32 shape_count
+                  per shape: uint8 hash_length | hash (ASCII)
+                             | uint32 point_count | point_count * (float32 lat, float32 lng)
+                  uint32 route_count
+                  per route: uint16 id_length | id (UTF-8) | uint32 ref_count
+                             | ref_count * uint32 (index into the shape table)
+"""
+import sys
+import struct
+from array import array
+
+SHAPE_FORMATS = ('json', 'polyline', 'binary')
+BINARY_MAGIC = b'BSH2'
+
+
+def encode_json_points(lats, lngs):
+    return [{'lat': lat, 'lng': lng} for lat, lng in zip(lats, lngs)]
+
+
+def _encode_signed(value, out):
+    value = ~(value << 1) if value < 0 else (value << 1)
+    while value >= 0x20:
+        out.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    out.append(chr(value + 63))
+
+
+def encode_polyline(lats, lngs, precision=5):
+    """Google encoded-polyline string for a sequence of points."""
+    factor = 10 ** precision
+    out = []
+    prev_lat = prev_lng = 0
+    for lat, lng in zip(lats, lngs):
+        ilat, ilng = round(lat * factor), round(lng * factor)
+        _encode_signed(ilat - prev_lat, out)
+        _encode_signed(ilng - prev_lng, out)
+        prev_lat, prev_lng = ilat, ilng
+    return ''.join(out)
+
+
+def encode_float32_shape(lats, lngs):
+    """One binary shape record: uint32 point count then interleaved float32 lat/lng."""
+    interleaved = array('f', bytes(8 * len(lats)))
+    interleaved[0::2] = array('f', lats)
+    interleaved[1::2] = array('f', lngs)
+    if sys.byteorder != 'little':
+        interleaved.byteswap()
+    return struct.pack('<I', len(lats)) + interleaved.tobytes()
+
+
+def pack_binary_shapes(shapes_data):
+    """
+    Frames load_gtfs_shapes() output for fmt 'binary' ({"routes": ..., "shapes":
+    {hash: encode_float32_shape(...)}}) into one binary response body.
+    """
+    shapes, routes = shapes_data["shapes"], shapes_data["routes"]
+    parts = [BINARY_MAGIC, struct.pack('<I', len(shapes))]
+    shape_positions = {}
+    for position, (shape_hash, shape) in enumerate(shapes.items()):
+        shape_positions[shape_hash] = position
+        encoded_hash = shape_hash.encode('ascii')
+        parts.append(struct.pack('<B', len(encoded_hash)))
+        parts.append(encoded_hash)
+        parts.append(shape)
+    parts.append(struct.pack('<I', len(routes)))
+    for realtime_id, refs in routes.items():
+        encoded_id = realtime_id.encode('utf-8')
+        parts.append(struct.pack('<H', len(encoded_id)))
+        parts.append(encoded_id)
+        parts.append(struct.pack(f'<I{len(refs)}I', len(refs), *(shape_positions[h] for h in refs)))
+    return b''.join(parts)
@@ -0,0 +1,83 @@
+# shape_simplify.py
+"""
+Douglas-Peucker simplification of route shapes, precomputed for every level of
+detail at once.
+
+Instead of simplifying a shape for one tolerance, douglas_peucker_significance()
+runs Douglas-Peucker to completion and records, per point, the largest tolerance
+at which it would still be kept. Simplifying for any tolerance is then a single
+threshold test over that column (significance > tolerance), which is exactly
+the Douglas-Peucker result for that tolerance. The column is computed when the
+GTFS store is compiled (see gtfs_store.py) and memory-mapped with the points.
+"""
+import math
+from array import array
+
+# Above this zoom level shapes are sent at full resolution.
+MAX_SIMPLIFIED_ZOOM = 17
+
+
+def tolerance_for_zoom(zoom):
+    """
+    Tolerance (degrees) for a Google Maps zoom level: the width of one 256px-tile
+    pixel at the equator, slightly more than one screen pixel at Sydney's latitude.
+    Returns None when no simplification should be applied.
+    """
+    if zoom >= MAX_SIMPLIFIED_ZOOM:
+        return None
+    return 360.0 / (256 * 2 ** max(zoom, 0))
+
+
+def douglas_peucker_significance(lats, lngs):
+    """
+    Per-point significance (float32, degrees of latitude) for one shape.
+    Endpoints are always kept (infinite significance). Longitudes are scaled by
+    cos(latitude) so distances are roughly isotropic.
+    """
+    n = len(lats)
+    significance = array('f', bytes(4 * n))
+    if n == 0:
+        return significance
+    significance[0] = significance[n - 1] = math.inf
+    if n < 3:
+        return significance
+
+    kx = math.cos(math.radians(sum(lats) / n))
+    xs = [lng * kx for lng in lngs]
+    ys = list(lats)
+
+    stack = [(0, n - 1, math.inf)]
+    while stack:
+        first, last, parent_significance = stack.pop()
+        if last - first < 2:
+            continue
+        x1, y1 = xs[first], ys[first]
+        dx, dy = xs[last] - x1, ys[last] - y1
+        segment_length = math.hypot(dx, dy)
+        if segment_length == 0:
+            # Closed loop: measure distance from the shared endpoint instead.
+            best = max(range(first + 1, last), key=lambda k: math.hypot(xs[k] - x1, ys[k] - y1))
+            distance = math.hypot(xs[best] - x1, ys[best] - y1)
+        else:
+            best = max(range(first + 1, last), key=lambda k: abs(dy * (xs[k] - x1) - dx * (ys[k] - y1)))
+            distance = abs(dy * (xs[best] - x1) - dx * (ys[best] - y1)) / segment_length
+        # A point can't outlive the split that exposed it, which keeps thresholds monotonic.
+        point_significance = min(distance, parent_significance)
+        significance[best] = point_significance
+        stack.append((first, best, point_significance))
+        stack.append((best, last, point_significance))
+    return significance
+
+
+def kept_indexes(significance, start, end, tolerance):
+    """
+    Indexes in [start, end) of the points kept at tolerance: those more
+    significant than it, and always the first and last point, whatever the
+    tolerance (even infinite).
+    """
+    if end - start <= 2:
+        return list(range(start, end))
+    keep = [start]
+    keep.extend(i for i in range(start + 1, end - 1) if significance[i] > tolerance)
+    keep.append(end - 1)
+    return keep
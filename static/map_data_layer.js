@@ -40,6 +40,17 @@ function getBoundingBox(points) {
     return { minLat, maxLat, minLng, maxLng };
 }
 
+const PREVIEW_SHAPE_ZOOM = 12;
+
+// Route shapes are requested as Google encoded polylines (format=polyline) to keep responses small.
+// Responses list each distinct shape once under "shapes"; "routes" refers to them by hash.
+function decodeShape(encodedPath) {
+    if (typeof encodedPath !== 'string') {
+        return [];
+    }
+    return google.maps.geometry.encoding.decodePath(encodedPath).map(latLng => ({ lat: latLng.lat(), lng: latLng.lng() }));
+}
+
 export async function renderRoutePreviewInModal(routeId, previewContainerElement) {
     if (!routeId || !previewContainerElement) {
         console.error("renderRoutePreviewInModal: Missing routeId or container element.");
@@ -50,7 +61,8 @@ export async function renderRoutePreviewInModal(routeId, previewContainerElement
     previewContainerElement.innerHTML = 'Loading preview...';
 
     try {
-        const response = await fetch(`/api/route_shapes?routes=${routeId}`);
+        // The preview is a small SVG, so a city-level simplification is plenty
+        const response = await fetch(`/api/route_shapes?routes=${routeId}&zoom=${PREVIEW_SHAPE_ZOOM}&format=polyline`);
         console.log(`renderRoutePreviewInModal: API response status for ${routeId}: ${response.status}`);
         if (!response.ok) {
             const errorText = await response.text();
@@ -60,13 +72,15 @@ export async function renderRoutePreviewInModal(routeId, previewContainerElement
         console.log(`renderRoutePreviewInModal: shapesData for ${routeId}:`, JSON.stringify(shapesData, null, 2).substring(0, 300) + "...");
 
 
-        if (!shapesData || !shapesData[routeId] || shapesData[routeId].length === 0 || shapesData[routeId][0].length === 0) {
-            console.warn(`No shape data found for previewing route ${routeId}. shapesData[routeId]:`, shapesData ? shapesData[routeId] : 'undefined');
+        const shapeRefs = shapesData?.routes?.[routeId];
+        const firstShape = shapeRefs && shapeRefs.length > 0 ? shapesData.shapes[shapeRefs[0]] : null;
+        if (!firstShape) {
+            console.warn(`No shape data found for previewing route ${routeId}. shapesData.routes[routeId]:`, shapeRefs);
             previewContainerElement.innerHTML = 'No path data available for this route.';
             return;
         }
 
-        const pathPoints = shapesData[routeId][0].filter(p => typeof p?.lat === 'number' && typeof p?.lng === 'number');
+        const pathPoints = decodeShape(firstShape).filter(p => typeof p?.lat === 'number' && typeof p?.lng === 'number');
         console.log(`renderRoutePreviewInModal: Filtered pathPoints for ${routeId} (count: ${pathPoints.length}):`, JSON.stringify(pathPoints.slice(0, 3), null, 2) + "...");
 
         if (pathPoints.length < 2) {
@@ -190,6 +204,7 @@ export async function updateMapData() {
 
     if (G.selectedRealtimeRouteIds.size === 0) {
         console.log("updateMapData: No routes selected. Map will be empty except base layer.");
+        stopBusStream();
         if (G.dataFetchIntervalId) {
             clearInterval(G.dataFetchIntervalId);
             G.setDataFetchIntervalId(null);
@@ -214,10 +229,14 @@ export async function updateMapData() {
         // console.log("updateMapData: Cleared existing data fetch interval."); // Can be verbose
     }
 
+    stopBusStream();
+
     // console.log("updateMapData: Fetching markers."); // Can be verbose
     await fetchAndUpdateMarkers(routesParam);
 
-    if (G.currentMapOptions.liveTrackingEnabled) {
+    if (G.currentMapOptions.liveTrackingEnabled && G.currentMapOptions.streamingEnabled) {
+        startBusStream(routesParam);
+    } else if (G.currentMapOptions.liveTrackingEnabled) {
         // console.log("updateMapData: Live tracking IS enabled. Starting interval."); // Can be verbose
         G.setDataFetchIntervalId(setInterval(async () => {
             if (G.currentMapOptions.liveTrackingEnabled && G.selectedRealtimeRouteIds.size > 0) {
@@ -412,6 +431,7 @@ export function clearAllMapLayers() {
         }
     }
     G.setRoutePolylines({});
+    G.setRouteShapesZoom(null);
 
     for (const vehicleId in G.busMarkerObjects) {
         if (G.busMarkerObjects.hasOwnProperty(vehicleId)) {
@@ -428,6 +448,7 @@ export function clearAllMapLayers() {
         }
     }
     G.setBusMarkerObjects({});
+    G.setBusDataVersion(null, null); // Markers are gone, so the next fetch must be a full one
 
     if (G.sidebarRoutesListDiv) {
          G.sidebarRoutesListDiv.innerHTML = '';
@@ -450,30 +471,35 @@ async function fetchAndDrawRouteShapes(routesParam) {
         return;
     }
     // console.log("fetchAndDrawRouteShapes: Fetching for routes:", routesParam);
+    // Shapes are simplified server-side for the current zoom level
+    const zoom = G.map ? Math.round(G.map.getZoom()) : null;
+    const zoomParam = zoom !== null ? `&zoom=${zoom}` : '';
     try {
-        const response = await fetch(`/api/route_shapes?routes=${routesParam}`);
+        const response = await fetch(`/api/route_shapes?routes=${routesParam}${zoomParam}&format=polyline`);
         if (!response.ok) {
             console.error(`fetchAndDrawRouteShapes: HTTP error ${response.status} for routes ${routesParam}`);
             return;
         }
         const shapesData = await response.json();
-        if (Object.keys(shapesData).length === 0) {
+        const routeShapeRefs = shapesData.routes || {};
+        if (Object.keys(routeShapeRefs).length === 0) {
             // console.log("fetchAndDrawRouteShapes: No shape data received from API for routes:", routesParam);
             return;
         }
 
         const tempRoutePolylines = {};
+        const decodedShapes = {}; // shape hash -> points, decoded once even if several routes share it
 
-        for (const routeId in shapesData) {
-            if (!shapesData.hasOwnProperty(routeId) || !G.selectedRealtimeRouteIds.has(routeId)) {
+        for (const routeId in routeShapeRefs) {
+            if (!routeShapeRefs.hasOwnProperty(routeId) || !G.selectedRealtimeRouteIds.has(routeId)) {
                  continue;
             }
 
              tempRoutePolylines[routeId] = [];
 
-            const shapes = shapesData[routeId];
-            if (!Array.isArray(shapes)) {
-                console.warn(`Shapes for route ${routeId} is not an array:`, shapes);
+            const shapeRefs = routeShapeRefs[routeId];
+            if (!Array.isArray(shapeRefs)) {
+                console.warn(`Shapes for route ${routeId} is not an array:`, shapeRefs);
                 continue;
             }
 
@@ -490,9 +516,13 @@ async function fetchAndDrawRouteShapes(routesParam) {
 
             const isRouteVisible = G.visibleRealtimeRouteIds.has(routeId);
 
-            shapes.forEach((pathPoints) => {
-                if (!Array.isArray(pathPoints) || pathPoints.length < 2) {
-                     // console.warn(`Invalid pathPoints array for route ${routeId}:`, pathPoints);
+            shapeRefs.forEach((shapeHash) => {
+                if (!decodedShapes[shapeHash]) {
+                    decodedShapes[shapeHash] = decodeShape(shapesData.shapes[shapeHash]);
+                }
+                const pathPoints = decodedShapes[shapeHash];
+                if (pathPoints.length < 2) {
+                     // console.warn(`Invalid encoded path for route ${routeId}:`, shapeHash);
                      return;
                 }
                 const validPathPoints = pathPoints.filter(p => typeof p?.lat === 'number' && typeof p?.lng === 'number');
@@ -535,6 +565,7 @@ async function fetchAndDrawRouteShapes(routesParam) {
             }
         }
         G.setRoutePolylines(tempRoutePolylines);
+        G.setRouteShapesZoom(zoom);
 
     } catch (error) {
         console.error("fetchAndDrawRouteShapes: General error:", error);
@@ -542,6 +573,29 @@ async function fetchAndDrawRouteShapes(routesParam) {
     // console.log("fetchAndDrawRouteShapes: FINISHED.");
 }
 
+// Called when the map settles after a zoom/pan. Zooming out keeps the (more detailed) shapes
+// already drawn; zooming in past the level they were simplified for redraws them in more detail.
+export async function refreshRouteShapesForZoom() {
+    if (!G.map || !G.currentMapOptions.showRoutePathsEnabled || G.selectedRealtimeRouteIds.size === 0) {
+        return;
+    }
+    const zoom = Math.round(G.map.getZoom());
+    if (G.routeShapesZoom === null || zoom <= G.routeShapesZoom) {
+        return;
+    }
+    G.setRouteShapesZoom(zoom); // Prevents repeated refreshes while this one is in flight
+
+    const oldPolylines = G.routePolylines;
+    await fetchAndDrawRouteShapes(Array.from(G.selectedRealtimeRouteIds).join(','));
+    if (G.routePolylines !== oldPolylines) {
+        for (const routeId in oldPolylines) {
+            if (oldPolylines.hasOwnProperty(routeId)) {
+                oldPolylines[routeId].forEach(polyline => polyline.setMap(null));
+            }
+        }
+    }
+}
+
 export async function fetchAndUpdateMarkers(routesParam) {
     if (!routesParam) {
         // console.log("fetchAndUpdateMarkers: No routesParam, skipping fetch.");
@@ -550,191 +604,234 @@ export async function fetchAndUpdateMarkers(routesParam) {
 
     // console.log("fetchAndUpdateMarkers: Fetching data for routes:", routesParam);
 
+    // Ask only for what changed since the last snapshot we applied for this exact route set.
+    const sinceVersion = (G.busDataVersion !== null && G.busDataRoutesParam === routesParam) ? G.busDataVersion : 0;
+
     try {
-        const response = await fetch(`/api/bus_data?routes=${routesParam}`);
+        const response = await fetch(`/api/bus_data?routes=${routesParam}&since=${sinceVersion}`);
         if (!response.ok) {
             console.error(`fetchAndUpdateMarkers: HTTP error ${response.status} for routes ${routesParam}`);
             return;
         }
         const busData = await response.json();
-        // console.log(`fetchAndUpdateMarkers: Received ${busData.length} vehicles.`);
+        // console.log(`fetchAndUpdateMarkers: Received ${busData.vehicles.length} changed vehicles (full: ${busData.full}).`);
 
-        const updatedVehicleIds = new Set();
-        const newBusMarkerObjects = { ...G.busMarkerObjects };
+        applyBusData(busData.vehicles, busData.full ? null : busData.removed);
+        G.setBusDataVersion(busData.version, routesParam);
 
-        busData.forEach(bus => {
-            const vehicleId = bus.vehicle_id;
-            const routeId = bus.route_id || 'N/A';
+    } catch (error) {
+        console.error("fetchAndUpdateMarkers: General error:", error);
+    }
+}
 
-            if (!vehicleId || vehicleId === 'N/A' || typeof bus.latitude !== 'number' || typeof bus.longitude !== 'number' || !G.selectedRealtimeRouteIds.has(routeId)) {
-                return;
-            }
-            updatedVehicleIds.add(vehicleId);
-
-            const newPosition = { lat: bus.latitude, lng: bus.longitude };
-            const bearing = Number(bus.bearing) ?? 0;
-            const routeShortName = routeId.includes('_') ? routeId.split('_').pop() : routeId;
-            const speedDisplay = bus.speed || 'N/A';
-            const timeDisplay = formatTimestamp(bus.raw_timestamp);
-            let markerColor = G.assignedRouteColors[routeId] || '#FF0000';
-
-            const currentInfoContent = `
-                <div style="font-family: sans-serif; font-size: 12px; line-height: 1.4; max-width: 200px;">
-                    <strong>Route:</strong> <span style="color:${markerColor}; font-weight:bold;">${routeId}</span><br>
-                    <strong>Vehicle:</strong> ${vehicleId}<br>
-                    ${speedDisplay !== 'N/A' ? `<strong>Speed:</strong> ${speedDisplay}<br>` : ''}
-                    <strong>Last Update:</strong> ${timeDisplay}
-                    ${bus.latitude && bus.longitude ? `<br><strong>Coords:</strong> ${bus.latitude.toFixed(5)}, ${bus.longitude.toFixed(5)}` : ''}
-                </div>`;
-
-            const iconSize = 50;
-            const fontSize = routeShortName.length > 3 ? 7 : (routeShortName.length > 2 ? 8 : 10);
-            const svgContent = `
-                <svg version="1.1" width="${iconSize}" height="${iconSize}" xmlns="http://www.w3.org/2000/svg">
-                    <g transform="rotate(${bearing}, ${iconSize/2}, ${iconSize/2})">
-                        <polygon points="${iconSize *.5},${iconSize * .2} ${iconSize *.7},${iconSize * .3} ${iconSize *.65},${iconSize * .7} ${iconSize *.35},${iconSize * .7} ${iconSize *.3},${iconSize * .3}" fill="${markerColor}" stroke="black" stroke-width="1.5"/>
-                        <circle cx="${iconSize / 2}" cy="${iconSize * .5}" r="${iconSize *.15}" fill="black"/>
-                        <text x="${iconSize / 2}" y="${iconSize / 2}" font-size="${fontSize}" text-anchor="middle" dominant-baseline="central" fill="white" font-family="Arial, sans-serif" transform="rotate(${-bearing}, ${iconSize/2}, ${iconSize/2})">${routeShortName}</text>
-                    </g>
-                </svg>`;
+// Shared by the polling fetch and the /api/bus_stream subscription. With removedVehicleIds === null,
+// busData is the full vehicle list and every other marker is removed; otherwise busData only holds
+// added/changed vehicles and just the listed vehicle ids are removed.
+function applyBusData(busData, removedVehicleIds = null) {
+    const updatedVehicleIds = new Set();
+    const newBusMarkerObjects = { ...G.busMarkerObjects };
 
-            const isRouteVisible = G.visibleRealtimeRouteIds.has(routeId);
+    busData.forEach(bus => {
+        const vehicleId = bus.vehicle_id;
+        const routeId = bus.route_id || 'N/A';
 
-            if (newBusMarkerObjects[vehicleId]) {
-                const md = newBusMarkerObjects[vehicleId];
-                md.route_id = routeId;
-
-                if (md.gmapMarker) {
-                    md.gmapMarker.title = `Route: ${routeId}\nVehicle: ${vehicleId}\nSpeed: ${speedDisplay}\nTime: ${timeDisplay}`;
-                     if (md.gmapMarker.content instanceof HTMLElement) {
-                         md.gmapMarker.content.innerHTML = svgContent;
-                     } else {
-                          const el = document.createElement('div');
-                          el.innerHTML = svgContent;
-                          el.style.cursor = 'pointer';
-                          md.gmapMarker.content = el;
-                     }
-                     md.gmapMarker.map = isRouteVisible ? G.map : null;
-                }
+        if (!vehicleId || vehicleId === 'N/A' || typeof bus.latitude !== 'number' || typeof bus.longitude !== 'number' || !G.selectedRealtimeRouteIds.has(routeId)) {
+            return;
+        }
+        updatedVehicleIds.add(vehicleId);
+
+        const newPosition = { lat: bus.latitude, lng: bus.longitude };
+        const bearing = Number(bus.bearing) ?? 0;
+        const routeShortName = routeId.includes('_') ? routeId.split('_').pop() : routeId;
+        const speedDisplay = bus.speed || 'N/A';
+        const timeDisplay = formatTimestamp(bus.raw_timestamp);
+        let markerColor = G.assignedRouteColors[routeId] || '#FF0000';
+
+        const currentInfoContent = `
+            <div style="font-family: sans-serif; font-size: 12px; line-height: 1.4; max-width: 200px;">
+                <strong>Route:</strong> <span style="color:${markerColor}; font-weight:bold;">${routeId}</span><br>
+                <strong>Vehicle:</strong> ${vehicleId}<br>
+                ${speedDisplay !== 'N/A' ? `<strong>Speed:</strong> ${speedDisplay}<br>` : ''}
+                <strong>Last Update:</strong> ${timeDisplay}
+                ${bus.latitude && bus.longitude ? `<br><strong>Coords:</strong> ${bus.latitude.toFixed(5)}, ${bus.longitude.toFixed(5)}` : ''}
+            </div>`;
+
+        const iconSize = 50;
+        const fontSize = routeShortName.length > 3 ? 7 : (routeShortName.length > 2 ? 8 : 10);
+        const svgContent = `
+            <svg version="1.1" width="${iconSize}" height="${iconSize}" xmlns="http://www.w3.org/2000/svg">
+                <g transform="rotate(${bearing}, ${iconSize/2}, ${iconSize/2})">
+                    <polygon points="${iconSize *.5},${iconSize * .2} ${iconSize *.7},${iconSize * .3} ${iconSize *.65},${iconSize * .7} ${iconSize *.35},${iconSize * .7} ${iconSize *.3},${iconSize * .3}" fill="${markerColor}" stroke="black" stroke-width="1.5"/>
+                    <circle cx="${iconSize / 2}" cy="${iconSize * .5}" r="${iconSize *.15}" fill="black"/>
+                    <text x="${iconSize / 2}" y="${iconSize / 2}" font-size="${fontSize}" text-anchor="middle" dominant-baseline="central" fill="white" font-family="Arial, sans-serif" transform="rotate(${-bearing}, ${iconSize/2}, ${iconSize/2})">${routeShortName}</text>
+                </g>
+            </svg>`;
+
+        const isRouteVisible = G.visibleRealtimeRouteIds.has(routeId);
+
+        if (newBusMarkerObjects[vehicleId]) {
+            const md = newBusMarkerObjects[vehicleId];
+            md.route_id = routeId;
+
+            if (md.gmapMarker) {
+                md.gmapMarker.title = `Route: ${routeId}\nVehicle: ${vehicleId}\nSpeed: ${speedDisplay}\nTime: ${timeDisplay}`;
+                 if (md.gmapMarker.content instanceof HTMLElement) {
+                     md.gmapMarker.content.innerHTML = svgContent;
+                 } else {
+                      const el = document.createElement('div');
+                      el.innerHTML = svgContent;
+                      el.style.cursor = 'pointer';
+                      md.gmapMarker.content = el;
+                 }
+                 md.gmapMarker.map = isRouteVisible ? G.map : null;
+            }
 
-                if (md.infowindow) {
-                    md.infowindow.setContent(currentInfoContent);
-                    if (G.currentlyOpenInfoWindow === md.infowindow && !isRouteVisible) {
-                        md.infowindow.close();
-                        G.setCurrentlyOpenInfoWindow(null);
-                    }
-                } else {
-                     md.infowindow = new google.maps.InfoWindow({ content: currentInfoContent, ariaLabel: `Bus ${vehicleId}`});
-                     md.infowindow.addListener('closeclick', () => {
-                         if (G.currentlyOpenInfoWindow === md.infowindow) {
-                             G.setCurrentlyOpenInfoWindow(null);
-                         }
-                     });
+            if (md.infowindow) {
+                md.infowindow.setContent(currentInfoContent);
+                if (G.currentlyOpenInfoWindow === md.infowindow && !isRouteVisible) {
+                    md.infowindow.close();
+                    G.setCurrentlyOpenInfoWindow(null);
                 }
-
-                const currentMarkerPosition = md.gmapMarker?.position;
-                if (currentMarkerPosition &&
-                    (Math.abs(currentMarkerPosition.lat - newPosition.lat) > 1e-6 || Math.abs(currentMarkerPosition.lng - newPosition.lng) > 1e-6)) {
-                    if (!md.isAnimating || md.targetPos?.lat !== newPosition.lat || md.targetPos?.lng !== newPosition.lng) {
-                        md.startPos = { lat: currentMarkerPosition.lat, lng: currentMarkerPosition.lng };
-                        md.targetPos = newPosition;
-                        md.startTime = performance.now();
-                        md.isAnimating = true;
-                    }
-                } else if (currentMarkerPosition) {
-                    md.isAnimating = false;
-                    md.startPos = null;
-                    if (md.gmapMarker && typeof md.gmapMarker.position === 'object') {
-                        md.gmapMarker.position = newPosition;
-                    }
-                } else {
-                     md.isAnimating = false;
-                     md.startPos = null;
-                     if (md.gmapMarker && typeof md.gmapMarker.position === 'object') {
-                         md.gmapMarker.position = newPosition;
+            } else {
+                 md.infowindow = new google.maps.InfoWindow({ content: currentInfoContent, ariaLabel: `Bus ${vehicleId}`});
+                 md.infowindow.addListener('closeclick', () => {
+                     if (G.currentlyOpenInfoWindow === md.infowindow) {
+                         G.setCurrentlyOpenInfoWindow(null);
                      }
+                 });
+            }
+
+            const currentMarkerPosition = md.gmapMarker?.position;
+            if (currentMarkerPosition &&
+                (Math.abs(currentMarkerPosition.lat - newPosition.lat) > 1e-6 || Math.abs(currentMarkerPosition.lng - newPosition.lng) > 1e-6)) {
+                if (!md.isAnimating || md.targetPos?.lat !== newPosition.lat || md.targetPos?.lng !== newPosition.lng) {
+                    md.startPos = { lat: currentMarkerPosition.lat, lng: currentMarkerPosition.lng };
+                    md.targetPos = newPosition;
+                    md.startTime = performance.now();
+                    md.isAnimating = true;
+                }
+            } else if (currentMarkerPosition) {
+                md.isAnimating = false;
+                md.startPos = null;
+                if (md.gmapMarker && typeof md.gmapMarker.position === 'object') {
+                    md.gmapMarker.position = newPosition;
                 }
             } else {
-                const el = document.createElement('div');
-                el.innerHTML = svgContent;
-                el.style.cursor = 'pointer';
-
-                const newMarker = new google.maps.marker.AdvancedMarkerElement({
-                    map: isRouteVisible ? G.map : null,
-                    position: newPosition,
-                    content: el,
-                    title: `R: ${routeId} V: ${vehicleId}`,
-                    zIndex: 100,
-                    gmpClickable: true
-                });
-
-                const infowindow = new google.maps.InfoWindow({
-                    content: currentInfoContent,
-                    ariaLabel: `Bus ${vehicleId}`
-                });
-
-                infowindow.addListener('closeclick', () => {
-                    if (G.currentlyOpenInfoWindow === infowindow) {
-                        G.setCurrentlyOpenInfoWindow(null);
-                    }
-                });
-
-                const capturedVehicleId = vehicleId;
-                const capturedRouteId = routeId;
-                newMarker.addEventListener('gmp-click', () => {
-                    if (G.visibleRealtimeRouteIds.has(capturedRouteId)) {
-                         const currentMarkerData = newBusMarkerObjects[capturedVehicleId];
-                         if (currentMarkerData && currentMarkerData.infowindow) {
-                             if (G.currentlyOpenInfoWindow && G.currentlyOpenInfoWindow !== currentMarkerData.infowindow) {
-                                 G.currentlyOpenInfoWindow.close();
-                             }
-                             try {
-                                 currentMarkerData.infowindow.open({ anchor: currentMarkerData.gmapMarker, map: G.map });
-                                 G.setCurrentlyOpenInfoWindow(currentMarkerData.infowindow);
-                             } catch (e) {
-                                 console.error('  ERROR calling infowindow.open:', e);
-                                 G.setCurrentlyOpenInfoWindow(null);
-                             }
-                         }
-                         handleRouteInteraction(capturedRouteId);
-                    } else {
-                         if (G.currentlyOpenInfoWindow) {
-                            G.currentlyOpenInfoWindow.close();
-                            G.setCurrentlyOpenInfoWindow(null);
-                          }
-                    }
-                });
-
-                newBusMarkerObjects[vehicleId] = {
-                    gmapMarker: newMarker,
-                    infowindow: infowindow,
-                    isAnimating: false,
-                    startPos: null,
-                    targetPos: newPosition,
-                    startTime: 0,
-                    route_id: routeId
-                };
+                 md.isAnimating = false;
+                 md.startPos = null;
+                 if (md.gmapMarker && typeof md.gmapMarker.position === 'object') {
+                     md.gmapMarker.position = newPosition;
+                 }
             }
-        });
+        } else {
+            const el = document.createElement('div');
+            el.innerHTML = svgContent;
+            el.style.cursor = 'pointer';
+
+            const newMarker = new google.maps.marker.AdvancedMarkerElement({
+                map: isRouteVisible ? G.map : null,
+                position: newPosition,
+                content: el,
+                title: `R: ${routeId} V: ${vehicleId}`,
+                zIndex: 100,
+                gmpClickable: true
+            });
 
-        const vehiclesToRemove = Object.keys(newBusMarkerObjects).filter(vid => !updatedVehicleIds.has(vid));
-        vehiclesToRemove.forEach(vid => {
-            const markerData = newBusMarkerObjects[vid];
-            if (markerData.gmapMarker) {
-                if (G.currentlyOpenInfoWindow && markerData.infowindow === G.currentlyOpenInfoWindow) {
+            const infowindow = new google.maps.InfoWindow({
+                content: currentInfoContent,
+                ariaLabel: `Bus ${vehicleId}`
+            });
+
+            infowindow.addListener('closeclick', () => {
+                if (G.currentlyOpenInfoWindow === infowindow) {
                     G.setCurrentlyOpenInfoWindow(null);
                 }
-                markerData.gmapMarker.map = null;
+            });
+
+            const capturedVehicleId = vehicleId;
+            const capturedRouteId = routeId;
+            newMarker.addEventListener('gmp-click', () => {
+                if (G.visibleRealtimeRouteIds.has(capturedRouteId)) {
+                     const currentMarkerData = newBusMarkerObjects[capturedVehicleId];
+                     if (currentMarkerData && currentMarkerData.infowindow) {
+                         if (G.currentlyOpenInfoWindow && G.currentlyOpenInfoWindow !== currentMarkerData.infowindow) {
+                             G.currentlyOpenInfoWindow.close();
+                         }
+                         try {
+                             currentMarkerData.infowindow.open({ anchor: currentMarkerData.gmapMarker, map: G.map });
+                             G.setCurrentlyOpenInfoWindow(currentMarkerData.infowindow);
+                         } catch (e) {
+                             console.error('  ERROR calling infowindow.open:', e);
+                             G.setCurrentlyOpenInfoWindow(null);
+                         }
+                     }
+                     handleRouteInteraction(capturedRouteId);
+                } else {
+                     if (G.currentlyOpenInfoWindow) {
+                        G.currentlyOpenInfoWindow.close();
+                        G.setCurrentlyOpenInfoWindow(null);
+                      }
+                }
+            });
+
+            newBusMarkerObjects[vehicleId] = {
+                gmapMarker: newMarker,
+                infowindow: infowindow,
+                isAnimating: false,
+                startPos: null,
+                targetPos: newPosition,
+                startTime: 0,
+                route_id: routeId
+            };
+        }
+    });
+
+    const vehiclesToRemove = removedVehicleIds === null
+        ? Object.keys(newBusMarkerObjects).filter(vid => !updatedVehicleIds.has(vid))
+        : removedVehicleIds.filter(vid => newBusMarkerObjects[vid]);
+    vehiclesToRemove.forEach(vid => {
+        const markerData = newBusMarkerObjects[vid];
+        if (markerData.gmapMarker) {
+            if (G.currentlyOpenInfoWindow && markerData.infowindow === G.currentlyOpenInfoWindow) {
+                G.setCurrentlyOpenInfoWindow(null);
             }
-            delete newBusMarkerObjects[vid];
-        });
+            markerData.gmapMarker.map = null;
+        }
+        delete newBusMarkerObjects[vid];
+    });
 
-        G.setBusMarkerObjects(newBusMarkerObjects);
-        startAnimationLoop();
+    G.setBusMarkerObjects(newBusMarkerObjects);
+    startAnimationLoop();
+}
 
-    } catch (error) {
-        console.error("fetchAndUpdateMarkers: General error:", error);
+export function stopBusStream() {
+    if (G.busEventSource) {
+        G.busEventSource.close();
+        G.setBusEventSource(null);
+        console.log("stopBusStream: Closed live vehicle stream.");
+    }
+}
+
+export function startBusStream(routesParam) {
+    stopBusStream();
+    G.setBusDataVersion(null, null); // Streamed lists are full snapshots; later polls start over
+    if (!routesParam) {
+        return;
     }
+    // The server pushes a message whenever a new feed snapshot arrives; EventSource reconnects on its own.
+    const eventSource = new EventSource(`/api/bus_stream?routes=${routesParam}`);
+    eventSource.addEventListener('vehicles', (event) => {
+        try {
+            applyBusData(JSON.parse(event.data));
+        } catch (error) {
+            console.error("startBusStream: Error applying streamed bus data:", error);
+        }
+    });
+    eventSource.onerror = () => {
+        console.warn("startBusStream: Stream error, browser will retry.");
+    };
+    G.setBusEventSource(eventSource);
+    console.log(`startBusStream: Subscribed to live vehicle stream for ${routesParam}.`);
 }
 
 function applyPolylineStyles(routeIdToStyle, isHighlight) {
@@ -7,6 +7,10 @@ export let busMarkerObjects = {};
 export let routePolylines = {};
 export let animationFrameId = null;
 export let dataFetchIntervalId = null;
+export let busEventSource = null;
+export let busDataVersion = null; // Snapshot version of the last /api/bus_data response applied
+export let busDataRoutesParam = null; // ...and the routes it was for
+export let routeShapesZoom = null; // Map zoom level the drawn route shapes were simplified for
 
 // --- Application State Variables ---
 export let selectedOperatorIds = new Set();
@@ -17,7 +21,8 @@ export let assignedRouteColors = {};
 export let currentMapOptions = {
     updateIntervalMs: 20000,
     liveTrackingEnabled: true,
-    showRoutePathsEnabled: true
+    showRoutePathsEnabled: true,
+    streamingEnabled: false
 };
 export let allFetchedRoutesForCurrentOperators = [];
 export let isPreviewingRouteId = null;
@@ -28,7 +33,7 @@ export let closeOperatorsModalBtn, closeRoutesModalBtn, closeOptionsModalBtn;
 export let operatorsListDiv, saveOperatorsBtn;
 export let selectedRoutesListDiv, availableRoutesListDiv, saveRoutesBtn, routeSearchInput;
 export let mapTitleH3;
-export let updateFrequencySelect, toggleLiveTrackingCheckbox, toggleRoutePathsCheckbox, saveOptionsBtn;
+export let updateFrequencySelect, toggleLiveTrackingCheckbox, toggleRoutePathsCheckbox, toggleStreamingCheckbox, saveOptionsBtn;
 export let timerDisplayElement;
 export let sidebarDiv, sidebarRoutesListDiv;
 export let routePreviewContainerDiv; 
@@ -66,6 +71,9 @@ export function setBusMarkerObjects(newObj) { busMarkerObjects = newObj; }
 export function setRoutePolylines(newObj) { routePolylines = newObj; }
 export function setAnimationFrameId(id) { animationFrameId = id; }
 export function setDataFetchIntervalId(id) { dataFetchIntervalId = id; }
+export function setBusEventSource(source) { busEventSource = source; }
+export function setBusDataVersion(version, routesParam) { busDataVersion = version; busDataRoutesParam = routesParam; }
+export function setRouteShapesZoom(zoom) { routeShapesZoom = zoom; }
 export function setSelectedOperatorIds(newSet) { selectedOperatorIds = newSet; }
 export function setSelectedRealtimeRouteIds(newSet) { selectedRealtimeRouteIds = newSet; }
 export function setVisibleRealtimeRouteIds(newSet) { visibleRealtimeRouteIds = newSet; }
@@ -93,6 +101,7 @@ export function setMapTitleH3(el) { mapTitleH3 = el; }
 export function setUpdateFrequencySelect(el) { updateFrequencySelect = el; }
 export function setToggleLiveTrackingCheckbox(el) { toggleLiveTrackingCheckbox = el; }
 export function setToggleRoutePathsCheckbox(el) { toggleRoutePathsCheckbox = el; }
+export function setToggleStreamingCheckbox(el) { toggleStreamingCheckbox = el; }
 export function setSaveOptionsBtn(el) { saveOptionsBtn = el; }
 export function setTimerDisplayElement(el) { timerDisplayElement = el; }
 export function setSidebarDiv(el) { sidebarDiv = el; }
@@ -11,7 +11,7 @@ import { loadStateFromLocalStorage,
          handleSaveRoutes, 
          handleSaveOptions, 
          filterAvailableRoutes } from './map_state_modals.js';
-import { updateMapData, fetchAndUpdateMarkers, populateSidebar, handleRouteInteraction, clearRouteHighlight } from './map_data_layer.js';
+import { updateMapData, fetchAndUpdateMarkers, populateSidebar, handleRouteInteraction, clearRouteHighlight, refreshRouteShapesForZoom } from './map_data_layer.js';
 
 function positionSidebarToggleButton() {
     if (!G.map || !G.sidebarToggleBtn) return false; // Return a status
@@ -81,7 +81,7 @@ async function loadGoogleMapsScript() {
 
         return new Promise((resolve, reject) => {
             const script = document.createElement('script');
-            script.src = `https://maps.googleapis.com/maps/api/js?key=${apiKey}&callback=initMap&v=beta&libraries=marker&loading=async`;
+            script.src = `https://maps.googleapis.com/maps/api/js?key=${apiKey}&callback=initMap&v=beta&libraries=marker,geometry&loading=async`;
             script.async = true;
             script.defer = true;
             script.onload = () => {
@@ -172,6 +172,11 @@ async function initMapGoogleCallback() {
             }
         });
 
+        // Route shapes are simplified per zoom level; fetch more detail after zooming in
+        G.map.addListener('idle', () => {
+            refreshRouteShapesForZoom();
+        });
+
         startAnimationLoop(); // Start animation loop if needed
      } else {
          console.log(">>> initMapGoogleCallback: Map object NOT created. Skipping map data initialization and sidebar positioning.");
@@ -214,6 +219,7 @@ function initializeDOMElements() {
     G.setUpdateFrequencySelect(document.getElementById('update-frequency'));
     G.setToggleLiveTrackingCheckbox(document.getElementById('toggle-live-tracking'));
     G.setToggleRoutePathsCheckbox(document.getElementById('toggle-route-paths'));
+    G.setToggleStreamingCheckbox(document.getElementById('toggle-streaming'));
     G.setSaveOptionsBtn(document.getElementById('save-options'));
     G.setSidebarDiv(document.getElementById('route-sidebar'));
     G.setSidebarRoutesListDiv(document.getElementById('sidebar-routes-list'));
@@ -225,6 +231,7 @@ function initializeDOMElements() {
     if (G.updateFrequencySelect) G.updateFrequencySelect.value = G.currentMapOptions.updateIntervalMs.toString();
     if (G.toggleLiveTrackingCheckbox) G.toggleLiveTrackingCheckbox.checked = G.currentMapOptions.liveTrackingEnabled;
     if (G.toggleRoutePathsCheckbox) G.toggleRoutePathsCheckbox.checked = G.currentMapOptions.showRoutePathsEnabled;
+    if (G.toggleStreamingCheckbox) G.toggleStreamingCheckbox.checked = G.currentMapOptions.streamingEnabled;
 
     console.log("initializeDOMElements: FINISHED. DOM elements stored in G.");
 }
@@ -285,7 +292,8 @@ function startOneSecondCountdown() {
         G.setCountdownValue(G.countdownValue - 1);
         updateTimerDisplay();
 
-        if (G.countdownValue <= G.FETCH_API_AT_COUNT && !G.isFetchingApiData && G.currentMapOptions.liveTrackingEnabled && G.selectedRealtimeRouteIds.size > 0) {
+        // When streaming, updates are pushed by /api/bus_stream, so no early fetch is needed
+        if (G.countdownValue <= G.FETCH_API_AT_COUNT && !G.isFetchingApiData && G.currentMapOptions.liveTrackingEnabled && !G.currentMapOptions.streamingEnabled && G.selectedRealtimeRouteIds.size > 0) {
             console.log(`Countdown reached ${G.countdownValue}s. Fetching data early...`);
             G.setIsFetchingApiData(true);
             const routesParam = Array.from(G.selectedRealtimeRouteIds).join(',');
@@ -429,6 +429,7 @@ export function openOptionsModal() {
     G.updateFrequencySelect.value = G.currentMapOptions.updateIntervalMs.toString();
     G.toggleLiveTrackingCheckbox.checked = G.currentMapOptions.liveTrackingEnabled;
     G.toggleRoutePathsCheckbox.checked = G.currentMapOptions.showRoutePathsEnabled;
+    if (G.toggleStreamingCheckbox) G.toggleStreamingCheckbox.checked = G.currentMapOptions.streamingEnabled;
     G.optionsModal.style.display = "block";
 }
 
@@ -440,16 +441,19 @@ export async function handleSaveOptions() {
     const newUpdateInterval = parseInt(G.updateFrequencySelect.value, 10);
     const newLiveTracking = G.toggleLiveTrackingCheckbox.checked;
     const newShowRoutePaths = G.toggleRoutePathsCheckbox.checked;
+    const newStreaming = G.toggleStreamingCheckbox ? G.toggleStreamingCheckbox.checked : false;
 
     const optionsChanged = G.currentMapOptions.updateIntervalMs !== newUpdateInterval ||
                            G.currentMapOptions.liveTrackingEnabled !== newLiveTracking ||
-                           G.currentMapOptions.showRoutePathsEnabled !== newShowRoutePaths;
+                           G.currentMapOptions.showRoutePathsEnabled !== newShowRoutePaths ||
+                           G.currentMapOptions.streamingEnabled !== newStreaming;
 
     if (optionsChanged) {
          G.setCurrentMapOptions({
              updateIntervalMs: newUpdateInterval,
              liveTrackingEnabled: newLiveTracking,
-             showRoutePathsEnabled: newShowRoutePaths
+             showRoutePathsEnabled: newShowRoutePaths,
+             streamingEnabled: newStreaming
          });
          saveStateToLocalStorage();
          console.log("Map options saved (G.currentMapOptions):", G.currentMapOptions);
@@ -0,0 +1,162 @@
+# synthetic_gtfs.py
+"""
+Deterministic synthetic GTFS static feeds, for benchmarks (see benchmark.py).
+
+Writes the full-network file names (agency.txt, routes.txt, trips.txt,
+shapes.txt, calendar.txt, calendar_dates.txt and optionally stop_times.txt),
+so a generated directory is served with GTFS_STATIC_DIR=<dir> GTFS_NETWORK=full.
+The same scale and seed always produce byte-identical files.
+
+Scales (SCALES) go from about the size of the operator subset up to the whole
+state:
+
+    subset  450 routes,    5.4k trips,  0.2M shape points
+    region  2k routes,     50k trips,   1.6M shape points
+    full    10k routes,    390k trips,  12M shape points (about 700 MB of shapes.txt)
+
+    python synthetic_gtfs.py --scale region --out /tmp/gtfs-region
+"""
+import os
+import json
+import random
+import argparse
+from datetime import date, timedelta
+
+SCALES = {
+    "subset": {"agencies": 1, "routes": 450, "shapes_per_route": 2, "points_per_shape": 220,
+               "trips_per_shape": 6, "stops_per_trip": 20, "duplicate_shape_fraction": 0.15},
+    "region": {"agencies": 40, "routes": 2000, "shapes_per_route": 2, "points_per_shape": 400,
+               "trips_per_shape": 12, "stops_per_trip": 25, "duplicate_shape_fraction": 0.1},
+    "full": {"agencies": 250, "routes": 10000, "shapes_per_route": 3, "points_per_shape": 400,
+             "trips_per_shape": 13, "stops_per_trip": 0, "duplicate_shape_fraction": 0.1},
+}
+# The calendar is fixed (not relative to today) so results don't depend on the run date
+CALENDAR_START = date(2026, 1, 1)
+CALENDAR_DAYS = 365
+SERVICES = 300
+PARAMS_FILE = 'synthetic.json'
+
+_DAY_PATTERNS = ('1111100', '0000011', '1111111', '0000010', '0000001', '1111110')
+
+
+def _gtfs_date(day):
+    return day.strftime('%Y%m%d')
+
+
+def _time(seconds):
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def generate(out_dir, scale='subset', seed=1, **overrides):
+    """
+    Writes a synthetic feed of the given scale (a SCALES key; any parameter can be
+    overridden) into out_dir and returns its parameters. Does nothing if out_dir
+    already holds a feed generated with the same parameters.
+    """
+    params = dict(SCALES[scale], scale=scale, seed=seed, **overrides)
+    params_path = os.path.join(out_dir, PARAMS_FILE)
+    try:
+        with open(params_path) as f:
+            if json.load(f) == params:
+                return params
+    except (FileNotFoundError, ValueError):
+        pass
+
+    os.makedirs(out_dir, exist_ok=True)
+    rng = random.Random(seed)
+    agencies = params["agencies"]
+    route_count = params["routes"]
+
+    with open(os.path.join(out_dir, 'agency.txt'), 'w', newline='') as f:
+        f.write('agency_id,agency_name,agency_url,agency_timezone,agency_lang,agency_phone\n')
+        for a in range(agencies):
+            f.write(f'"{3000 + a}","Synthetic Buses {a}","http://example.com","Australia/Sydney","EN",""\n')
+
+    with open(os.path.join(out_dir, 'calendar.txt'), 'w', newline='') as f:
+        f.write('service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n')
+        end = CALENDAR_START + timedelta(days=CALENDAR_DAYS - 1)
+        for s in range(SERVICES):
+            days = ','.join(f'"{d}"' for d in _DAY_PATTERNS[s % len(_DAY_PATTERNS)])
+            f.write(f'"svc{s}",{days},"{_gtfs_date(CALENDAR_START)}","{_gtfs_date(end)}"\n')
+
+    with open(os.path.join(out_dir, 'calendar_dates.txt'), 'w', newline='') as f:
+        f.write('service_id,date,exception_type\n')
+        for s in range(0, SERVICES, 7):
+            day = CALENDAR_START + timedelta(days=rng.randrange(CALENDAR_DAYS))
+            f.write(f'"svc{s}","{_gtfs_date(day)}","{1 + s % 2}"\n')
+
+    with open(os.path.join(out_dir, 'routes.txt'), 'w', newline='') as f:
+        f.write('route_id,agency_id,route_short_name,route_long_name,route_desc,route_type,'
+                'route_color,route_text_color,exact_times\n')
+        for r in range(route_count):
+            agency_id = 3000 + r % agencies
+            short_name = f"{100 + r // agencies}" if r % 5 else f"{100 + r // agencies}X"
+            f.write(f'"syn-{r}","{agency_id}","{short_name}","Synthetic route {r}","Buses","700",'
+                    f'"00B5EF","FFFFFF","1"\n')
+
+    stops_per_trip = params["stops_per_trip"]
+    points_per_shape = params["points_per_shape"]
+    stop_times = open(os.path.join(out_dir, 'stop_times.txt'), 'w', newline='') if stops_per_trip else None
+    if stop_times is None and os.path.exists(os.path.join(out_dir, 'stop_times.txt')):
+        os.remove(os.path.join(out_dir, 'stop_times.txt'))
+    try:
+        with open(os.path.join(out_dir, 'trips.txt'), 'w', newline='') as trips, \
+                open(os.path.join(out_dir, 'shapes.txt'), 'w', newline='') as shapes:
+            trips.write('route_id,service_id,trip_id,shape_id,trip_headsign,direction_id\n')
+            shapes.write('shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence,shape_dist_traveled\n')
+            if stop_times is not None:
+                stop_times.write('trip_id,arrival_time,departure_time,stop_id,stop_sequence,'
+                                 'pickup_type,drop_off_type\n')
+            trip_number = 0
+            previous_points = None
+            for r in range(route_count):
+                for k in range(params["shapes_per_route"]):
+                    shape_id = f"syn-{r}.{k}"
+                    # Some shapes repeat the previous shape's points under a new id (for dedup)
+                    if previous_points is not None and rng.random() < params["duplicate_shape_fraction"]:
+                        points = previous_points
+                    else:
+                        lat, lon = -33.8 + rng.uniform(-1, 1), 151.0 + rng.uniform(-1, 1)
+                        points = []
+                        for _ in range(points_per_shape):
+                            lat += rng.uniform(-3e-4, 3e-4)
+                            lon += rng.uniform(-3e-4, 3e-4)
+                            points.append((lat, lon))
+                    previous_points = points
+                    shapes.writelines(f'"{shape_id}","{lat:.8f}","{lon:.8f}","{i}","{i * 10.0:.1f}"\n'
+                                      for i, (lat, lon) in enumerate(points, 1))
+
+                    for _ in range(params["trips_per_shape"]):
+                        trip_number += 1
+                        trip_id = f"{trip_number}.syn-{r}.{k}"
+                        trips.write(f'"syn-{r}","svc{rng.randrange(SERVICES)}","{trip_id}","{shape_id}",'
+                                    f'"Synthetic {k}","{k % 2}"\n')
+                        if stop_times is not None:
+                            start = rng.randint(5 * 3600, 25 * 3600)
+                            for s in range(1, stops_per_trip + 1):
+                                arrival = _time(start + s * 90)
+                                stop_times.write(f'"{trip_id}","{arrival}","{arrival}","syn-stop-{r}-{s}",'
+                                                 f'"{s}","0","0"\n')
+    finally:
+        if stop_times is not None:
+            stop_times.close()
+
+    with open(params_path, 'w') as f:
+        json.dump(params, f, indent=1)
+    return params
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a deterministic synthetic GTFS static feed.")
+    parser.add_argument('--scale', choices=sorted(SCALES), default='subset')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', required=True, help="output directory")
+    parser.add_argument('--stops-per-trip', type=int, help="0 leaves out stop_times.txt")
+    args = parser.parse_args()
+    overrides = {} if args.stops_per_trip is None else {"stops_per_trip": args.stops_per_trip}
+    params = generate(args.out, args.scale, args.seed, **overrides)
+    print(f"Synthetic GTFS ({params['scale']}, seed {params['seed']}) in {args.out}")
+
+
+if __name__ == '__main__':
+    main()
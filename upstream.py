@@ -0,0 +1,232 @@
+# upstream.py
+"""
+HTTP client for the realtime feed upstream (TfNSW or a stand-in, see
+feed_server.py).
+
+One UpstreamClient per process keeps a pooled keep-alive requests.Session and,
+per URL:
+
+- coalescing: concurrent fetch() calls share one in-flight download; the
+  callers that arrive while it runs wait for it and get its result
+- revalidation: the ETag / Last-Modified of the last good response are sent
+  back as If-None-Match / If-Modified-Since; a 304 returns the content already
+  held (the same bytes object, so callers can skip re-parsing it)
+- retries: connection errors, timeouts, 429 and 5xx are retried up to
+  UPSTREAM_RETRIES times with exponential backoff and full jitter, within an
+  overall UPSTREAM_DEADLINE_SECONDS
+- circuit breaker: after UPSTREAM_BREAKER_FAILURES failed fetches in a row no
+  request is sent for UPSTREAM_BREAKER_SECONDS, then one trial request decides
+  whether to close it again. While it is open fetch() returns None at once and
+  the app keeps serving the last good snapshot.
+
+Timeouts are (connect, read) per attempt, so a stalled upstream holds a caller
+for at most the deadline. Request handlers never call upstream themselves;
+only the feed poller does (see feed_poller.py).
+"""
+import os
+import time
+import random
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "3"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "10"))
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+UPSTREAM_DEADLINE_SECONDS = float(os.getenv("UPSTREAM_DEADLINE_SECONDS", "20"))
+UPSTREAM_BREAKER_FAILURES = int(os.getenv("UPSTREAM_BREAKER_FAILURES", "5"))
+UPSTREAM_BREAKER_SECONDS = float(os.getenv("UPSTREAM_BREAKER_SECONDS", "30"))
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 8.0
+POOL_SIZE = 4
+
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+UPSTREAM_RETRIES_TOTAL = metrics.Counter('busmap_upstream_retries_total', "Retried upstream attempts.")
+UPSTREAM_COALESCED_TOTAL = metrics.Counter('busmap_upstream_coalesced_total',
+                                           "Fetches answered by another caller's in-flight download.")
+UPSTREAM_CIRCUIT_OPEN = metrics.Gauge('busmap_upstream_circuit_open',
+                                      "1 while the upstream circuit breaker is open.", aggregate='max')
+
+
+class _Flight:
+    """One in-flight download that late callers wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class _UrlState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flight = None
+        self.content = None
+        self.etag = None
+        self.last_modified = None
+        self.failures = 0
+        self.open_until = 0.0
+
+
+class UpstreamClient:
+    def __init__(self, retries=UPSTREAM_RETRIES, deadline=UPSTREAM_DEADLINE_SECONDS,
+                 breaker_failures=UPSTREAM_BREAKER_FAILURES, breaker_seconds=UPSTREAM_BREAKER_SECONDS,
+                 timeout=(UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT)):
+        self.retries = retries
+        self.deadline = deadline
+        self.breaker_failures = breaker_failures
+        self.breaker_seconds = breaker_seconds
+        self.timeout = timeout
+        self._pid = None
+        self._session = None
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def _ensure_process(self):
+        """A forked child must not share the parent's pooled sockets or locks."""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+                    self._states = {}
+                    self._pid = os.getpid()
+
+    def _state(self, url):
+        state = self._states.get(url)
+        if state is None:
+            with self._lock:
+                state = self._states.setdefault(url, _UrlState())
+        return state
+
+    def circuit_open(self, url):
+        return time.monotonic() < self._state(url).open_until
+
+    def fetch(self, url, headers=None):
+        """
+        The body at url, or None if it can't be had (errors are printed). Returns
+        the previously fetched bytes object if upstream answers 304 Not Modified.
+        """
+        self._ensure_process()
+        state = self._state(url)
+        with state.lock:
+            flight = state.flight
+            leader = flight is None
+            if leader:
+                flight = state.flight = _Flight()
+        if not leader:
+            UPSTREAM_COALESCED_TOTAL.inc()
+            flight.done.wait()
+            return flight.result
+
+        try:
+            flight.result = self._fetch_with_breaker(url, state, headers or {})
+        finally:
+            with state.lock:
+                state.flight = None
+            flight.done.set()
+        return flight.result
+
+    def _fetch_with_breaker(self, url, state, headers):
+        now = time.monotonic()
+        if now < state.open_until:
+            metrics.UPSTREAM_FETCH_SECONDS.labels('circuit_open').observe(0.0)
+            return None
+        # Past open_until a single (coalesced) trial request runs; its outcome decides
+        content = self._fetch_with_retries(url, state, headers)
+        if content is None:
+            state.failures += 1
+            if state.failures >= self.breaker_failures:
+                if state.open_until == 0.0:
+                    print(f"Upstream circuit breaker opened for {url} after {state.failures} failures; "
+                          f"serving the last good snapshot.")
+                state.open_until = time.monotonic() + self.breaker_seconds
+                UPSTREAM_CIRCUIT_OPEN.set(1)
+        else:
+            if state.open_until:
+                print(f"Upstream circuit breaker closed for {url}.")
+            state.failures = 0
+            state.open_until = 0.0
+            UPSTREAM_CIRCUIT_OPEN.set(0)
+        return content
+
+    def _fetch_with_retries(self, url, state, headers):
+        deadline = time.monotonic() + self.deadline
+        for attempt in range(self.retries + 1):
+            content, retry_after = self._attempt(url, state, headers)
+            if content is not None or retry_after is None:
+                return content
+            if attempt == self.retries:
+                break
+            backoff = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+            delay = max(backoff, retry_after)
+            if time.monotonic() + delay >= deadline:
+                break
+            UPSTREAM_RETRIES_TOTAL.inc()
+            time.sleep(delay)
+        return None
+
+    def _attempt(self, url, state, headers):
+        """
+        One request. Returns (content, None) on success, (None, seconds to wait
+        at least) if it should be retried, or (None, None) if not.
+        """
+        request_headers = dict(headers)
+        if state.content is not None:
+            if state.etag:
+                request_headers["If-None-Match"] = state.etag
+            if state.last_modified:
+                request_headers["If-Modified-Since"] = state.last_modified
+
+        started = time.perf_counter()
+        try:
+            response = self._session.get(url, headers=request_headers, timeout=self.timeout)
+        except requests.exceptions.Timeout:
+            metrics.UPSTREAM_FETCH_SECONDS.labels('timeout').observe(time.perf_counter() - started)
+            print(f"Error: Request to {url} timed out.")
+            return None, 0.0
+        except requests.exceptions.RequestException as e:
+            metrics.UPSTREAM_FETCH_SECONDS.labels('error').observe(time.perf_counter() - started)
+            print(f"Error fetching data: {e}")
+            return None, 0.0
+        elapsed = time.perf_counter() - started
+
+        if response.status_code == 304 and state.content is not None:
+            metrics.UPSTREAM_FETCH_SECONDS.labels('not_modified').observe(elapsed)
+            return state.content, None
+        if response.status_code != 200:
+            metrics.UPSTREAM_FETCH_SECONDS.labels('error').observe(elapsed)
+            print(f"Error fetching data: HTTP {response.status_code} from {url}")
+            if response.status_code in (401, 403):
+                print("Authentication failed (401/403). Check your API key (API_KEY in .env) and ensure it has access.")
+            elif response.status_code == 404:
+                print("API endpoint not found (404). Check the URL (BUS_URL in .env).")
+            if response.status_code in _RETRY_STATUSES:
+                return None, _retry_after_seconds(response)
+            return None, None
+
+        metrics.UPSTREAM_FETCH_SECONDS.labels('ok').observe(elapsed)
+        metrics.UPSTREAM_PAYLOAD_BYTES.observe(len(response.content))
+        state.content = response.content
+        state.etag = response.headers.get("ETag")
+        state.last_modified = response.headers.get("Last-Modified")
+        return state.content, None
+
+
+def _retry_after_seconds(response):
+    """A Retry-After given in seconds, capped at BACKOFF_MAX_SECONDS; 0 if absent or a date."""
+    value = response.headers.get("Retry-After", "")
+    try:
+        return min(float(value), BACKOFF_MAX_SECONDS)
+    except ValueError:
+        return 0.0
+
+
+# Shared by everything in this process that fetches the feed
+default_client = UpstreamClient()